@@ -0,0 +1,278 @@
+#!/usr/bin/python3
+# Copyright (c) 2011-2026 TurnKey GNU/Linux - http://www.turnkeylinux.org
+#
+# This file is part of buildtasks.
+#
+# Buildtasks is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+
+"""
+Compress stdin (e.g., a tar stream) into one or more files using all CPUs
+
+gzip (.gz) and bzip2 (.bz2) output is compressed in parallel blocks,
+each written as a complete gzip member or bzip2 stream (like pigz
+--independent and pbzip2), which gzip, bzip2, tar and zlib all read as
+one file. zstd (.zst) and xz (.xz) output is piped through zstd -T0 and
+xz -T0, which are multi-threaded themselves. The format of each output
+is taken from its suffix, so a single tar stream can be written in
+several formats at once.
+
+The sha256 and sha512 digests of gzip and bzip2 output are computed as
+it is written and recorded in OUTPUT.digest (see digest.py), so signing
+it doesn't read it again.
+
+Arguments:
+
+    output          Path to write (.gz, .bz2, .zst or .xz; repeatable)
+
+Options:
+
+    --workers=      Compression threads (default: number of CPUs)
+    --level=        Compression level of all formats, or FORMAT:LEVEL
+                    for one (e.g., zst:19; repeatable). Ranges (and
+                    defaults): gz 0-9 (6), bz2 1-9 (9), zst 1-19 (3),
+                    xz 0-9 (6)
+
+Environment:
+
+    BT_COMPRESS_EXTRA   Extra formats (e.g., "zst xz") also written next to
+                        the first output (same name, other suffix)
+
+"""
+import os
+import sys
+import bz2
+import zlib
+import getopt
+import hashlib
+import subprocess
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import digest
+
+# a multiple of bzip2's (level 9) block size, so blocks split evenly
+BLOCK_SIZE = 2 * 900000
+
+LEVELS = {'gz': 6, 'bz2': 9, 'zst': 3, 'xz': 6}
+
+# valid levels (zstd's 20-22 need --ultra, so aren't offered)
+LEVEL_RANGES = {'gz': (0, 9), 'bz2': (1, 9), 'zst': (1, 19), 'xz': (0, 9)}
+
+ALGORITHMS = ('sha256', 'sha512')
+
+
+class CompressError(Exception):
+    pass
+
+
+def fatal(e):
+    print("error: " + str(e), file=sys.stderr)
+    sys.exit(1)
+
+
+def usage(e=None):
+    if e:
+        print("error: " + str(e), file=sys.stderr)
+
+    print("Syntax: %s [ -options ] output... < input" % (sys.argv[0]),
+          file=sys.stderr)
+    print(__doc__.strip(), file=sys.stderr)
+
+    sys.exit(1)
+
+
+def get_format(path):
+    fmt = path.rsplit('.', 1)[-1]
+    if fmt not in LEVELS:
+        raise CompressError(f'unknown format: {path}')
+    return fmt
+
+
+def get_level(fmt, levels=None):
+    """Return compression level of fmt from {format: level} levels (or
+    the default), raising CompressError if it's out of range"""
+    level = levels.get(fmt, LEVELS[fmt]) if levels else LEVELS[fmt]
+    low, high = LEVEL_RANGES[fmt]
+    if not low <= level <= high:
+        raise CompressError(f'invalid {fmt} level: {level} '
+                            f'(must be {low}-{high})')
+    return level
+
+
+class BlockOutput:
+    """gzip or bzip2 output, compressed block by block"""
+
+    def __init__(self, path, fmt, level):
+        self.path = path
+        self.fmt = fmt
+        self.level = level
+        self.fob = open(path, 'wb')
+        self.hashes = [hashlib.new(algorithm) for algorithm in ALGORITHMS]
+
+    def compress(self, block):
+        # called from worker threads; zlib and bz2 release the GIL
+        if self.fmt == 'gz':
+            c = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+            return c.compress(block) + c.flush()
+        return bz2.compress(block, self.level)
+
+    def write(self, data):
+        self.fob.write(data)
+        for h in self.hashes:
+            h.update(data)
+
+    def close(self):
+        self.fob.close()
+        digest.store(self.path, {algorithm: h.hexdigest() for algorithm, h
+                                 in zip(ALGORITHMS, self.hashes)})
+
+
+class PipeOutput:
+    """zstd or xz output, compressed by a multi-threaded subprocess"""
+
+    def __init__(self, path, fmt, level):
+        self.path = path
+        command = {'zst': ['zstd', '-q'], 'xz': ['xz']}[fmt]
+        with open(path, 'wb') as fob:
+            try:
+                self.proc = subprocess.Popen(command + ['-T0', f'-{level}',
+                                                        '-c'],
+                                             stdin=subprocess.PIPE,
+                                             stdout=fob)
+            except OSError as e:
+                raise CompressError(f'{command[0]}: {e}')
+
+    def write(self, block):
+        self.proc.stdin.write(block)
+
+    def close(self):
+        self.proc.stdin.close()
+        if self.proc.wait() != 0:
+            raise CompressError(f'{self.path}: {self.proc.args[0]} '
+                                f'failed ({self.proc.returncode})')
+
+
+def _read(fob, size):
+    # a short read on a pipe isn't the end of input
+    chunks = []
+    while size:
+        chunk = fob.read(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def compress(fob, paths, workers=None, levels=None):
+    """Compress file object fob into each of paths (format by suffix),
+    at {format: level} levels (default: LEVELS)"""
+    workers = workers if workers else os.cpu_count() or 1
+
+    # check every output before any is created
+    formats = [get_format(path) for path in paths]
+    output_levels = [get_level(fmt, levels) for fmt in formats]
+
+    blocks = []
+    pipes = []
+    try:
+        for path, fmt, level in zip(paths, formats, output_levels):
+            if fmt in ('gz', 'bz2'):
+                blocks.append(BlockOutput(path, fmt, level))
+            else:
+                pipes.append(PipeOutput(path, fmt, level))
+
+        # compressed blocks are written in order; at most 2 per worker
+        # are in flight, which bounds memory use
+        queue = deque()
+
+        def write_next():
+            for output, future in zip(blocks, queue.popleft()):
+                output.write(future.result())
+
+        with ThreadPoolExecutor(workers) as executor:
+            empty = True
+            for block in iter(lambda: _read(fob, BLOCK_SIZE), b''):
+                empty = False
+                for output in pipes:
+                    output.write(block)
+                queue.append([executor.submit(output.compress, block)
+                              for output in blocks])
+                while len(queue) > 2 * workers:
+                    write_next()
+
+            while queue:
+                write_next()
+
+        # empty input still makes a valid (empty) gzip or bzip2 file
+        if empty:
+            for output in blocks:
+                output.write(output.compress(b''))
+
+        for output in blocks + pipes:
+            output.close()
+
+    except BaseException:
+        for output in blocks + pipes:
+            if isinstance(output, PipeOutput):
+                output.proc.kill()
+            if os.path.exists(output.path):
+                os.remove(output.path)
+        raise
+
+
+def main():
+    try:
+        l_opts = ["help", "workers=", "level="]
+        opts, args = getopt.gnu_getopt(sys.argv[1:], "h", l_opts)
+    except getopt.GetoptError as e:
+        usage(e)
+
+    workers = None
+    level = None
+    levels = {}
+    for opt, val in opts:
+        if opt in ('-h', '--help'):
+            usage()
+
+        try:
+            if opt == "--workers":
+                workers = int(val)
+
+            if opt == "--level":
+                fmt, _, value = val.rpartition(':')
+                if not fmt:
+                    level = int(value)
+                elif fmt in LEVELS:
+                    levels[fmt] = int(value)
+                else:
+                    usage(f"unknown format: {fmt}")
+        except ValueError:
+            usage(f"invalid {opt}: {val}")
+
+    if not args:
+        usage("incorrect number of arguments")
+
+    # a per-format --level overrides --level for all formats
+    if level is not None:
+        levels = dict({fmt: level for fmt in LEVELS}, **levels)
+
+    paths = list(args)
+    base = paths[0].rsplit('.', 1)[0]
+    for fmt in os.environ.get('BT_COMPRESS_EXTRA', '').split():
+        path = f'{base}.{fmt}'
+        if path not in paths:
+            paths.append(path)
+
+    try:
+        compress(sys.stdin.buffer, paths, workers, levels)
+    except (OSError, CompressError) as e:
+        fatal(e)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+#!/usr/bin/python3
+# Copyright (c) 2011-2026 TurnKey GNU/Linux - http://www.turnkeylinux.org
+#
+# This file is part of buildtasks.
+#
+# Buildtasks is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+
+"""
+Print digests of files (like sha256sum), reusing cached digests
+
+All requested digests are computed in a single read of the file (each
+block is hashed by all algorithms concurrently), and cached in a sidecar
+file (FILE.digest) keyed by the file's device, inode, size, mtime and
+ctime, so an unchanged file is only read once (e.g., download.py records
+the digests of what it downloads).
+
+With several algorithms, a line is printed per file and algorithm, in
+the order given.
+
+Arguments:
+
+    file            Path to file (repeatable)
+
+Options:
+
+    --algorithm=    Digest algorithm (repeatable, default: sha256)
+
+"""
+import os
+import sys
+import json
+import getopt
+import hashlib
+
+from concurrent.futures import ThreadPoolExecutor
+
+SUFFIX = '.digest'
+
+BLOCK_SIZE = 4 * 2**20
+
+
+def usage(e=None):
+    if e:
+        print("error: " + str(e), file=sys.stderr)
+
+    print("Syntax: %s [ -options ] file..." % (sys.argv[0]), file=sys.stderr)
+    print(__doc__.strip(), file=sys.stderr)
+
+    sys.exit(1)
+
+
+def _key(st):
+    return [st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns]
+
+
+def load(path):
+    """Return dict of cached digests of path ({} if none are valid)"""
+    try:
+        with open(path + SUFFIX) as fob:
+            cached = json.load(fob)
+        if cached.get('key') == _key(os.stat(path)):
+            return cached['digests']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    return {}
+
+
+def store(path, digests):
+    """Add digests (dict of algorithm: hexdigest) of path to its cache"""
+    key = _key(os.stat(path))
+    digests = dict(load(path), **digests)
+    tmp = f'{path}{SUFFIX}.{os.getpid()}'
+    with open(tmp, 'w') as fob:
+        json.dump({'key': key, 'digests': digests}, fob)
+    os.rename(tmp, path + SUFFIX)
+
+
+def compute(path, algorithms):
+    """Return dict of hexdigests of path for each of algorithms, reading
+    it once"""
+    hashes = [hashlib.new(algorithm) for algorithm in algorithms]
+    # hashlib releases the GIL for large updates, so each algorithm gets
+    # a thread; blocks are read (into reused buffers) while the previous
+    # block is hashed
+    buffers = [bytearray(BLOCK_SIZE), bytearray(BLOCK_SIZE)]
+    with open(path, 'rb', buffering=0) as fob, \
+            ThreadPoolExecutor(len(hashes)) as executor:
+        pending = []
+        n = 0
+        while True:
+            view = memoryview(buffers[n % 2])
+            size = fob.readinto(view)
+            for future in pending:
+                future.result()
+            if not size:
+                break
+
+            pending = [executor.submit(h.update, view[:size])
+                       for h in hashes]
+            n += 1
+
+    return {algorithm: h.hexdigest()
+            for algorithm, h in zip(algorithms, hashes)}
+
+
+def get_many(path, algorithms):
+    """Return dict of hexdigests of path for each of algorithms, from its
+    cache if still valid; missing ones are computed and cached"""
+    cached = load(path)
+    missing = [a for a in algorithms if a not in cached]
+    if missing:
+        key = _key(os.stat(path))
+        digests = compute(path, missing)
+        # not cached if path changed while it was read
+        if _key(os.stat(path)) == key:
+            try:
+                store(path, digests)
+            except OSError:
+                pass
+        cached.update(digests)
+
+    return {algorithm: cached[algorithm] for algorithm in algorithms}
+
+
+def get(path, algorithm='sha256'):
+    """Return hexdigest of path, from its cache if still valid"""
+    return get_many(path, [algorithm])[algorithm]
+
+
+def main():
+    try:
+        l_opts = ["help", "algorithm="]
+        opts, args = getopt.gnu_getopt(sys.argv[1:], "h", l_opts)
+    except getopt.GetoptError as e:
+        usage(e)
+
+    algorithms = []
+    for opt, val in opts:
+        if opt in ('-h', '--help'):
+            usage()
+
+        if opt == "--algorithm":
+            if val not in hashlib.algorithms_available:
+                usage(f"unknown algorithm: {val}")
+            algorithms.append(val)
+
+    if not args:
+        usage("incorrect number of arguments")
+
+    algorithms = algorithms if algorithms else ['sha256']
+    for path in args:
+        try:
+            digests = get_many(path, algorithms)
+        except OSError as e:
+            print("error: " + str(e), file=sys.stderr)
+            sys.exit(1)
+
+        for algorithm in algorithms:
+            print(f'{digests[algorithm]}  {path}')
+
+
+if __name__ == "__main__":
+    main()
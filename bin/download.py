@@ -0,0 +1,477 @@
+#!/usr/bin/python3
+# Copyright (c) 2011-2026 TurnKey GNU/Linux - http://www.turnkeylinux.org
+#
+# This file is part of buildtasks.
+#
+# Buildtasks is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+
+"""
+Download file in parallel ranges from one or more sources, resumably
+
+The file is split into ranges which workers fetch concurrently, each
+worker from its own choice of the working sources, so e.g. the mirror
+and the S3 bucket are both used at once; a source that keeps failing is
+dropped. Ranges are written into DEST.part and the completed ones
+recorded in DEST.part.state, so an interrupted download resumes where it
+left off.
+
+The sha256 and sha512 digests are computed in order as ranges complete
+(from memory, not re-read from disk) and recorded in DEST.digest (see
+digest.py), so verifying the download doesn't read it again.
+
+Arguments:
+
+    dest            Path to download to
+    source          http(s):// URL or s3://bucket/key (repeatable; all
+                    sources must serve the same file; s3:// sources are
+                    skipped if boto3 isn't installed or no AWS
+                    credentials are configured)
+
+Options:
+
+    --workers=      Concurrent range requests (default: 8)
+    --chunk-size=   Range size in MiB (default: 8)
+
+Environment:
+
+    AWS_DEFAULT_REGION      Region of the S3 client (default: us-east-1)
+
+"""
+import os
+import sys
+import json
+import time
+import getopt
+import hashlib
+import logging
+import threading
+import http.client
+import urllib.request
+
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import boto3
+
+    from botocore.config import Config
+    from botocore.exceptions import BotoCoreError, ClientError
+    BOTO_ERRORS = (BotoCoreError, ClientError)
+except ImportError:
+    # e.g., a non-EC2 build host; s3:// sources are skipped
+    boto3 = None
+    BOTO_ERRORS = ()
+
+import digest
+
+WORKERS = 8
+CHUNK_SIZE = 8 * 2**20
+
+ALGORITHMS = ('sha256', 'sha512')
+
+# like wget --read-timeout=60 --tries=10
+TIMEOUT = 60
+ATTEMPTS = 10
+
+# consecutive failed requests after which a source is dropped
+SOURCE_FAILURES = 3
+
+# seconds between saving the state of a download, and logging progress
+STATE_INTERVAL = 5
+PROGRESS_INTERVAL = 30
+
+SOURCE_ERRORS = (OSError, http.client.HTTPException) + BOTO_ERRORS
+
+
+class DownloadError(Exception):
+    pass
+
+
+def get_logger(name):
+    logger = logging.getLogger(name)
+    if not logger.handlers:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(
+            logging.Formatter('%(levelname)s [%(name)s]: %(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+    return logger
+
+
+log = get_logger('download')
+
+_s3 = None
+_s3_lock = threading.Lock()
+
+
+def s3_client():
+    """Return the S3 client shared by all workers (boto3 clients are
+    thread-safe, sessions aren't)"""
+    global _s3
+    with _s3_lock:
+        if _s3 is None:
+            region = os.environ.get('AWS_DEFAULT_REGION', 'us-east-1')
+            config = Config(max_pool_connections=2 * WORKERS,
+                            retries={'max_attempts': 3, 'mode': 'standard'})
+            _s3 = boto3.session.Session().client('s3', region_name=region,
+                                                 config=config)
+        return _s3
+
+
+def fatal(e):
+    print("error: " + str(e), file=sys.stderr)
+    sys.exit(1)
+
+
+def usage(e=None):
+    if e:
+        print("error: " + str(e), file=sys.stderr)
+
+    print("Syntax: %s [ -options ] dest source..." % (sys.argv[0]),
+          file=sys.stderr)
+    print(__doc__.strip(), file=sys.stderr)
+
+    sys.exit(1)
+
+
+class HTTPSource:
+    def __init__(self, url):
+        self.url = url
+        self.failures = 0
+
+    def __str__(self):
+        return self.url
+
+    def _get(self, start, end):
+        request = urllib.request.Request(
+            self.url, headers={'Range': f'bytes={start}-{end - 1}'})
+        response = urllib.request.urlopen(request, timeout=TIMEOUT)
+        if response.status != 206:
+            response.close()
+            raise DownloadError(f'{self.url}: range requests not supported')
+        return response
+
+    def size(self):
+        # a range request rather than HEAD, as redirects turn HEAD into GET
+        with self._get(0, 1) as response:
+            total = response.headers.get('Content-Range', '').split('/')[-1]
+            # stay on the mirror redirected to, so all ranges match
+            self.url = response.geturl()
+        if not total.isdigit():
+            raise DownloadError(f'{self.url}: size unknown')
+        return int(total)
+
+    def read(self, start, end):
+        with self._get(start, end) as response:
+            return response.read()
+
+
+class S3Source:
+    def __init__(self, url):
+        self.url = url
+        self.bucket, _, self.key = url[len('s3://'):].partition('/')
+        self.failures = 0
+
+    def __str__(self):
+        return self.url
+
+    def size(self):
+        response = s3_client().head_object(Bucket=self.bucket,
+                                           Key=self.key)
+        return response['ContentLength']
+
+    def read(self, start, end):
+        response = s3_client().get_object(Bucket=self.bucket,
+                                          Key=self.key,
+                                          Range=f'bytes={start}-{end - 1}')
+        return response['Body'].read()
+
+
+def have_credentials():
+    """Return True if boto finds AWS credentials (env, config or role)"""
+    if boto3 is None:
+        return False
+
+    try:
+        return boto3.session.Session().get_credentials() is not None
+    except BotoCoreError:
+        return False
+
+
+def source(url):
+    if url.startswith('s3://'):
+        return S3Source(url)
+    if url.startswith(('http://', 'https://')):
+        return HTTPSource(url)
+    raise DownloadError(f'unsupported source: {url}')
+
+
+class Download:
+    """Download of path from sources (list of URLs); see run()"""
+
+    def __init__(self, path, sources, workers=None, chunk_size=None):
+        self.path = path
+        self.part = path + '.part'
+        self.state_path = self.part + '.state'
+        self.sources = [source(url) for url in sources]
+        self.workers = workers if workers else WORKERS
+        self.chunk_size = chunk_size if chunk_size else CHUNK_SIZE
+
+        self.size = None
+        self.fd = None
+        self.cond = threading.Condition()
+        self.pending = []
+        self.done = set()
+        self.buffers = {}
+        self.hashed = 0
+        self.error = None
+        self.stopped = False
+
+    def _probe(self):
+        """Set size from the first working source, dropping the others if
+        they don't work or serve a different size"""
+        s3 = [s for s in self.sources if isinstance(s, S3Source)]
+        if s3 and not have_credentials():
+            if len(s3) == len(self.sources):
+                raise DownloadError('no boto3 or AWS credentials for S3 '
+                                    'sources')
+            # e.g., a mirror with an S3 fallback, on a host without AWS
+            log.debug('no boto3 or AWS credentials, skipping S3 sources')
+            self.sources = [s for s in self.sources if s not in s3]
+
+        def size(source):
+            try:
+                return source.size()
+            except (DownloadError,) + SOURCE_ERRORS as e:
+                return e
+
+        with ThreadPoolExecutor(len(self.sources)) as executor:
+            sizes = list(executor.map(size, self.sources))
+
+        working = []
+        for source, size in zip(self.sources, sizes):
+            if isinstance(size, Exception):
+                log.warning(f'{source}: {size}')
+            elif self.size not in (None, size):
+                log.warning(f'{source}: size {size} != {self.size}')
+            else:
+                self.size = size
+                working.append(source)
+
+        if not working:
+            raise DownloadError('no working sources')
+        self.sources = working
+
+    def _range(self, chunk):
+        start = chunk * self.chunk_size
+        return start, min(start + self.chunk_size, self.size)
+
+    def _load_state(self):
+        try:
+            with open(self.state_path) as fob:
+                state = json.load(fob)
+        except (OSError, ValueError):
+            return set()
+
+        if (state.get('size'), state.get('chunk_size')) != \
+                (self.size, self.chunk_size) or \
+                not os.path.exists(self.part):
+            log.info(f'{self.part}: remote file changed, starting over')
+            return set()
+        return set(state['done'])
+
+    def _save_state(self):
+        with self.cond:
+            done = sorted(self.done)
+
+        # ranges are only recorded as done once they're on disk
+        os.fdatasync(self.fd)
+        tmp = self.state_path + '.tmp'
+        with open(tmp, 'w') as fob:
+            json.dump({'size': self.size, 'chunk_size': self.chunk_size,
+                       'done': done}, fob)
+        os.rename(tmp, self.state_path)
+
+    def _next_source(self, n):
+        with self.cond:
+            working = [s for s in self.sources
+                       if s.failures < SOURCE_FAILURES]
+        if not working:
+            return None
+        return working[n % len(working)]
+
+    def _fetch(self, chunk, worker):
+        start, end = self._range(chunk)
+        for attempt in range(ATTEMPTS):
+            if self.stopped:
+                raise DownloadError('stopped')
+
+            source = self._next_source(worker + attempt)
+            if source is None:
+                raise DownloadError('no working sources left')
+
+            try:
+                data = source.read(start, end)
+                if len(data) != end - start:
+                    raise DownloadError(f'short read ({len(data)} bytes)')
+            except (DownloadError,) + SOURCE_ERRORS as e:
+                log.warning(f'{source}: bytes {start}-{end - 1}: {e}')
+                with self.cond:
+                    source.failures += 1
+                    if source.failures == SOURCE_FAILURES:
+                        log.warning(f'dropping {source}')
+                time.sleep(min(2 ** attempt, 30))
+                continue
+
+            with self.cond:
+                source.failures = 0
+            return data
+
+        raise DownloadError(f'bytes {start}-{end - 1}: failed after '
+                            f'{ATTEMPTS} attempts')
+
+    def _worker(self, worker):
+        # ranges aren't fetched too far ahead of hashing, which bounds the
+        # memory held by buffers
+        window = 2 * self.workers
+        while True:
+            with self.cond:
+                while (self.pending and not self.stopped and
+                       self.pending[0] >= self.hashed + window):
+                    self.cond.wait()
+                if self.stopped or not self.pending:
+                    return
+                chunk = self.pending.pop(0)
+
+            try:
+                data = self._fetch(chunk, worker)
+            except DownloadError as e:
+                with self.cond:
+                    self.error = self.error or e
+                    self.stopped = True
+                    self.cond.notify_all()
+                return
+
+            os.pwrite(self.fd, data, chunk * self.chunk_size)
+            with self.cond:
+                self.done.add(chunk)
+                self.buffers[chunk] = data
+                self.cond.notify_all()
+
+    def run(self):
+        """Download path, record its digests and return them (dict of
+        algorithm: hexdigest)"""
+        started = time.monotonic()
+        self._probe()
+        chunks = max(1, -(-self.size // self.chunk_size))
+        self.done = self._load_state()
+        resumed = sum(self._range(chunk)[1] - self._range(chunk)[0]
+                      for chunk in self.done)
+        self.pending = [chunk for chunk in range(chunks)
+                        if chunk not in self.done]
+
+        log.info(f'downloading {os.path.basename(self.path)} '
+                 f'({self.size // 2**20}MiB) from '
+                 f'{", ".join(str(s) for s in self.sources)}')
+        if resumed:
+            log.info(f'resuming, {resumed // 2**20}MiB already downloaded')
+
+        self.fd = os.open(self.part, os.O_RDWR | os.O_CREAT, 0o644)
+        os.ftruncate(self.fd, self.size)
+
+        threads = []
+        for worker in range(min(self.workers, len(self.pending))):
+            thread = threading.Thread(target=self._worker, args=(worker,),
+                                      daemon=True)
+            thread.start()
+            threads.append(thread)
+
+        hashes = [hashlib.new(algorithm) for algorithm in ALGORITHMS]
+        saved = logged = time.monotonic()
+        try:
+            for chunk in range(chunks):
+                with self.cond:
+                    while chunk not in self.done and not self.error:
+                        self.cond.wait()
+                    if self.error:
+                        raise self.error
+                    data = self.buffers.pop(chunk, None)
+
+                start, end = self._range(chunk)
+                if data is None:
+                    # downloaded before resuming
+                    data = os.pread(self.fd, end - start, start)
+                for h in hashes:
+                    h.update(data)
+
+                with self.cond:
+                    self.hashed = chunk + 1
+                    self.cond.notify_all()
+
+                now = time.monotonic()
+                if now - saved > STATE_INTERVAL:
+                    self._save_state()
+                    saved = now
+                if now - logged > PROGRESS_INTERVAL:
+                    rate = (end - resumed) / 2**20 / (now - started)
+                    log.info(f'{end // 2**20}/{self.size // 2**20}MiB '
+                             f'({rate:.1f}MiB/s)')
+                    logged = now
+        finally:
+            with self.cond:
+                self.stopped = True
+                self.cond.notify_all()
+            self._save_state()
+
+        for thread in threads:
+            thread.join()
+        os.close(self.fd)
+
+        os.rename(self.part, self.path)
+        os.remove(self.state_path)
+        digests = {algorithm: h.hexdigest()
+                   for algorithm, h in zip(ALGORITHMS, hashes)}
+        digest.store(self.path, digests)
+
+        elapsed = time.monotonic() - started
+        rate = (self.size - resumed) / 2**20 / max(elapsed, 0.001)
+        log.info(f'downloaded {os.path.basename(self.path)} in '
+                 f'{elapsed:.1f}s ({rate:.1f}MiB/s)')
+        return digests
+
+
+def main():
+    try:
+        l_opts = ["help", "workers=", "chunk-size="]
+        opts, args = getopt.gnu_getopt(sys.argv[1:], "h", l_opts)
+    except getopt.GetoptError as e:
+        usage(e)
+
+    workers = None
+    chunk_size = None
+    for opt, val in opts:
+        if opt in ('-h', '--help'):
+            usage()
+
+        if opt == "--workers":
+            workers = int(val)
+
+        if opt == "--chunk-size":
+            chunk_size = int(val) * 2**20
+
+    if len(args) < 2:
+        usage("incorrect number of arguments")
+
+    dest, sources = args[0], args[1:]
+    try:
+        Download(dest, sources, workers, chunk_size).run()
+    except (DownloadError,) + SOURCE_ERRORS as e:
+        fatal(e)
+    except KeyboardInterrupt:
+        fatal("interrupted (run again to resume)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+# Copyright (c) 2011-2026 TurnKey GNU/Linux - http://www.turnkeylinux.org
+#
+# This file is part of buildtasks.
+#
+# Buildtasks is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+
+"""Attachment slots and kernel device resolution for EBS volumes
+
+Slots (the device name passed to AttachVolume) are handed out under an
+flock so concurrent bundles on one host never pick the same name. Once
+attached, the kernel device is found by NVMe serial (Nitro) or Xen name,
+waiting on udev events rather than polling.
+"""
+
+import os
+import time
+import fcntl
+import select
+import string
+import subprocess
+
+import utils
+import waiter
+
+log = utils.get_logger('ebs-blockdev')
+
+LOCK_DIR = '/run/lock/buildtasks-ebs'
+# overridable so ec2_standin.py can fake attachments with loop devices
+BYID_DIR = os.environ.get('BT_EBS_BYID_DIR', '/dev/disk/by-id')
+
+# names AWS accepts for EBS volumes on HVM instances, in preference order
+SLOTS = (['/dev/sd' + c for c in 'fghijklmnopqrstuvwxyz'] +
+         ['/dev/xvd' + p + c for p in 'bc' for c in string.ascii_lowercase])
+
+
+class BlockDevError(Exception):
+    pass
+
+
+def xen_path(amazon_path):
+    # /dev/sdf -> /dev/xvdf (Xen instances rename devices)
+    return '/dev/xvd' + amazon_path[len('/dev/sd'):] \
+        if amazon_path.startswith('/dev/sd') else amazon_path
+
+
+def nvme_serial(volume_id):
+    # NVMe serial of an EBS volume is its id without the dash
+    return volume_id.replace('-', '')
+
+
+def attached_device_names(instance_id=None):
+    instance_id = instance_id if instance_id else utils.get_instanceid()
+    conn = utils.connect()
+    response = conn.describe_instances(InstanceIds=[instance_id])
+    instance = response['Reservations'][0]['Instances'][0]
+    return set(m['DeviceName'] for m in instance['BlockDeviceMappings'])
+
+
+class Slot:
+    """An attachment device name, held (flock) until release()"""
+
+    def __init__(self, amazon_path, fd):
+        self.amazon_path = amazon_path
+        self.fd = fd
+
+    @classmethod
+    def allocate(cls, used=None):
+        used = used if used is not None else attached_device_names()
+        utils.mkdir(LOCK_DIR)
+        for amazon_path in SLOTS:
+            if amazon_path in used or xen_path(amazon_path) in used:
+                continue
+
+            if os.path.exists(xen_path(amazon_path)):
+                continue
+
+            lock = os.path.join(LOCK_DIR, os.path.basename(amazon_path))
+            fd = os.open(lock, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+
+            log.debug(f'allocated slot - {amazon_path}')
+            return cls(amazon_path, fd)
+
+        raise BlockDevError("no free attachment slots available")
+
+    def release(self):
+        if self.fd is not None:
+            log.debug(f'released slot - {self.amazon_path}')
+            os.close(self.fd)
+            self.fd = None
+
+    def __del__(self):
+        self.release()
+
+
+def _find(volume_id, amazon_path):
+    serial = nvme_serial(volume_id)
+    nvme = os.path.join(BYID_DIR, 'nvme-Amazon_Elastic_Block_Store_' + serial)
+    if os.path.exists(nvme):
+        return os.path.realpath(nvme)
+
+    if os.path.exists(xen_path(amazon_path)):
+        return xen_path(amazon_path)
+
+    return None
+
+
+def _udev_events(monitor, deadline):
+    """Yield property dicts of udev events until deadline"""
+    event = {}
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+
+        ready, _, _ = select.select([monitor.stdout], [], [], remaining)
+        if not ready:
+            return
+
+        # unbuffered, so select() never misses lines already read ahead
+        line = monitor.stdout.readline()
+        if not line:
+            return
+
+        line = line.decode(errors='replace').strip()
+        if not line:
+            if event:
+                yield event
+            event = {}
+        elif '=' in line:
+            key, value = line.split('=', 1)
+            event[key] = value
+
+
+def _poll(find, timeout, desc):
+    found = {}
+
+    def check():
+        found['path'] = find()
+        return found['path'] is not None
+
+    waiter.Waiter(delay=0.25, max_delay=2, timeout=timeout).wait(check, desc)
+    return found['path']
+
+
+def wait_udev(find, matches, timeout=300, desc='device'):
+    """Wait for udev to add a block device; returns find() result.
+
+    find() is called once the monitor is listening (so no event can be
+    missed) and again after every matching event; matches(event) selects
+    relevant events. Falls back to polling if udevadm isn't available.
+    """
+    try:
+        monitor = subprocess.Popen(['udevadm', 'monitor', '--udev',
+                                    '--subsystem-match=block', '--property'],
+                                   stdout=subprocess.PIPE, bufsize=0)
+    except FileNotFoundError:
+        return _poll(find, timeout, desc)
+
+    try:
+        started = time.monotonic()
+        deadline = started + timeout
+
+        # udevadm prints its header once it is subscribed to events
+        while True:
+            remaining = max(deadline - time.monotonic(), 0)
+            ready, _, _ = select.select([monitor.stdout], [], [], remaining)
+            if not ready:
+                raise waiter.WaiterTimeout(f'timed out after {timeout}s '
+                                           f'waiting for udev monitor')
+
+            line = monitor.stdout.readline()
+            if line.startswith(b'UDEV'):
+                break
+            if not line:
+                # udevadm exited (e.g., udev isn't running)
+                return _poll(find, max(deadline - time.monotonic(), 0),
+                             desc)
+
+        path = find()
+        if not path:
+            for event in _udev_events(monitor, deadline):
+                if event.get('ACTION') in ('add', 'change') \
+                        and matches(event):
+                    path = find()
+                    if path:
+                        break
+
+        if not path:
+            raise waiter.WaiterTimeout(f'timed out after {timeout}s '
+                                       f'waiting for {desc}')
+
+        log.debug(f'{desc} is {path} '
+                  f'(after {time.monotonic() - started:.1f}s)')
+        return path
+    finally:
+        monitor.kill()
+        monitor.wait()
+
+
+def resolve(volume_id, amazon_path, timeout=300):
+    """Return kernel device path of attached volume (waits for udev)"""
+    serial = nvme_serial(volume_id)
+    xen = xen_path(amazon_path)
+
+    def matches(event):
+        return (event.get('DEVNAME') == xen or
+                serial in event.get('ID_SERIAL', '') or
+                serial in event.get('ID_SERIAL_SHORT', ''))
+
+    return wait_udev(lambda: _find(volume_id, amazon_path), matches,
+                     timeout, f'{volume_id} ({amazon_path})')
+
+
+def wait_partition(path, timeout=60):
+    """Wait until udev has processed partition device path"""
+
+    def find():
+        return path if os.path.exists(path) else None
+
+    return wait_udev(find, lambda event: event.get('DEVNAME') == path,
+                     timeout, f'partition {path}')
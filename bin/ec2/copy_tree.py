@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+# Copyright (c) 2011-2026 TurnKey GNU/Linux - http://www.turnkeylinux.org
+#
+# This file is part of buildtasks.
+#
+# Buildtasks is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+
+"""
+Copy rootfs tree into dest (parallel replacement for rsync -aHSAX)
+
+Keeps ownership, permissions, timestamps, hardlinks, xattrs, ACLs, sparse
+holes and device nodes; the copy is verified against the source.
+
+Arguments:
+
+    src             Path to source tree (e.g., rootfs)
+    dest            Path to copy into (created if it doesn't exist)
+
+Options:
+
+    --workers=      Concurrent file copies (default: 4 per CPU, max 32)
+    --no-verify     Don't verify copy against src
+
+"""
+import os
+import sys
+import getopt
+
+import utils
+
+
+def fatal(e):
+    print("error: " + str(e), file=sys.stderr)
+    sys.exit(1)
+
+
+def usage(e=None):
+    if e:
+        print("error: " + str(e), file=sys.stderr)
+
+    print("Syntax: %s [ -options ] src dest" % (sys.argv[0]),
+          file=sys.stderr)
+    print(__doc__.strip(), file=sys.stderr)
+
+    sys.exit(1)
+
+
+def main():
+    try:
+        l_opts = ["help", "workers=", "no-verify"]
+        opts, args = getopt.gnu_getopt(sys.argv[1:], "h", l_opts)
+    except getopt.GetoptError as e:
+        usage(e)
+
+    workers = None
+    verify = True
+    for opt, val in opts:
+        if opt in ('-h', '--help'):
+            usage()
+
+        if opt == "--workers":
+            workers = int(val)
+
+        if opt == "--no-verify":
+            verify = False
+
+    if len(args) != 2:
+        usage("incorrect number of arguments")
+
+    src, dest = args
+    if not os.path.isdir(src):
+        fatal("src path does not exist: %s" % src)
+
+    try:
+        utils.copy_tree(src, dest, workers=workers, verify=verify)
+    except (OSError, utils.CopyError) as e:
+        fatal(e)
+
+
+if __name__ == "__main__":
+    main()
@@ -12,21 +12,46 @@
 """
 Create Amazon EC2 EBS-backed HVM AMI from rootfs
 
+Every resource created is tagged with a build fingerprint (turnkey_version,
+build inputs and buildtasks commit). If a previous run with the same
+fingerprint was interrupted, its snapshot, AMI and regional copies are
+reused and only the missing stages are run. Runs that finished aren't
+resumed (they're recorded as done in the journal), so a respin from the
+same inputs builds afresh.
+
 Arguments:
 
     rootfs          Path to rootfs
 
 Options:
     --name=         Use as name basis (default: turnkey_version + ctime)
-    --copy          Copy created AMI to all other regions
-    --publish       Set AMI launch permission to public
-    --marketplace   Share snapshot with AWS marketplace userid
+    --engine=       Bundle engine: volume or direct (default: volume)
+    --parent=       Parent snapshot id, or 'auto' to use the newest
+                    snapshot of the same appliance; uploads only changed
+                    blocks as a child snapshot (requires --engine=direct)
+    --copy          Copy created AMI to all other regions, each from the
+                    nearest available replica (see ec2_replicate.py);
+                    waits until all copies are available or failed
+    --copy-timeout= Deadline in seconds for --copy (default: 14400)
+    --copy-fanout=  Concurrent copies from each replica (default: 2)
+    --publish       Set AMI launch permission to public (and of each
+                    regional copy as soon as it is available)
+    --marketplace   Share snapshot with AWS marketplace userid (and each
+                    regional copy's snapshot as soon as it is available)
+    --no-resume     Ignore resources from interrupted runs
 
 Environment:
 
     AWS_ACCESS_KEY_ID       AWS Access Key ID (required)
     AWS_SECRET_ACCESS_KEY   AWS Secret Access Key (required)
     AWS_SESSION_TOKEN       AWS Session Token
+    LOGFILE_PATH            Stages are journaled to $LOGFILE_PATH.journal
+    EC2_METADATA_URL        Override instance metadata endpoint
+    BT_EC2_METADATA         JSON instance identity document to use instead
+                            of querying instance metadata (off-instance)
+    BT_BUILD_INPUTS         Inputs rootfs was built from (e.g., ISO sha256,
+                            patches, options) for the fingerprint; default
+                            is a digest of the rootfs contents
 
 """
 import os
@@ -36,11 +61,13 @@ import getopt
 
 import utils
 
-from ebs_bundle import bundle
+from ebs_bundle import ENGINES, Snapshot, bundle_async
+from ebs_resume import Journal, State, load_state
 from ebs_register import register
 from ebs_publish import share_public
 from ebs_share import share_marketplace
-from ec2_copy import copy_image
+from ec2_copy import Image, publisher
+from ec2_replicate import replicate
 
 log = utils.get_logger('ebs')
 
@@ -62,16 +89,23 @@ def usage(e=None):
 
 def main():
     try:
-        l_opts = ["help", "copy", "publish", "marketplace", "pvmregister", "name="]
+        l_opts = ["help", "copy", "copy-timeout=", "copy-fanout=",
+                  "publish", "marketplace", "pvmregister", "name=",
+                  "engine=", "parent=", "no-resume"]
         opts, args = getopt.gnu_getopt(sys.argv[1:], "h", l_opts)
     except getopt.GetoptError as e:
         usage(e)
 
     name = None
+    engine = 'volume'
+    parent = None
     copy = False
+    copy_timeout = 14400
+    copy_fanout = 2
     publish = False
     marketplace = False
     pvmregister = False
+    resume = True
     for opt, val in opts:
         if opt in ('-h', '--help'):
             usage()
@@ -79,9 +113,21 @@ def main():
         if opt == "--name":
             name = val
 
+        if opt == "--engine":
+            engine = val
+
+        if opt == "--parent":
+            parent = val
+
         if opt == "--copy":
             copy = True
 
+        if opt == "--copy-timeout":
+            copy_timeout = int(val)
+
+        if opt == "--copy-fanout":
+            copy_fanout = int(val)
+
         if opt == "--publish":
             publish = True
 
@@ -91,6 +137,15 @@ def main():
         if opt == "--pvmregister":
             pvmregister = True
 
+        if opt == "--no-resume":
+            resume = False
+
+    if engine not in ENGINES:
+        usage(f"unknown engine: {engine}")
+
+    if parent and engine != 'direct':
+        usage("--parent requires --engine=direct")
+
     if len(args) != 1:
         usage("incorrect number of arguments")
 
@@ -98,39 +153,122 @@ def main():
     if not os.path.exists(rootfs):
         fatal("rootfs path does not exist: %s" % rootfs)
 
-    if not name:
-        turnkey_version = utils.get_turnkey_version(rootfs)
-        name = '_'.join([turnkey_version, str(int(time.time()))])
-
     arch = utils.get_arch()
     region = utils.get_region()
-    snapshot_id, snapshot_name = bundle(rootfs, name)
+    regions = []
+    if copy:
+        regions = utils.get_all_regions()
+        regions.remove(region)
+
+    fingerprint = utils.get_fingerprint(rootfs,
+                                        os.environ.get('BT_BUILD_INPUTS'))
+    tags = {utils.FINGERPRINT_TAG: fingerprint}
+    journal = Journal(fingerprint)
+    state = load_state(fingerprint, region, journal, regions) \
+        if resume else State()
+
+    # a pending direct-engine snapshot may be a partial upload; only trust
+    # it if the previous run got as far as finishing the upload
+    if state.snapshot_state == 'pending' and engine != 'volume' \
+            and state.snapshot_id not in state.bundled:
+        state.snapshot_id = None
+
+    if state.snapshot_id:
+        log.info(f'resuming with snapshot - {state.snapshot_id} '
+                 f'{state.snapshot_name}')
+        snapshot = Snapshot(region)
+        snapshot.id = state.snapshot_id
+        snapshot.description = state.snapshot_name
+    else:
+        if not name:
+            turnkey_version = utils.get_turnkey_version(rootfs)
+            name = '_'.join([turnkey_version, str(int(time.time()))])
+
+        snapshot = bundle_async(rootfs, name, engine=engine, parent=parent,
+                                tags=tags)
+        journal.record('bundle', snapshot_id=snapshot.id)
+
+    snapshot.wait()
+    snapshot_id, snapshot_name = snapshot.id, snapshot.description
+    journal.record('snapshot', snapshot_id=snapshot_id)
     log.important(' '.join([snapshot_id, arch, region]))
 
-    if marketplace:
+    if marketplace and not state.marketplace:
         share_marketplace(snapshot_id, region)
+        journal.record('marketplace', snapshot_id=snapshot_id)
 
-    ami_id, ami_name = register(snapshot_id, region, arch)
+    if state.ami_id:
+        ami_id, ami_name = state.ami_id, state.ami_name
+        log.info(f'resuming with image - {ami_id} {ami_name}')
+    else:
+        ami_id, ami_name = register(snapshot_id, region, arch, tags=tags)
+        journal.record('register', ami_id=ami_id, ami_name=ami_name)
 
     log.info(ami_name)
     log.important(' '.join([ami_id, arch, region]))
 
     if pvmregister:
-        ami_id, ami_name = register(snapshot_id, region, arch, pvm=True)
+        if state.pvm_ami_id:
+            ami_id, ami_name = state.pvm_ami_id, ami_name + '-pvm'
+        else:
+            ami_id, ami_name = register(snapshot_id, region, arch, pvm=True,
+                                        tags=tags)
+            journal.record('register-pvm', ami_id=ami_id)
 
         log.info(ami_name + ' (PVM)')
         log.important(' '.join([ami_id, arch, region, '(PVM)']))
 
-    if publish:
+    if publish and not state.public:
         share_public(ami_id, region)
+        journal.record('public', ami_id=ami_id)
 
     if copy:
-        regions = utils.get_all_regions()
-        regions.remove(region)
-        images = copy_image(ami_id, ami_name, region, regions)
-
+        existing = [Image(state.copies[r], r) for r in regions
+                    if r in state.copies]
+        if existing:
+            log.info(f'resuming {len(existing)} existing copies, '
+                     f'copying to {len(regions) - len(existing)} region(s)')
+
+        publish_copy = None
+        if publish or marketplace:
+            publish_image = publisher(publish, marketplace)
+
+            def publish_copy(image):
+                if state.published.get(image.region) != image.id:
+                    publish_image(image)
+                    journal.record('publish-copy', region=image.region,
+                                   ami_id=image.id)
+
+        images = replicate(ami_id, ami_name, region, regions,
+                           timeout=copy_timeout, fanout=copy_fanout,
+                           tags=tags, existing=existing,
+                           publish=publish_copy)
+
+        failed = []
         for image in images:
-            log.important(' '.join([image.id, arch, image.region]))
+            if image.error:
+                failed.append(image.region)
+                log.error(f'copy to {image.region} {image.state}: '
+                          f'{image.error}')
+                continue
+
+            journal.record('copy', region=image.region, ami_id=image.id)
+            if image.source:
+                log.info(f'{image.region} copied from {image.source}')
+            if image.publish_error:
+                failed.append(image.region)
+                log.error(f'publish in {image.region} failed: '
+                          f'{image.publish_error}')
+            else:
+                published = ' (published)' if image.published else ''
+                log.important(' '.join([image.id, arch, image.region])
+                              + published)
+
+        if failed:
+            fatal("copy or publish failed for region(s): " +
+                  ' '.join(failed))
+
+    journal.record('done', snapshot_id=snapshot_id)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,320 @@
+#!/usr/bin/python3
+# Copyright (c) 2011-2026 TurnKey GNU/Linux - http://www.turnkeylinux.org
+#
+# This file is part of buildtasks.
+#
+# Buildtasks is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+
+"""
+Create Amazon EC2 EBS-backed HVM AMIs from many rootfs trees
+
+Runs each rootfs through a staged pipeline (bundle -> snapshot ->
+register -> copy) with bounded concurrency per stage, so one appliance's
+snapshot completion overlaps the next appliance's rootfs copy and GRUB install.
+
+Arguments:
+
+    rootfs...       Path(s) to rootfs (prepared as for ebs.py)
+
+Options:
+    --copy              Copy created AMIs to all other regions (along a
+                        fan-out tree, see ec2_replicate.py)
+    --copy-timeout=     Deadline in seconds per AMI for --copy
+                        (default: 14400)
+    --publish           Set AMI launch permission to public (including
+                        regional copies, as each becomes available)
+    --marketplace       Share snapshot with AWS marketplace userid
+                        (including those of regional copies)
+    --engine=           Bundle engine: volume or direct (default: volume)
+    --parent=           Parent snapshot for direct engine (only 'auto':
+                        the newest snapshot of each appliance)
+
+    --bundle-workers=   Concurrent bundles (local I/O bound, default: 2)
+    --snapshot-workers= Concurrent snapshot waits (default: 16)
+    --register-workers= Concurrent registrations/shares (default: 4)
+    --copy-workers=     Concurrent AMI copy fan-outs (default: 4)
+    --pool-size=        Build volumes to keep prepared ahead of the next
+                        bundle of this run; left over ones are deleted at
+                        exit (volume engine, default: --bundle-workers)
+
+Environment:
+
+    AWS_ACCESS_KEY_ID       AWS Access Key ID (required)
+    AWS_SECRET_ACCESS_KEY   AWS Secret Access Key (required)
+    AWS_SESSION_TOKEN       AWS Session Token
+
+"""
+import os
+import sys
+import time
+import getopt
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+import utils
+
+from ebs_bundle import ENGINES, bundle_async, get_pool
+from ebs_register import register
+from ebs_publish import share_public
+from ebs_share import share_marketplace
+from ec2_copy import publisher
+from ec2_replicate import replicate
+
+log = utils.get_logger('ebs-batch')
+
+
+def fatal(e):
+    print("error: " + str(e), file=sys.stderr)
+    sys.exit(1)
+
+
+def usage(e=None):
+    if e:
+        print("error: " + str(e), file=sys.stderr)
+
+    print("Syntax: %s [ -options ] rootfs..." % (sys.argv[0]),
+          file=sys.stderr)
+    print(__doc__.strip(), file=sys.stderr)
+
+    sys.exit(1)
+
+
+class Item:
+    def __init__(self, rootfs):
+        self.rootfs = rootfs
+        self.name = None
+        self.snapshot = None
+        self.ami_id = None
+        self.ami_name = None
+        self.images = []
+        self.error = None
+        self.failed_stage = None
+        self.timings = {}
+        self.started = None
+        self.finished = None
+
+
+class Pipeline:
+    """Pass items through stages; each stage has its own worker pool.
+
+    stages is a list of (name, func, workers); func(item) is called in
+    order for each item, which moves to the next stage as soon as it's
+    done, so different items occupy different stages at the same time.
+    """
+
+    def __init__(self, stages):
+        self.stages = stages
+        self.executors = [ThreadPoolExecutor(max_workers=workers,
+                                             thread_name_prefix=name)
+                          for name, func, workers in stages]
+        self.remaining = 0
+        self.done = threading.Condition()
+
+    def _finish(self, item):
+        item.finished = time.time()
+        with self.done:
+            self.remaining -= 1
+            self.done.notify_all()
+
+    def _run(self, i, item):
+        name, func, workers = self.stages[i]
+        started = time.time()
+        try:
+            func(item)
+        except Exception as e:
+            item.error = e
+            item.failed_stage = name
+            log.error(f'{item.rootfs}: {name} failed: {e}')
+            return self._finish(item)
+        finally:
+            item.timings[name] = time.time() - started
+
+        if i + 1 < len(self.stages):
+            self.executors[i + 1].submit(self._run, i + 1, item)
+        else:
+            self._finish(item)
+
+    def run(self, items):
+        self.remaining = len(items)
+        for item in items:
+            item.started = time.time()
+            self.executors[0].submit(self._run, 0, item)
+
+        with self.done:
+            self.done.wait_for(lambda: self.remaining == 0)
+
+        for executor in self.executors:
+            executor.shutdown()
+
+        return items
+
+
+class Batch:
+    def __init__(self, copy=False, copy_timeout=14400, publish=False,
+                 marketplace=False, engine='volume', parent=None,
+                 pool_size=None):
+        self.copy = copy
+        self.copy_timeout = copy_timeout
+        self.publish = publish
+        self.marketplace = marketplace
+        self.engine = engine
+        self.parent = parent
+        self.pool_size = pool_size
+        self.arch = utils.get_arch()
+        self.region = utils.get_region()
+
+    def bundle(self, item):
+        turnkey_version = utils.get_turnkey_version(item.rootfs)
+        item.name = '_'.join([turnkey_version, str(int(time.time()))])
+        item.snapshot = bundle_async(item.rootfs, item.name,
+                                     engine=self.engine, parent=self.parent)
+
+    def snapshot(self, item):
+        item.snapshot.wait()
+        log.important(' '.join([item.snapshot.id, self.arch, self.region]))
+
+    def register(self, item):
+        if self.marketplace:
+            share_marketplace(item.snapshot.id, self.region)
+
+        item.ami_id, item.ami_name = register(item.snapshot.id, self.region,
+                                              self.arch)
+        log.important(' '.join([item.ami_id, self.arch, self.region]))
+
+        if self.publish:
+            share_public(item.ami_id, self.region)
+
+    def copy_regions(self, item):
+        regions = utils.get_all_regions()
+        regions.remove(self.region)
+        publish = None
+        if self.publish or self.marketplace:
+            publish = publisher(self.publish, self.marketplace)
+
+        item.images = replicate(item.ami_id, item.ami_name, self.region,
+                                regions, timeout=self.copy_timeout,
+                                publish=publish)
+
+        failed = [image.region for image in item.images
+                  if image.error or image.publish_error]
+        for image in item.images:
+            if not image.error:
+                log.important(' '.join([image.id, self.arch, image.region]))
+
+        if failed:
+            raise RuntimeError("copy or publish failed for region(s): " +
+                               ' '.join(failed))
+
+    def stages(self, workers):
+        stages = [('bundle', self.bundle, workers['bundle']),
+                  ('snapshot', self.snapshot, workers['snapshot']),
+                  ('register', self.register, workers['register'])]
+        if self.copy:
+            stages.append(('copy', self.copy_regions, workers['copy']))
+
+        return stages
+
+    def run(self, rootfs_paths, workers):
+        started = time.time()
+        pool = get_pool()
+        if self.engine == 'volume':
+            pool.target = self.pool_size if self.pool_size is not None \
+                else workers['bundle']
+
+        try:
+            items = Pipeline(self.stages(workers)).run(
+                [Item(rootfs) for rootfs in rootfs_paths])
+        finally:
+            pool.reclaim()
+        report(items, time.time() - started)
+
+        return items
+
+
+def report(items, elapsed):
+    for item in items:
+        total = item.finished - item.started
+        stages = ' '.join(f'{name}={seconds:.0f}s'
+                          for name, seconds in item.timings.items())
+        if item.error:
+            log.info(f'FAILED {item.rootfs} at {item.failed_stage} '
+                     f'({total:.0f}s: {stages}): {item.error}')
+        else:
+            log.info(f'OK {item.rootfs} {item.ami_id} '
+                     f'({total:.0f}s: {stages})')
+
+    ok = len([item for item in items if not item.error])
+    serial = sum(item.finished - item.started for item in items)
+    log.important(f'{ok}/{len(items)} succeeded in {elapsed:.0f}s '
+                  f'({len(items) * 3600 / max(elapsed, 1):.1f} items/hour, '
+                  f'{serial / max(elapsed, 1):.1f}x overlap)')
+
+
+def main():
+    try:
+        l_opts = ["help", "copy", "copy-timeout=", "publish", "marketplace",
+                  "engine=", "parent=", "bundle-workers=",
+                  "snapshot-workers=", "register-workers=", "copy-workers=",
+                  "pool-size="]
+        opts, args = getopt.gnu_getopt(sys.argv[1:], "h", l_opts)
+    except getopt.GetoptError as e:
+        usage(e)
+
+    kwargs = {}
+    workers = {'bundle': 2, 'snapshot': 16, 'register': 4, 'copy': 4}
+    for opt, val in opts:
+        if opt in ('-h', '--help'):
+            usage()
+
+        if opt == "--copy":
+            kwargs['copy'] = True
+
+        if opt == "--copy-timeout":
+            kwargs['copy_timeout'] = int(val)
+
+        if opt == "--publish":
+            kwargs['publish'] = True
+
+        if opt == "--marketplace":
+            kwargs['marketplace'] = True
+
+        if opt == "--engine":
+            kwargs['engine'] = val
+
+        if opt == "--parent":
+            # one snapshot id can't be the parent of different appliances
+            if val != 'auto':
+                usage(f"--parent must be 'auto', not {val}")
+            kwargs['parent'] = val
+
+        if opt == "--pool-size":
+            kwargs['pool_size'] = int(val)
+
+        if opt.endswith("-workers"):
+            workers[opt[2:-len("-workers")]] = int(val)
+
+    engine = kwargs.get('engine', 'volume')
+    if engine not in ENGINES:
+        usage(f"unknown engine: {engine}")
+
+    if 'parent' in kwargs and engine != 'direct':
+        usage("--parent requires --engine=direct")
+
+    if not args:
+        usage("incorrect number of arguments")
+
+    for rootfs in args:
+        if not os.path.exists(rootfs):
+            fatal("rootfs path does not exist: %s" % rootfs)
+
+    items = Batch(**kwargs).run(args, workers)
+    if any(item.error for item in items):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,311 @@
+#!/usr/bin/python3
+# Copyright (c) 2011-2026 TurnKey GNU/Linux - http://www.turnkeylinux.org
+#
+# This file is part of buildtasks.
+#
+# Buildtasks is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+
+"""
+Benchmark the ebs.py flow against the local EC2/EBS stand-in
+
+Each run starts a fresh ec2_standin.py server and runs ebs.py against it
+(no AWS account or credentials needed). Reports end-to-end and per-stage
+timings (from the resume journal), API calls and waiter polls (from the
+metrics records) and the spread of the regional CopyImage calls. With
+--baseline, exits non-zero if a metric regressed beyond --tolerance.
+
+Arguments:
+
+    rootfs          Path to rootfs (prepared as for ebs.py)
+
+Options:
+    --engine=       Bundle engine: volume or direct (default: direct)
+    --copy          Copy AMI to all other regions
+    --publish       Set AMI launch permission to public
+    --marketplace   Share snapshot with AWS marketplace userid
+    --latency=      NAME=SECONDS stand-in latency (repeatable, see
+                    ec2_standin.py)
+    --throttle=     Fraction of stand-in requests throttled
+    --request-rate= Stand-in requests per second per region before
+                    throttling
+    --fail-copy=    Fraction of image copies that fail
+    --loop          Back volumes with loop devices (volume engine,
+                    requires root)
+    --layout=       Disk image layout (direct engine, see
+                    image_builder.py; none needs neither sfdisk nor GRUB,
+                    default: gpt)
+    --runs=         Number of runs (default: 1); metrics are the median
+    --baseline=     Compare with baseline (JSON) and exit 1 on regression
+    --save-baseline= Save results as baseline (JSON)
+    --tolerance=    Allowed regression as a fraction (default: 0.2)
+
+"""
+import os
+import sys
+import json
+import time
+import getopt
+import shutil
+import tempfile
+import statistics
+import subprocess
+
+import ec2_standin
+
+IDENTITY = {'instanceId': 'i-0standin0000000', 'region': 'us-east-1',
+            'availabilityZone': 'us-east-1a'}
+
+# timings within this many seconds of the baseline are never regressions
+SLACK = 0.5
+
+
+def fatal(e):
+    print("error: " + str(e), file=sys.stderr)
+    sys.exit(1)
+
+
+def usage(e=None):
+    if e:
+        print("error: " + str(e), file=sys.stderr)
+
+    print("Syntax: %s [ -options ] rootfs" % (sys.argv[0]), file=sys.stderr)
+    print(__doc__.strip(), file=sys.stderr)
+
+    sys.exit(1)
+
+
+def _read_json_lines(path):
+    # LOGFILE_PATH also holds plain log lines; only the records are JSON
+    entries = []
+    if os.path.exists(path):
+        with open(path) as fob:
+            for line in fob:
+                if line.startswith('{'):
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        pass
+    return entries
+
+
+def stage_times(journal, started):
+    """Return {stage: seconds} from journal entries (repeated stages add)"""
+    stages = {}
+    previous = started
+    for entry in sorted(journal, key=lambda e: e['time']):
+        stage = entry['stage']
+        stages[stage] = stages.get(stage, 0) + entry['time'] - previous
+        previous = entry['time']
+
+    return {stage: round(seconds, 3) for stage, seconds in stages.items()}
+
+
+def run(rootfs, args, standin_kwargs, layout=None):
+    """Run ebs.py once against a fresh stand-in; returns result dict"""
+    tmpdir = tempfile.mkdtemp(prefix='ebs-bench.')
+    server = None
+    try:
+        byid_dir = os.path.join(tmpdir, 'by-id')
+        server = ec2_standin.serve(0, os.path.join(tmpdir, 'store'),
+                                   byid_dir=byid_dir, **standin_kwargs)
+        url = f'http://127.0.0.1:{server.server_port}'
+
+        identity = os.path.join(tmpdir, 'identity.json')
+        with open(identity, 'w') as fob:
+            json.dump(IDENTITY, fob)
+
+        logfile = os.path.join(tmpdir, 'ebs.log')
+        env = dict(os.environ, EC2_ENDPOINT_URL=url, EBS_ENDPOINT_URL=url,
+                   AWS_ACCESS_KEY_ID='standin',
+                   AWS_SECRET_ACCESS_KEY='standin',
+                   LOGFILE_PATH=logfile, BT_EC2_METADATA=identity,
+                   BT_EBS_INDEX_DIR=os.path.join(tmpdir, 'index'),
+                   BT_EBS_BYID_DIR=byid_dir)
+        env.pop('AWS_SESSION_TOKEN', None)
+        if layout:
+            env['BT_EBS_IMAGE_LAYOUT'] = layout
+
+        ebs = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'ebs.py')
+        started = time.time()
+        proc = subprocess.run([sys.executable, ebs, '--no-resume'] + args
+                              + [rootfs], env=env, capture_output=True,
+                              text=True)
+        total = time.time() - started
+
+        if proc.returncode != 0 and not standin_kwargs.get('fail_copy'):
+            sys.stderr.write(proc.stderr)
+            raise RuntimeError(f'ebs.py exited {proc.returncode}')
+
+        records = _read_json_lines(logfile)
+        calls = [r for r in records if r.get('type') == 'aws-call']
+        stats = server.ec2.stats()
+
+        return {
+            'status': proc.returncode,
+            'total': round(total, 3),
+            'stages': stage_times(_read_json_lines(logfile + '.journal'),
+                                  started),
+            'calls': len([c for c in calls if not c['in_wait']]),
+            'polls': len([c for c in calls if c['in_wait']]),
+            'retries': sum(c['retries'] for c in calls),
+            'throttles': sum(c['throttles'] for c in calls),
+            'waits': len([r for r in records if r.get('type') == 'wait']),
+            'copy_spread': stats['copy_spread'],
+            'operations': stats['calls'],
+        }
+    finally:
+        if server:
+            server.shutdown()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def median(results):
+    """Return result with the (low) median of each metric across runs"""
+    def merge(values):
+        values = [v for v in values if v is not None]
+        if values and isinstance(values[0], dict):
+            keys = dict.fromkeys(k for v in values for k in v)
+            return {k: merge([v.get(k) for v in values]) for k in keys}
+        return statistics.median_low(values) if values else None
+
+    return merge(results)
+
+
+def _flatten(result, prefix=''):
+    for key, value in sorted(result.items()):
+        if key in ('status', 'operations'):
+            continue
+        if isinstance(value, dict):
+            yield from _flatten(value, prefix + key + '.')
+        else:
+            yield prefix + key, value
+
+
+def compare(result, baseline, tolerance):
+    """Return list of (metric, baseline, value) that regressed"""
+    current = dict(_flatten(result))
+    regressions = []
+    for metric, base in _flatten(baseline):
+        value = current.get(metric)
+        if value is None or base is None:
+            continue
+
+        # counts are exact; timings get some slack for scheduling noise
+        slack = 0 if isinstance(base, int) else SLACK
+        if value > base * (1 + tolerance) + slack:
+            regressions.append((metric, base, value))
+
+    return regressions
+
+
+def report(result):
+    print(f"total: {result['total']:.2f}s")
+    for stage, seconds in result['stages'].items():
+        print(f"  {stage}: {seconds:.2f}s")
+    print(f"api calls: {result['calls']}, polls: {result['polls']}, "
+          f"waits: {result['waits']}, retries: {result['retries']}, "
+          f"throttled: {result['throttles']}")
+    print(f"copy spread: {result['copy_spread']:.2f}s")
+    for operation, count in sorted(result['operations'].items()):
+        print(f"  {operation}: {count}")
+
+
+def main():
+    try:
+        l_opts = ["help", "engine=", "copy", "publish", "marketplace",
+                  "latency=", "throttle=", "request-rate=", "fail-copy=",
+                  "loop", "layout=", "runs=", "baseline=", "save-baseline=",
+                  "tolerance="]
+        opts, args = getopt.gnu_getopt(sys.argv[1:], "h", l_opts)
+    except getopt.GetoptError as e:
+        usage(e)
+
+    ebs_args = ['--engine=direct']
+    standin_kwargs = {'latency': {}}
+    layout = None
+    runs = 1
+    baseline = None
+    save_baseline = None
+    tolerance = 0.2
+    for opt, val in opts:
+        if opt in ('-h', '--help'):
+            usage()
+
+        if opt == "--engine":
+            ebs_args[0] = '--engine=' + val
+
+        if opt in ("--copy", "--publish", "--marketplace"):
+            ebs_args.append(opt)
+
+        if opt == "--latency":
+            name, seconds = val.split('=', 1)
+            if name not in ec2_standin.LATENCY:
+                usage(f"unknown latency: {name}")
+            standin_kwargs['latency'][name] = float(seconds)
+
+        if opt == "--throttle":
+            standin_kwargs['throttle'] = float(val)
+
+        if opt == "--request-rate":
+            standin_kwargs['request_rate'] = float(val)
+
+        if opt == "--fail-copy":
+            standin_kwargs['fail_copy'] = float(val)
+
+        if opt == "--loop":
+            standin_kwargs['loop'] = True
+
+        if opt == "--layout":
+            layout = val
+
+        if opt == "--runs":
+            runs = int(val)
+
+        if opt == "--baseline":
+            baseline = val
+
+        if opt == "--save-baseline":
+            save_baseline = val
+
+        if opt == "--tolerance":
+            tolerance = float(val)
+
+    if len(args) != 1:
+        usage("incorrect number of arguments")
+
+    rootfs = args[0]
+    if not os.path.exists(rootfs):
+        fatal(f"rootfs path does not exist: {rootfs}")
+
+    results = []
+    for i in range(runs):
+        print(f"run {i + 1}/{runs}", file=sys.stderr)
+        try:
+            results.append(run(rootfs, ebs_args, standin_kwargs, layout))
+        except RuntimeError as e:
+            fatal(e)
+
+    result = median(results)
+    report(result)
+
+    if save_baseline:
+        with open(save_baseline, 'w') as fob:
+            json.dump(result, fob, indent=2)
+
+    if baseline:
+        with open(baseline) as fob:
+            regressions = compare(result, json.load(fob), tolerance)
+
+        for metric, base, value in regressions:
+            print(f"regression: {metric} {base} -> {value}")
+
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,311 @@
+#!/usr/bin/python3
+# Copyright (c) 2011-2026 TurnKey GNU/Linux - http://www.turnkeylinux.org
+#
+# This file is part of buildtasks.
+#
+# Buildtasks is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+
+"""
+Local stand-in for the EBS direct APIs (offline testing)
+
+Implements StartSnapshot, PutSnapshotBlock, CompleteSnapshot,
+ListSnapshotBlocks and GetSnapshotBlock closely enough for boto3's 'ebs'
+client. Point the EC2 tools at it with:
+
+    export EBS_ENDPOINT_URL=http://127.0.0.1:PORT
+
+Options:
+
+    --port=         Port to listen on (default: 8765)
+    --dir=          Directory to store blocks in (default: temporary)
+
+"""
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import base64
+import getopt
+import hashlib
+import tempfile
+import threading
+
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+BLOCK_SIZE = 524288
+
+
+def usage(e=None):
+    if e:
+        print("error: " + str(e), file=sys.stderr)
+
+    print("Syntax: %s [ -options ]" % (sys.argv[0]), file=sys.stderr)
+    print(__doc__.strip(), file=sys.stderr)
+
+    sys.exit(1)
+
+
+class BlockStoreError(Exception):
+    def __init__(self, msg, status=400, error_type='ValidationException'):
+        Exception.__init__(self, msg)
+        self.status = status
+        self.error_type = error_type
+
+
+class BlockStore:
+    def __init__(self, path):
+        self.path = path
+        self.snapshots = {}
+        self.lock = threading.Lock()
+
+    def _block_path(self, snapshot_id, index):
+        return os.path.join(self.path, snapshot_id, str(index))
+
+    def get(self, snapshot_id):
+        try:
+            return self.snapshots[snapshot_id]
+        except KeyError:
+            raise BlockStoreError(f'snapshot not found: {snapshot_id}', 404,
+                                  'ResourceNotFoundException')
+
+    def start(self, params):
+        parent_id = params.get('ParentSnapshotId')
+        if parent_id:
+            self.get(parent_id)
+
+        snapshot_id = 'snap-' + uuid.uuid4().hex[:17]
+        snapshot = {
+            'SnapshotId': snapshot_id,
+            'OwnerId': '000000000000',
+            'Status': 'pending',
+            'StartTime': time.time(),
+            'VolumeSize': params['VolumeSize'],
+            'BlockSize': BLOCK_SIZE,
+            'Tags': params.get('Tags', []),
+            'ParentSnapshotId': parent_id,
+            'Description': params.get('Description', ''),
+        }
+        with self.lock:
+            self.snapshots[snapshot_id] = dict(snapshot, blocks={})
+        os.makedirs(os.path.join(self.path, snapshot_id))
+
+        return snapshot
+
+    def put(self, snapshot_id, index, data, digest):
+        snapshot = self.get(snapshot_id)
+        if snapshot['Status'] != 'pending':
+            raise BlockStoreError(f'snapshot not pending: {snapshot_id}')
+
+        if len(data) != BLOCK_SIZE:
+            raise BlockStoreError(f'invalid block length: {len(data)}')
+
+        if index >= snapshot['VolumeSize'] * 1024 ** 3 // BLOCK_SIZE:
+            raise BlockStoreError(f'block index out of range: {index}')
+
+        actual = base64.b64encode(hashlib.sha256(data).digest()).decode()
+        if actual != digest:
+            raise BlockStoreError(f'checksum mismatch for block {index}')
+
+        with open(self._block_path(snapshot_id, index), 'wb') as fob:
+            fob.write(data)
+
+        with self.lock:
+            snapshot['blocks'][index] = digest
+
+        return digest
+
+    def complete(self, snapshot_id, changed, digest):
+        snapshot = self.get(snapshot_id)
+        blocks = snapshot['blocks']
+        if changed != len(blocks):
+            raise BlockStoreError(f'expected {changed} blocks, '
+                                  f'received {len(blocks)}')
+
+        if digest:
+            aggregate = hashlib.sha256()
+            for index in sorted(blocks):
+                aggregate.update(base64.b64decode(blocks[index]))
+            actual = base64.b64encode(aggregate.digest()).decode()
+            if actual != digest:
+                snapshot['Status'] = 'error'
+                raise BlockStoreError('aggregated checksum mismatch')
+
+        snapshot['Status'] = 'completed'
+        return snapshot['Status']
+
+    def resolve(self, snapshot_id):
+        """Return {index: (owning snapshot_id, checksum)} incl. parents"""
+        chain = []
+        while snapshot_id:
+            snapshot = self.get(snapshot_id)
+            chain.append(snapshot)
+            snapshot_id = snapshot['ParentSnapshotId']
+
+        resolved = {}
+        for snapshot in reversed(chain):
+            for index, digest in snapshot['blocks'].items():
+                resolved[index] = (snapshot['SnapshotId'], digest)
+
+        return resolved
+
+    def read(self, snapshot_id, index):
+        owner, digest = self.resolve(snapshot_id)[index]
+        with open(self._block_path(owner, index), 'rb') as fob:
+            return fob.read(), digest
+
+
+class Handler(BaseHTTPRequestHandler):
+    store = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body=None, headers={}, data=None):
+        if body is not None:
+            data = json.dumps(body).encode()
+            headers = dict(headers, **{'Content-Type': 'application/json'})
+
+        data = data if data is not None else b''
+        self.send_response(status)
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(length)
+
+    def _dispatch(self, routes):
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        try:
+            for pattern, handler in routes:
+                match = re.fullmatch(pattern, url.path)
+                if match:
+                    return handler(query, *match.groups())
+
+            raise BlockStoreError(f'no route: {url.path}', 404)
+
+        except BlockStoreError as e:
+            self._send(e.status, {'Message': str(e)},
+                       {'x-amzn-ErrorType': e.error_type})
+
+    def do_POST(self):
+        self._dispatch([
+            (r'/snapshots', self.start_snapshot),
+            (r'/snapshots/completion/([^/]+)', self.complete_snapshot),
+        ])
+
+    def do_PUT(self):
+        self._dispatch([
+            (r'/snapshots/([^/]+)/blocks/(\d+)', self.put_snapshot_block),
+        ])
+
+    def do_GET(self):
+        self._dispatch([
+            (r'/snapshots/([^/]+)/blocks', self.list_snapshot_blocks),
+            (r'/snapshots/([^/]+)/blocks/(\d+)', self.get_snapshot_block),
+        ])
+
+    def start_snapshot(self, query):
+        snapshot = self.store.start(json.loads(self._body() or b'{}'))
+        self._send(201, snapshot)
+
+    def put_snapshot_block(self, query, snapshot_id, index):
+        digest = self.store.put(snapshot_id, int(index), self._body(),
+                                self.headers.get('x-amz-Checksum'))
+        self._send(201, headers={'x-amz-Checksum': digest,
+                                 'x-amz-Checksum-Algorithm': 'SHA256'})
+
+    def complete_snapshot(self, query, snapshot_id):
+        self._body()
+        changed = int(self.headers.get('x-amz-ChangedBlocksCount', 0))
+        status = self.store.complete(snapshot_id, changed,
+                                     self.headers.get('x-amz-Checksum'))
+        self._send(202, {'Status': status})
+
+    def list_snapshot_blocks(self, query, snapshot_id):
+        snapshot = self.store.get(snapshot_id)
+        start = int(query.get('startingBlockIndex',
+                              query.get('pageToken', 0)))
+        limit = int(query.get('maxResults', 10000))
+
+        indexes = sorted(i for i in self.store.resolve(snapshot_id)
+                         if i >= start)
+        body = {
+            'Blocks': [{'BlockIndex': i, 'BlockToken': f'{snapshot_id}:{i}'}
+                       for i in indexes[:limit]],
+            'VolumeSize': snapshot['VolumeSize'],
+            'BlockSize': BLOCK_SIZE,
+        }
+        if len(indexes) > limit:
+            body['NextToken'] = str(indexes[limit])
+
+        self._send(200, body)
+
+    def get_snapshot_block(self, query, snapshot_id, index):
+        try:
+            data, digest = self.store.read(snapshot_id, int(index))
+        except KeyError:
+            raise BlockStoreError(f'block not found: {index}', 404,
+                                  'ResourceNotFoundException')
+
+        self._send(200, data=data, headers={
+            'x-amz-Data-Length': str(len(data)),
+            'x-amz-Checksum': digest,
+            'x-amz-Checksum-Algorithm': 'SHA256'})
+
+
+def serve(port=8765, path=None, address='127.0.0.1'):
+    """Return started server (daemon thread); server.shutdown() to stop"""
+    path = path if path else tempfile.mkdtemp(prefix='ebs-blockstore.')
+    handler = type('Handler', (Handler,), {'store': BlockStore(path)})
+    server = ThreadingHTTPServer((address, port), handler)
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    return server
+
+
+def main():
+    try:
+        opts, args = getopt.gnu_getopt(sys.argv[1:], "h",
+                                       ["help", "port=", "dir="])
+    except getopt.GetoptError as e:
+        usage(e)
+
+    port = 8765
+    path = None
+    for opt, val in opts:
+        if opt in ('-h', '--help'):
+            usage()
+
+        if opt == "--port":
+            port = int(val)
+
+        if opt == "--dir":
+            path = val
+            os.makedirs(path, exist_ok=True)
+
+    if args:
+        usage("incorrect number of arguments")
+
+    server = serve(port, path)
+    print(f"EBS_ENDPOINT_URL=http://127.0.0.1:{server.server_port}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -21,20 +21,54 @@ Options:
     --name=         Snapshot name (default: turnkey_version + ctime)
     --size=         Size of snapshot (default: 10)
     --filesystem=   File system of snapshot (default: ext4)
+    --engine=       Bundle engine (default: volume)
+
+                    volume: create, attach and populate an EBS volume,
+                            then snapshot it
+                    direct: build the disk image locally without
+                            mounting it (see image_builder.py) and stream
+                            its non-zero blocks into a snapshot via the
+                            EBS direct APIs
+    --parent=       Parent snapshot id, or 'auto' for the newest snapshot of
+                    the same appliance; only changed blocks are uploaded
+                    (requires --engine=direct)
+
+Environment:
+
+    BT_EBS_VOLUME_TYPE          Build volume type (default: gp3)
+    BT_EBS_VOLUME_IOPS          Build volume IOPS (default: by rootfs size)
+    BT_EBS_VOLUME_THROUGHPUT    Build volume throughput in MiB/s (gp3,
+                                default: by rootfs size)
+    BT_EBS_IMAGE_LAYOUT         Disk image layout (direct engine, see
+                                image_builder.py, default: gpt)
 
 """
 import os
 import sys
 import time
+import atexit
 import getopt
+import threading
 import subprocess
 
+from concurrent.futures import ThreadPoolExecutor
+
 import utils
+import waiter
+import blockdev
+import ebs_direct
+import image_builder
 
-from boto.exception import EC2ResponseError
+from botocore.exceptions import ClientError
 
 log = utils.get_logger('ebs-bundle')
 
+# gp3 build volume tiers by rootfs size: (up to bytes, IOPS, MiB/s);
+# copying the rootfs is throughput bound (gp3 baseline: 3000, 125)
+VOLUME_TIERS = ((2 * ebs_direct.GiB, 3000, 125),
+                (6 * ebs_direct.GiB, 3000, 250),
+                (None, 4000, 500))
+
 
 def fatal(e):
     print("error: " + str(e), file=sys.stderr)
@@ -59,79 +93,124 @@ class Snapshot:
     def __init__(self, region=None):
         self.region = region if region else utils.get_region()
         self.conn = utils.connect(self.region)
-        self.snap = None
+        self.id = None
+        self.description = None
+
+    def get_state(self):
+        try:
+            snapshots = self.conn.describe_snapshots(SnapshotIds=[self.id])
+        except ClientError as e:
+            if utils.error_code(e) != 'InvalidSnapshot.NotFound':
+                raise
+            return 'pending'
 
-    def _wait(self, status):
-        while self.snap.status != status:
-            time.sleep(1)
-            self.snap.update()
+        return snapshots['Snapshots'][0]['State']
 
-        time.sleep(3)
+    def wait(self, status="completed", timeout=7200):
+        # snapshots take minutes; the tracker polls all of them together
+        waiter.get_tracker().wait('snapshot', self.region, self.id, status,
+                                  timeout=timeout)
 
-    def create(self, volume_id, name):
+    def wait_async(self, status="completed", timeout=7200):
+        return waiter.get_tracker().submit('snapshot', self.region, self.id,
+                                           status, timeout=timeout)
+
+    def create(self, volume_id, name, wait=True, tags=None):
         log.debug('creating snapshot - %s %s', volume_id, name)
 
-        self.snap = self.conn.create_snapshot(volume_id, name)
-        self._wait("completed")
+        kwargs = {}
+        if tags:
+            kwargs['TagSpecifications'] = [{
+                'ResourceType': 'snapshot',
+                'Tags': utils.tag_list(tags)}]
 
-        log.debug('created snapshot - %s', self.snap.id)
+        response = self.conn.create_snapshot(VolumeId=volume_id,
+                                             Description=name, **kwargs)
+        self.id = response['SnapshotId']
+        self.description = response['Description']
+        if wait:
+            self.wait()
+            log.debug('created snapshot - %s', self.id)
 
 
 class Volume:
     def __init__(self, region=None):
         self.region = region if region else utils.get_region()
         self.conn = utils.connect(self.region)
-        self.vol = None
+        self.id = None
         self.device = None
+        self.spec = {}
 
-    def _wait(self, status):
-        while self.vol.status != status:
-            time.sleep(1)
-            self.vol.update()
+    def get_state(self):
+        try:
+            volumes = self.conn.describe_volumes(VolumeIds=[self.id])
+        except ClientError as e:
+            if utils.error_code(e) != 'InvalidVolume.NotFound':
+                raise
+            return 'creating'
 
-        time.sleep(3)
+        return volumes['Volumes'][0]['State']
 
-    def create(self, size, zone=None):
-        zone = zone if zone else utils.get_zone()
-        log.debug('creating volume - %d %s', size, zone)
+    def _wait(self, status, timeout=600):
+        waiter.wait_for_status(self.get_state, status, self.id,
+                               timeout=timeout, delay=1, max_delay=10)
 
-        self.vol = self.conn.create_volume(size, zone)
+    def create(self, size, zone=None, spec=None):
+        zone = zone if zone else utils.get_zone()
+        spec = spec if spec else {}
+        log.debug('creating volume - %d %s %s', size, zone, spec)
+
+        tags = {utils.BUILD_VOLUME_TAG: utils.get_instanceid()}
+        response = self.conn.create_volume(
+            Size=size, AvailabilityZone=zone,
+            TagSpecifications=[{'ResourceType': 'volume',
+                                'Tags': utils.tag_list(tags)}], **spec)
+        self.id = response['VolumeId']
+        self.spec = spec
         self._wait("available")
-        log.debug('created volume - %s', self.vol.id)
+        log.debug('created volume - %s', self.id)
+
+    def modify(self, spec):
+        """Change type, IOPS and throughput (applied while in use)"""
+        log.debug('modifying volume - %s %s', self.id, spec)
+        self.conn.modify_volume(VolumeId=self.id, **spec)
+        self.spec = spec
 
     def delete(self, max_attempts=10):
-        if self.vol:
+        if self.id:
             attempt = 0
             while True:
                 attempt += 1
-                log.debug(f'deleting volume {self.vol.id} (attempt {attempt})')
+                log.debug(f'deleting volume {self.id} (attempt {attempt})')
                 self._wait("available")
                 try:
-                    self.vol.delete()
+                    self.conn.delete_volume(VolumeId=self.id)
                     break
-                except EC2ResponseError as e:
-                    error_code = e.errors[0][0]
-                    log.debug(f'delete failed {self.vol.id} ({error_code})')
+                except ClientError as e:
+                    error_code = utils.error_code(e)
+                    log.debug(f'delete failed {self.id} ({error_code})')
                     if error_code not in ("Client.VolumeInUse", "VolumeInUse"):
                         raise
 
                     if max_attempts == attempt:
-                        log.debug(f'all delete attempts failed: {self.vol.id}')
+                        log.debug(f'all delete attempts failed: {self.id}')
                         raise
 
-            self.vol = None
+                    time.sleep(min(2 ** attempt, 30))
+
+            self.id = None
 
     def attach(self, instance_id, device):
         self.device = device
-        if self.vol:
-            log.debug(f'attaching volume - {self.device.real_path} ('
-                      f'{self.device.amazon_path})')
+        if self.id:
+            log.debug(f'attaching volume - {self.id} '
+                      f'({self.device.amazon_path})')
 
-            self.vol.attach(instance_id, self.device.amazon_path)
-            while not self.device.exists():
-                time.sleep(1)
+            self.conn.attach_volume(VolumeId=self.id, InstanceId=instance_id,
+                                    Device=self.device.amazon_path)
+            self.device.resolve(self.id)
 
-            log.debug('attached volume')
+            log.debug(f'attached volume - {self.device.real_path}')
 
     def detach(self):
         if self.device:
@@ -139,11 +218,12 @@ class Volume:
                 log.debug('umounting device before detaching volume')
                 self.device.umount()
 
-            if self.vol:
+            if self.id:
                 log.debug('detaching volume')
 
+                self.conn.detach_volume(VolumeId=self.id)
                 self._wait("available")
-                self.vol.detach()
+                self.device.release()
                 self.device = None
 
     def __del__(self):
@@ -152,28 +232,29 @@ class Volume:
 
 
 class Device:
-    def __init__(self):
-        self.real_path = self._get_freedevice()
-        if not self.real_path:
-            raise EbsBundleError("no free devices available...")
-
-        self.amazon_path = '/dev/sd' + self.real_path[-1]
+    def __init__(self, real_path=None):
+        self.real_path = real_path
         self.root_path = None
+        self.slot = None
+        if not real_path:
+            self.slot = blockdev.Slot.allocate()
 
-    @staticmethod
-    def _get_freedevice():
-        for s in 'fghijk':
-            real_device = '/dev/xvd' + s
-            if not os.path.exists(real_device):
-                return real_device
+    @property
+    def amazon_path(self):
+        return self.slot.amazon_path if self.slot else None
 
-        return None
+    def resolve(self, volume_id):
+        self.real_path = blockdev.resolve(volume_id, self.amazon_path)
+
+    def release(self):
+        if self.slot:
+            self.slot.release()
 
     def is_mounted(self):
-        return utils.is_mounted(self.real_path)
+        return bool(self.real_path) and utils.is_mounted(self.real_path)
 
     def exists(self):
-        return os.path.exists(self.real_path)
+        return bool(self.real_path) and os.path.exists(self.real_path)
 
     def mount(self, mount_path):
         log.debug(f'mounting - {self.real_path} {mount_path}')
@@ -194,67 +275,277 @@ class Device:
                         " set 1 bios_grub on mkpart primary ext4 3 -1 name 2"
                         " rootfs quit"], check=True)
         subprocess.run(['partprobe', self.real_path], check=True)
-        time.sleep(5)
         self.root_path = self.real_path
-        self.real_path = self.real_path + '2'
+        self.real_path = blockdev.wait_partition(
+            utils.partition_path(self.real_path, 2))
 
     def __del__(self):
         if self.is_mounted():
             self.umount()
+        self.release()
 
 
-def bundle(rootfs, snapshot_name, size=10, filesystem='ext4'):
-    log.info(f'target snapshot - {snapshot_name} ')
+def volume_spec(rootfs_size, size):
+    """Return create_volume() type, IOPS and throughput kwargs for a
+    size GiB build volume holding rootfs_size bytes"""
+    volume_type = os.environ.get('BT_EBS_VOLUME_TYPE', 'gp3')
+    iops = os.environ.get('BT_EBS_VOLUME_IOPS')
+    throughput = os.environ.get('BT_EBS_VOLUME_THROUGHPUT')
 
-    log.info('creating volume, attaching, formatting and mounting')
-    volume = Volume()
-    volume.create(size)
+    spec = {'VolumeType': volume_type}
+    if volume_type == 'gp3':
+        for limit, tier_iops, tier_throughput in VOLUME_TIERS:
+            if limit is None or rootfs_size <= limit:
+                break
 
+        # gp3 allows up to 500 IOPS per GiB and 0.25 MiB/s per IOPS
+        iops = int(iops) if iops else min(tier_iops, 500 * size)
+        throughput = int(throughput) if throughput else \
+            min(tier_throughput, iops // 4)
+        spec.update(Iops=iops, Throughput=throughput)
+    elif iops:
+        spec['Iops'] = int(iops)
+
+    return spec
+
+
+def _attach_and_format(volume, filesystem):
+    """Attach volume to this instance, partition and format it"""
     device = Device()
     volume.attach(utils.get_instanceid(), device)
 
-    log.info('creating partitions')
+    log.info(f'creating partitions - {volume.id}')
     device.mkpart()
     device.mkfs(filesystem)
+
+
+class VolumePool:
+    """Build volumes created, attached, partitioned and formatted ahead.
+
+    get() takes a ready volume of the same size and filesystem if there is
+    one (else prepares one) and tops the pool back up to target volumes in
+    the background, while the caller copies its rootfs. Pool volumes are
+    created with the caller's spec (volume_spec() for that size), so only
+    a checkout for a rootfs in another tier pays for modify_volume.
+    Volumes left in the pool are detached and deleted by reclaim() (at
+    exit for the shared pool).
+
+    The pool lives in one process: only ebs_batch.py, which bundles many
+    appliances in a process, sets a target. ebs.py bundles one appliance
+    per process, so the shared pool has a target of 0 there and get()
+    just prepares the volume it needs.
+    """
+
+    def __init__(self, target=0, region=None, max_workers=2):
+        self.target = target
+        self.region = region
+        self.ready = {}
+        self.preparing = {}
+        self.closed = False
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix='volume-pool')
+
+    def _prepare(self, size, filesystem, spec):
+        volume = Volume(self.region)
+        try:
+            volume.create(size, spec=spec)
+            _attach_and_format(volume, filesystem)
+        except BaseException:
+            try:
+                volume.detach()
+                volume.delete(max_attempts=1)
+            except Exception as e:
+                log.warning(f'cleaning up volume {volume.id} failed: {e}')
+            raise
+
+        return volume
+
+    def _fill(self, key, spec):
+        volume = None
+        try:
+            if not self.closed:
+                volume = self._prepare(*key, spec)
+        except Exception as e:
+            log.warning(f'preparing pool volume failed: {e}')
+
+        with self.lock:
+            self.preparing[key] -= 1
+            if volume and not self.closed:
+                self.ready.setdefault(key, []).append(volume)
+                log.debug(f'pool volume ready - {volume.id}')
+                return
+
+        if volume:
+            volume.detach()
+            volume.delete()
+
+    def _replenish(self, key, spec, checkout):
+        # called with self.lock held; checkout is a volume the caller is
+        # preparing itself, which counts towards target
+        if self.closed:
+            return
+
+        missing = self.target - len(self.ready.get(key, [])) \
+            - self.preparing.get(key, 0) - checkout
+        for _ in range(missing):
+            self.preparing[key] = self.preparing.get(key, 0) + 1
+            self.executor.submit(self._fill, key, spec)
+
+    def get(self, size, filesystem, spec=None):
+        """Return attached, partitioned and formatted Volume"""
+        spec = spec if spec else {}
+        key = (size, filesystem)
+        with self.lock:
+            volumes = self.ready.get(key)
+            volume = volumes.pop(0) if volumes else None
+            self._replenish(key, spec, 0 if volume else 1)
+
+        if volume and volume.spec != spec:
+            try:
+                volume.modify(spec)
+            except ClientError as e:
+                log.warning(f'modifying warm volume {volume.id} failed '
+                            f'({e}), creating one')
+                with self.lock:
+                    self.ready.setdefault(key, []).append(volume)
+                volume = None
+
+        if volume:
+            log.info(f'using warm volume - {volume.id}')
+            return volume
+
+        return self._prepare(size, filesystem, spec)
+
+    def reclaim(self):
+        """Detach and delete all volumes in the pool"""
+        with self.lock:
+            self.closed = True
+
+        # volumes still being prepared are deleted by _fill
+        self.executor.shutdown(wait=True)
+
+        with self.lock:
+            volumes = [v for vs in self.ready.values() for v in vs]
+            self.ready = {}
+
+        for volume in volumes:
+            log.debug(f'reclaiming pool volume - {volume.id}')
+            try:
+                volume.detach()
+                volume.delete()
+            except ClientError as e:
+                log.warning(f'reclaiming {volume.id} failed: {e}')
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Return the shared VolumePool (reclaimed at exit, target 0 unless
+    set by ebs_batch.py)"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = VolumePool()
+            atexit.register(_pool.reclaim)
+        return _pool
+
+
+def _install(rootfs, device):
     mount_path = rootfs + '.mount'
     device.mount(mount_path)
 
-    log.info('syncing rootfs to partition')
-    utils.rsync(rootfs, mount_path)
+    log.info('copying rootfs to partition')
+    utils.copy_tree(rootfs, mount_path)
 
-    log.info('installing GRUB on volume')
-    submounts = ['/sys', '/proc', '/dev']
-    for s in submounts:
-        subprocess.run(['mount', '--bind', '--make-rslave', s, mount_path + s],
-                       check=True)
-    subprocess.run(['chroot', mount_path, 'grub-install', device.root_path],
-                   check=True)
-    subprocess.run(['chroot', mount_path, 'update-grub'], check=True)
-    subprocess.run(['chroot', mount_path, 'update-initramfs', '-u'],
-                   check=True)
-
-    submounts.reverse()
-    for s in submounts:
-        subprocess.run(['umount', '-l', mount_path + s], check=True)
+    log.info('installing GRUB')
+    utils.install_grub(mount_path, device.root_path)
 
     device.umount()
-    volume.detach()
     os.removedirs(mount_path)
 
+
+def bundle_volume(rootfs, snapshot_name, size, filesystem, parent, tags):
+    spec = volume_spec(image_builder.rootfs_size(rootfs), size)
+    volume = get_pool().get(size, filesystem, spec)
+    _install(rootfs, volume.device)
+    volume.detach()
+
     log.info('creating snapshot from volume')
     snapshot = Snapshot()
-    snapshot.create(volume.vol.id, snapshot_name)
+    snapshot.create(volume.id, snapshot_name, wait=False, tags=tags)
 
-    volume._wait("available")
+    # the snapshot is point-in-time; the volume isn't needed while it
+    # completes
     volume.delete()
 
-    log.info(f"complete - {snapshot.snap.id} {snapshot.snap.description}")
-    return snapshot.snap.id, snapshot.snap.description
+    return snapshot
+
+
+def bundle_direct(rootfs, snapshot_name, size, filesystem, parent, tags):
+    if filesystem != 'ext4':
+        raise EbsBundleError("direct engine only supports ext4")
+
+    image_path = rootfs + '.img'
+    try:
+        layout = os.environ.get('BT_EBS_IMAGE_LAYOUT', 'gpt')
+        image_builder.build_image(rootfs, image_path, size * ebs_direct.GiB,
+                                  layout=layout)
+
+        log.info('streaming disk image to snapshot')
+        snapshot = Snapshot()
+        snapshot.id = ebs_direct.upload_image(image_path, snapshot_name,
+                                              size, snapshot.region,
+                                              parent=parent, tags=tags)
+        snapshot.description = snapshot_name
+    finally:
+        if os.path.exists(image_path):
+            os.remove(image_path)
+
+    return snapshot
+
+
+ENGINES = {
+    'volume': bundle_volume,
+    'direct': bundle_direct,
+}
+
+
+def bundle_async(rootfs, snapshot_name, size=10, filesystem='ext4',
+                 engine='volume', parent=None, tags=None):
+    """Bundle rootfs; returns Snapshot which may still be pending"""
+    log.info(f'target snapshot - {snapshot_name} ')
+
+    if engine not in ENGINES:
+        raise EbsBundleError(f"unknown bundle engine: {engine}")
+    if parent and engine != 'direct':
+        raise EbsBundleError("parent snapshots require the direct engine")
+
+    appliance = utils.get_appliance(rootfs)
+    tags = dict(tags if tags else {}, **{utils.APPLIANCE_TAG: appliance})
+    if parent == 'auto':
+        parent = ebs_direct.find_parent(appliance)
+
+    return ENGINES[engine](rootfs, snapshot_name, size, filesystem, parent,
+                           tags)
+
+
+def bundle(rootfs, snapshot_name, size=10, filesystem='ext4',
+           engine='volume', parent=None, tags=None):
+    snapshot = bundle_async(rootfs, snapshot_name, size, filesystem, engine,
+                            parent, tags)
+    snapshot.wait()
+
+    log.info(f"complete - {snapshot.id} {snapshot.description}")
+    return snapshot.id, snapshot.description
 
 
 def main():
     try:
-        l_opts = ["help", "name=", "size=", "filesystem="]
+        l_opts = ["help", "name=", "size=", "filesystem=", "engine=",
+                  "parent="]
         opts, args = getopt.gnu_getopt(sys.argv[1:], "h", l_opts)
     except getopt.GetoptError as e:
         usage(e)
@@ -262,6 +553,8 @@ def main():
     name = None
     size = 10
     filesystem = 'ext4'
+    engine = 'volume'
+    parent = None
     for opt, val in opts:
         if opt in ('-h', '--help'):
             usage()
@@ -275,6 +568,18 @@ def main():
         if opt == "--filesystem":
             filesystem = val
 
+        if opt == "--engine":
+            engine = val
+
+        if opt == "--parent":
+            parent = val
+
+    if engine not in ENGINES:
+        usage(f"unknown engine: {engine}")
+
+    if parent and engine != 'direct':
+        usage("--parent requires --engine=direct")
+
     if len(args) != 1:
         usage("incorrect number of arguments")
 
@@ -286,7 +591,8 @@ def main():
         turnkey_version = utils.get_turnkey_version(rootfs)
         name = '_'.join([turnkey_version, str(int(time.time()))])
 
-    kwargs = {'size': size, 'filesystem': filesystem}
+    kwargs = {'size': size, 'filesystem': filesystem, 'engine': engine,
+              'parent': parent}
     snapshot_id, snapshot_name = bundle(rootfs, name, **kwargs)
 
     print(snapshot_id, snapshot_name)
@@ -0,0 +1,380 @@
+#!/usr/bin/python3
+# Copyright (c) 2011-2026 TurnKey GNU/Linux - http://www.turnkeylinux.org
+#
+# This file is part of buildtasks.
+#
+# Buildtasks is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+
+"""
+Stream raw disk image into a new snapshot (EBS direct APIs)
+
+Only non-zero blocks are uploaded; each block is sent with its SHA256
+checksum and the snapshot is completed with the aggregated checksum.
+
+If a parent snapshot is given, a child snapshot is created and only the
+blocks that differ from the parent are uploaded. The parent's block
+checksums are read from a local index (created whenever a snapshot is
+uploaded) or, if missing, fetched from the parent snapshot once.
+
+Arguments:
+
+    image           Path to raw disk image
+
+Options:
+
+    --name=         Snapshot description (default: image basename)
+    --region=       Region (default: current region)
+    --workers=      Concurrent block uploads (default: 16)
+    --parent=       Parent snapshot id to upload changed blocks against
+
+Environment:
+
+    EBS_ENDPOINT_URL    Override EBS direct API endpoint (e.g., stand-in
+                        server started with ebs_blockstore.py)
+    BT_EBS_INDEX_DIR    Block checksum index cache
+                        (default: /var/cache/buildtasks/ebs-index)
+
+"""
+import os
+import sys
+import errno
+import json
+import time
+import base64
+import getopt
+import hashlib
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+import utils
+
+log = utils.get_logger('ebs-direct')
+
+BLOCK_SIZE = 524288
+ZERO_BLOCK = bytes(BLOCK_SIZE)
+GiB = 1024 ** 3
+
+INDEX_DIR = os.environ.get('BT_EBS_INDEX_DIR',
+                           '/var/cache/buildtasks/ebs-index')
+
+
+def usage(e=None):
+    if e:
+        print("error: " + str(e), file=sys.stderr)
+
+    print("Syntax: %s [ -options ] image" % (sys.argv[0]), file=sys.stderr)
+    print(__doc__.strip(), file=sys.stderr)
+
+    sys.exit(1)
+
+
+class EbsDirectError(Exception):
+    pass
+
+
+def connect(region=None):
+    return utils.connect(region, service='ebs',
+                         endpoint_url=os.environ.get('EBS_ENDPOINT_URL'))
+
+
+def checksum(data):
+    return base64.b64encode(hashlib.sha256(data).digest()).decode()
+
+
+def aggregate_checksum(checksums):
+    """Linear aggregation: checksum of block checksums in index order"""
+    digest = hashlib.sha256()
+    for index in sorted(checksums):
+        digest.update(base64.b64decode(checksums[index]))
+
+    return base64.b64encode(digest.digest()).decode()
+
+
+def iter_blocks(path):
+    """Yield (index, data) for each block containing non-zero bytes"""
+    with open(path, 'rb') as fob:
+        fd = fob.fileno()
+        size = os.fstat(fd).st_size
+        offset = 0
+        seek_data = True
+        while offset < size:
+            # jump over holes in sparse images without reading them
+            data_offset = offset
+            try:
+                if seek_data:
+                    data_offset = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    # no more data, the rest is a hole
+                    break
+                if e.errno not in (errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+                # SEEK_DATA not supported; read every block instead
+                seek_data = False
+
+            offset = data_offset - (data_offset % BLOCK_SIZE)
+            fob.seek(offset)
+            data = fob.read(BLOCK_SIZE)
+            if len(data) < BLOCK_SIZE:
+                data = data.ljust(BLOCK_SIZE, b'\0')
+
+            if data != ZERO_BLOCK:
+                yield offset // BLOCK_SIZE, data
+
+            offset += BLOCK_SIZE
+
+
+def _index_path(snapshot_id):
+    return os.path.join(INDEX_DIR, snapshot_id + '.json')
+
+
+def load_index(snapshot_id):
+    """Return {block_index: checksum} of non-zero blocks, or None"""
+    try:
+        with open(_index_path(snapshot_id)) as fob:
+            index = json.load(fob)
+    except FileNotFoundError:
+        return None
+
+    return {int(i): digest for i, digest in index['blocks'].items()}
+
+
+def save_index(snapshot_id, blocks, parent=None):
+    utils.mkdir(INDEX_DIR)
+    path = _index_path(snapshot_id)
+    with open(path + '.tmp', 'w') as fob:
+        json.dump({'snapshot_id': snapshot_id, 'parent': parent,
+                   'block_size': BLOCK_SIZE, 'blocks': blocks}, fob)
+    os.rename(path + '.tmp', path)
+
+
+def fetch_index(snapshot_id, region=None, workers=16):
+    """Build block checksum index by reading snapshot (slow, done once)"""
+    log.info(f'building block index from snapshot - {snapshot_id}')
+    conn = connect(region)
+
+    tokens = {}
+    kwargs = {'SnapshotId': snapshot_id, 'MaxResults': 10000}
+    while True:
+        response = conn.list_snapshot_blocks(**kwargs)
+        for block in response['Blocks']:
+            tokens[block['BlockIndex']] = block['BlockToken']
+
+        if not response.get('NextToken'):
+            break
+        kwargs['NextToken'] = response['NextToken']
+
+    def get(index):
+        response = conn.get_snapshot_block(SnapshotId=snapshot_id,
+                                           BlockIndex=index,
+                                           BlockToken=tokens[index])
+        data = response['BlockData'].read()
+        return index, data, response['Checksum']
+
+    blocks = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for index, data, digest in executor.map(get, tokens):
+            if data != ZERO_BLOCK:
+                blocks[index] = digest
+
+    save_index(snapshot_id, blocks)
+    return blocks
+
+
+def get_index(snapshot_id, region=None, workers=16):
+    index = load_index(snapshot_id)
+    if index is None:
+        index = fetch_index(snapshot_id, region, workers)
+
+    return index
+
+
+def find_parent(appliance, region=None):
+    """Return newest completed snapshot tagged with appliance, or None"""
+    conn = utils.connect(region)
+    paginator = conn.get_paginator('describe_snapshots')
+    filters = [{'Name': 'tag:' + utils.APPLIANCE_TAG, 'Values': [appliance]},
+               {'Name': 'status', 'Values': ['completed']}]
+
+    newest = None
+    for page in paginator.paginate(OwnerIds=['self'], Filters=filters):
+        for snapshot in page['Snapshots']:
+            if newest is None or snapshot['StartTime'] > newest['StartTime']:
+                newest = snapshot
+
+    if newest is None:
+        log.info(f'no parent snapshot found for {appliance}')
+        return None
+
+    log.info(f"found parent snapshot for {appliance} - "
+             f"{newest['SnapshotId']} {newest['Description']}")
+    return newest['SnapshotId']
+
+
+def diff_blocks(path, parent_index, new_index):
+    """Yield (index, data, checksum) of blocks that differ from parent.
+
+    new_index is filled with the checksums of all non-zero blocks. Blocks
+    the parent has but which are now zero are yielded as zero blocks.
+    """
+    for index, data in iter_blocks(path):
+        digest = checksum(data)
+        new_index[index] = digest
+        if parent_index.get(index) != digest:
+            yield index, data, digest
+
+    for index in sorted(set(parent_index) - set(new_index)):
+        yield index, ZERO_BLOCK, checksum(ZERO_BLOCK)
+
+
+class Uploader:
+    def __init__(self, region=None, workers=16):
+        self.conn = connect(region)
+        self.workers = workers
+        self.checksums = {}
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def start(self, name, size, **kwargs):
+        response = self.conn.start_snapshot(VolumeSize=size,
+                                            Description=name,
+                                            Timeout=60, **kwargs)
+        if response['BlockSize'] != BLOCK_SIZE:
+            raise EbsDirectError(f"unexpected block size "
+                                 f"{response['BlockSize']}")
+
+        return response['SnapshotId']
+
+    def put(self, snapshot_id, index, data, digest=None):
+        digest = digest if digest else checksum(data)
+        self.conn.put_snapshot_block(SnapshotId=snapshot_id,
+                                     BlockIndex=index,
+                                     BlockData=data,
+                                     DataLength=len(data),
+                                     Checksum=digest,
+                                     ChecksumAlgorithm='SHA256')
+        with self.lock:
+            self.checksums[index] = digest
+            self.bytes += len(data)
+
+    def put_all(self, snapshot_id, blocks):
+        # bound blocks in flight so memory use doesn't grow with image size
+        inflight = threading.BoundedSemaphore(self.workers * 2)
+
+        def put(index, data, digest):
+            try:
+                self.put(snapshot_id, index, data, digest)
+            finally:
+                inflight.release()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = []
+            for index, data, digest in blocks:
+                inflight.acquire()
+                futures.append(executor.submit(put, index, data, digest))
+
+            for future in futures:
+                future.result()
+
+    def complete(self, snapshot_id):
+        response = self.conn.complete_snapshot(
+            SnapshotId=snapshot_id,
+            ChangedBlocksCount=len(self.checksums),
+            Checksum=aggregate_checksum(self.checksums),
+            ChecksumAlgorithm='SHA256',
+            ChecksumAggregationMethod='LINEAR')
+
+        return response['Status']
+
+
+def upload_image(image, name, size=None, region=None, workers=16,
+                 parent=None, tags=None):
+    """Upload image to a new snapshot, returns its id.
+
+    With parent, the new snapshot is a child of parent and only the
+    blocks that differ from it are uploaded; otherwise every non-zero
+    block is uploaded.
+    """
+    image_size = os.path.getsize(image)
+    size = size if size else -(-image_size // GiB)
+    if size * GiB < image_size:
+        raise EbsDirectError(f"image larger than {size}GiB: {image}")
+
+    kwargs = {}
+    parent_index = {}
+    if parent:
+        parent_index = get_index(parent, region, workers)
+        kwargs['ParentSnapshotId'] = parent
+        log.debug(f'parent snapshot - {parent} '
+                  f'({len(parent_index)} blocks)')
+
+    if tags:
+        kwargs['Tags'] = utils.tag_list(tags)
+
+    uploader = Uploader(region, workers)
+    snapshot_id = uploader.start(name, size, **kwargs)
+    log.debug(f'started snapshot - {snapshot_id} {name}')
+
+    started = time.monotonic()
+    new_index = {}
+    uploader.put_all(snapshot_id, diff_blocks(image, parent_index, new_index))
+    elapsed = max(time.monotonic() - started, 0.001)
+
+    status = uploader.complete(snapshot_id)
+    save_index(snapshot_id, new_index, parent)
+    log.info(f'uploaded {len(uploader.checksums)} of {len(new_index)} '
+             f'blocks ({uploader.bytes // 2**20}MiB, '
+             f'{uploader.bytes / 2**20 / elapsed:.1f}MiB/s) to '
+             f'{snapshot_id} - {status}')
+
+    return snapshot_id
+
+
+def main():
+    try:
+        l_opts = ["help", "name=", "region=", "workers=", "parent="]
+        opts, args = getopt.gnu_getopt(sys.argv[1:], "h", l_opts)
+    except getopt.GetoptError as e:
+        usage(e)
+
+    name = None
+    region = None
+    workers = 16
+    parent = None
+    for opt, val in opts:
+        if opt in ('-h', '--help'):
+            usage()
+
+        if opt == "--name":
+            name = val
+
+        if opt == "--region":
+            region = val
+
+        if opt == "--workers":
+            workers = int(val)
+
+        if opt == "--parent":
+            parent = val
+
+    if len(args) != 1:
+        usage("incorrect number of arguments")
+
+    image = args[0]
+    if not os.path.isfile(image):
+        usage(f"image does not exist: {image}")
+
+    name = name if name else os.path.basename(image)
+    region = region if region else utils.get_region()
+
+    snapshot_id = upload_image(image, name, region=region, workers=workers,
+                               parent=parent)
+    print(snapshot_id, name)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,390 @@
+#!/usr/bin/python3
+# Copyright (c) 2011-2026 TurnKey GNU/Linux - http://www.turnkeylinux.org
+#
+# This file is part of buildtasks.
+#
+# Buildtasks is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+
+"""
+Local index (SQLite) of buildtasks AMIs and snapshots in all regions
+
+'refresh' updates the index: the first refresh of a region (or --full)
+lists every buildtasks AMI (turnkey-*) and appliance-tagged snapshot;
+later refreshes only list those created since the previous refresh (by
+creation date) and recheck the ones that were still pending. Deleted
+resources are only noticed by a full refresh.
+
+Arguments:
+
+    command         refresh     update the index
+                    images      list AMIs (newest first)
+                    snapshots   list snapshots (newest first)
+                    newest      newest available AMI per appliance/region
+                    regions     regions with an available matching AMI
+
+Options:
+    --db=           Index path (default: $BT_EBS_INVENTORY or
+                    /var/cache/buildtasks/ebs-inventory.db)
+    --region=       Limit to region (repeatable, default: all regions)
+    --full          Full refresh (also drops deleted resources)
+    --appliance=    Match appliance (e.g., core-bookworm-amd64)
+    --version=      Match version (e.g., 18.0)
+    --arch=         Match architecture (e.g., amd64)
+    --fingerprint=  Match build fingerprint
+    --state=        Match state (default for newest/regions: available)
+
+"""
+import os
+import sys
+import getopt
+import sqlite3
+
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+import utils
+
+log = utils.get_logger('ebs-inventory')
+
+DB_PATH = os.environ.get('BT_EBS_INVENTORY',
+                         '/var/cache/buildtasks/ebs-inventory.db')
+
+# incremental refreshes list by creation day; beyond this, do a full one
+MAX_INCREMENTAL_DAYS = 31
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    region TEXT, image_id TEXT, name TEXT, state TEXT, created TEXT,
+    public INTEGER, appliance TEXT, version TEXT, arch TEXT, pvm INTEGER,
+    fingerprint TEXT, snapshots TEXT,
+    PRIMARY KEY (region, image_id));
+CREATE TABLE IF NOT EXISTS snapshots (
+    region TEXT, snapshot_id TEXT, state TEXT, created TEXT,
+    description TEXT, appliance TEXT, fingerprint TEXT, size INTEGER,
+    PRIMARY KEY (region, snapshot_id));
+CREATE TABLE IF NOT EXISTS regions (
+    region TEXT PRIMARY KEY, refreshed TEXT, full_refreshed TEXT);
+"""
+
+PENDING_STATES = ('pending',)
+
+
+def usage(e=None):
+    if e:
+        print("error: " + str(e), file=sys.stderr)
+
+    print("Syntax: %s [ -options ] command" % (sys.argv[0]), file=sys.stderr)
+    print(__doc__.strip(), file=sys.stderr)
+
+    sys.exit(1)
+
+
+def _iso(value):
+    if isinstance(value, datetime):
+        return value.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    return value[:19] + 'Z'
+
+
+def _tags(resource):
+    return {t['Key']: t['Value'] for t in resource.get('Tags', [])}
+
+
+def image_row(region, image):
+    fields = utils.parse_image_name(image['Name']) or {}
+    snapshots = [m['Ebs']['SnapshotId']
+                 for m in image.get('BlockDeviceMappings', [])
+                 if m.get('Ebs', {}).get('SnapshotId')]
+    return {'region': region, 'image_id': image['ImageId'],
+            'name': image['Name'], 'state': image['State'],
+            'created': _iso(image['CreationDate']),
+            'public': int(bool(image.get('Public'))),
+            'appliance': fields.get('appliance'),
+            'version': fields.get('version'), 'arch': fields.get('arch'),
+            'pvm': int(bool(fields.get('pvm'))),
+            'fingerprint': _tags(image).get(utils.FINGERPRINT_TAG),
+            'snapshots': ' '.join(snapshots)}
+
+
+def snapshot_row(region, snapshot):
+    tags = _tags(snapshot)
+    return {'region': region, 'snapshot_id': snapshot['SnapshotId'],
+            'state': snapshot['State'],
+            'created': _iso(snapshot['StartTime']),
+            'description': snapshot.get('Description'),
+            'appliance': tags.get(utils.APPLIANCE_TAG),
+            'fingerprint': tags.get(utils.FINGERPRINT_TAG),
+            'size': snapshot.get('VolumeSize')}
+
+
+def _days(since, now):
+    """Return describe filter patterns matching since's day until now"""
+    day = datetime.strptime(since[:10], '%Y-%m-%d').date()
+    patterns = []
+    while day <= now.date():
+        patterns.append(day.isoformat() + '*')
+        day += timedelta(days=1)
+    return patterns
+
+
+def fetch(region, since=None, pending=()):
+    """List region's buildtasks images and snapshots (created on or after
+    since's day, if given); pending is [(kind, id)] to recheck.
+
+    Returns (images, snapshots, gone) rows; gone are pending ids that no
+    longer exist.
+    """
+    conn = utils.connect(region)
+    image_filters = [{'Name': 'name', 'Values': ['turnkey-*']}]
+    snapshot_filters = [{'Name': 'tag-key', 'Values': [utils.APPLIANCE_TAG]}]
+    if since:
+        days = _days(since, datetime.now(timezone.utc))
+        image_filters.append({'Name': 'creation-date', 'Values': days})
+        snapshot_filters.append({'Name': 'start-time', 'Values': days})
+
+    images = conn.describe_images(Owners=['self'],
+                                  Filters=image_filters)['Images']
+    snapshots = []
+    paginator = conn.get_paginator('describe_snapshots')
+    for page in paginator.paginate(OwnerIds=['self'],
+                                   Filters=snapshot_filters):
+        snapshots += page['Snapshots']
+
+    image_ids = [i for kind, i in pending if kind == 'image']
+    snapshot_ids = [i for kind, i in pending if kind == 'snapshot']
+    if image_ids:
+        images += conn.describe_images(Filters=[
+            {'Name': 'image-id', 'Values': image_ids}])['Images']
+    if snapshot_ids:
+        for page in paginator.paginate(OwnerIds=['self'], Filters=[
+                {'Name': 'snapshot-id', 'Values': snapshot_ids}]):
+            snapshots += page['Snapshots']
+
+    # pending resources may also have been listed by creation date
+    images = {i['ImageId']: i for i in images}
+    snapshots = {s['SnapshotId']: s for s in snapshots}
+    gone = [(kind, i) for kind, i in pending
+            if i not in images and i not in snapshots]
+
+    return ([image_row(region, i) for i in images.values()],
+            [snapshot_row(region, s) for s in snapshots.values()], gone)
+
+
+class Inventory:
+    def __init__(self, path=None):
+        self.path = path if path else DB_PATH
+        utils.mkdir(os.path.dirname(os.path.abspath(self.path)))
+        self.db = sqlite3.connect(self.path)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def _upsert(self, table, rows):
+        for row in rows:
+            columns = ', '.join(row)
+            values = ', '.join('?' * len(row))
+            self.db.execute(f'INSERT OR REPLACE INTO {table} ({columns}) '
+                            f'VALUES ({values})', list(row.values()))
+
+    def _region_state(self, region):
+        row = self.db.execute('SELECT * FROM regions WHERE region = ?',
+                              (region,)).fetchone()
+        return dict(row) if row else {}
+
+    def _pending(self, region):
+        states = ', '.join('?' * len(PENDING_STATES))
+        pending = [('image', r[0]) for r in self.db.execute(
+            f'SELECT image_id FROM images WHERE region = ? AND '
+            f'state IN ({states})', (region,) + PENDING_STATES)]
+        pending += [('snapshot', r[0]) for r in self.db.execute(
+            f'SELECT snapshot_id FROM snapshots WHERE region = ? AND '
+            f'state IN ({states})', (region,) + PENDING_STATES)]
+        return pending
+
+    def refresh(self, regions=None, full=False, max_workers=8):
+        """Refresh regions concurrently; returns {region: (images,
+        snapshots)} counts of rows updated, or {region: exception}"""
+        regions = regions if regions else utils.get_all_regions()
+        now = _iso(datetime.now(timezone.utc))
+        oldest = _iso(datetime.now(timezone.utc) -
+                      timedelta(days=MAX_INCREMENTAL_DAYS))
+
+        plans = {}
+        for region in regions:
+            refreshed = self._region_state(region).get('refreshed')
+            since = None if full or not refreshed or refreshed < oldest \
+                else refreshed
+            plans[region] = (since, self._pending(region) if since else [])
+
+        results = {}
+        workers = max(min(max_workers, len(regions)), 1)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {region: executor.submit(fetch, region, *plans[region])
+                       for region in regions}
+
+            for region, future in futures.items():
+                since = plans[region][0]
+                try:
+                    images, snapshots, gone = future.result()
+                except Exception as e:
+                    log.error(f'refreshing {region} failed: {e}')
+                    results[region] = e
+                    continue
+
+                with self.db:
+                    if since is None:
+                        self.db.execute('DELETE FROM images WHERE '
+                                        'region = ?', (region,))
+                        self.db.execute('DELETE FROM snapshots WHERE '
+                                        'region = ?', (region,))
+                    for kind, resource_id in gone:
+                        self.db.execute(f'DELETE FROM {kind}s WHERE region '
+                                        f'= ? AND {kind}_id = ?',
+                                        (region, resource_id))
+                    self._upsert('images', images)
+                    self._upsert('snapshots', snapshots)
+
+                    state = {'region': region, 'refreshed': now}
+                    state['full_refreshed'] = now if since is None else \
+                        self._region_state(region).get('full_refreshed')
+                    self._upsert('regions', [state])
+
+                log.debug(f'{region}: {"full" if since is None else "inc"} '
+                          f'refresh, {len(images)} images, '
+                          f'{len(snapshots)} snapshots')
+                results[region] = (len(images), len(snapshots))
+
+        return results
+
+    def _select(self, table, where, order='created DESC'):
+        clauses = []
+        params = []
+        for column, value in where.items():
+            if value is None:
+                continue
+            if isinstance(value, (list, tuple, set)):
+                clauses.append(f'{column} IN ({", ".join("?" * len(value))})')
+                params += list(value)
+            else:
+                clauses.append(f'{column} = ?')
+                params.append(value)
+
+        sql = f'SELECT * FROM {table}'
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        sql += f' ORDER BY {order}'
+        return [dict(row) for row in self.db.execute(sql, params)]
+
+    def images(self, region=None, appliance=None, version=None, arch=None,
+               fingerprint=None, state=None, pvm=False):
+        """Return image rows matching (None matches anything), newest
+        first; region may be a list"""
+        return self._select('images', {
+            'region': region, 'appliance': appliance, 'version': version,
+            'arch': arch, 'fingerprint': fingerprint, 'state': state,
+            'pvm': None if pvm is None else int(pvm)})
+
+    def snapshots(self, region=None, appliance=None, fingerprint=None,
+                  state=None):
+        return self._select('snapshots', {
+            'region': region, 'appliance': appliance,
+            'fingerprint': fingerprint, 'state': state})
+
+    def newest(self, region=None, appliance=None, arch=None):
+        """Return newest available image row per (appliance, region)"""
+        newest = {}
+        for image in self.images(region, appliance, arch=arch,
+                                 state='available'):
+            key = (image['appliance'], image['region'])
+            if image['appliance'] and key not in newest:
+                newest[key] = image
+        return sorted(newest.values(),
+                      key=lambda i: (i['appliance'], i['region']))
+
+    def regions(self, **where):
+        """Return regions with an available image matching where (as for
+        images(), e.g., appliance='core-bookworm-amd64', version='18.0')"""
+        where.setdefault('state', 'available')
+        return sorted(set(i['region'] for i in self.images(**where)))
+
+
+def main():
+    try:
+        l_opts = ["help", "db=", "region=", "full", "appliance=", "version=",
+                  "arch=", "fingerprint=", "state="]
+        opts, args = getopt.gnu_getopt(sys.argv[1:], "h", l_opts)
+    except getopt.GetoptError as e:
+        usage(e)
+
+    path = None
+    regions = []
+    full = False
+    where = {}
+    for opt, val in opts:
+        if opt in ('-h', '--help'):
+            usage()
+
+        if opt == "--db":
+            path = val
+
+        if opt == "--region":
+            regions.append(val)
+
+        if opt == "--full":
+            full = True
+
+        if opt in ("--appliance", "--version", "--arch", "--fingerprint",
+                   "--state"):
+            where[opt[2:]] = val
+
+    if len(args) != 1:
+        usage("incorrect number of arguments")
+
+    command = args[0]
+    inventory = Inventory(path)
+    region = regions if regions else None
+
+    if command == 'refresh':
+        results = inventory.refresh(regions, full)
+        failed = False
+        for name, result in results.items():
+            if isinstance(result, Exception):
+                print(f'{name}: failed: {result}')
+                failed = True
+            else:
+                print(f'{name}: {result[0]} images, {result[1]} snapshots')
+        if failed:
+            sys.exit(1)
+
+    elif command == 'images':
+        for image in inventory.images(region, **where):
+            print(image['image_id'], image['region'], image['state'],
+                  image['created'], image['name'])
+
+    elif command == 'snapshots':
+        where.pop('version', None)
+        where.pop('arch', None)
+        for snapshot in inventory.snapshots(region, **where):
+            print(snapshot['snapshot_id'], snapshot['region'],
+                  snapshot['state'], snapshot['created'],
+                  snapshot['description'])
+
+    elif command == 'newest':
+        for image in inventory.newest(region, where.get('appliance'),
+                                      where.get('arch')):
+            print(image['image_id'], image['region'], image['created'],
+                  image['name'])
+
+    elif command == 'regions':
+        print(' '.join(inventory.regions(region=region, **where)))
+
+    else:
+        usage(f"unknown command: {command}")
+
+
+if __name__ == "__main__":
+    main()
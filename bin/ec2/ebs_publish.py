@@ -26,6 +26,8 @@ import getopt
 
 import utils
 
+from ebs_share import share_marketplace
+
 log = utils.get_logger('ebs-publish')
 
 
@@ -44,14 +46,31 @@ def share_public(ami_id, region):
 
     log.debug(f'setting image to public - {ami_id}')
     conn.modify_image_attribute(
-        ami_id,
-        attribute='launchPermission',
-        operation='add',
-        groups=['all'])
+        ImageId=ami_id,
+        LaunchPermission={'Add': [{'Group': 'all'}]})
 
     log.info(f'set image to public - {ami_id}')
 
 
+def image_snapshots(ami_id, region):
+    """Return ids of the EBS snapshots backing ami_id"""
+    conn = utils.connect(region)
+    image = conn.describe_images(ImageIds=[ami_id])['Images'][0]
+    return [m['Ebs']['SnapshotId'] for m in image['BlockDeviceMappings']
+            if m.get('Ebs', {}).get('SnapshotId')]
+
+
+def publish_image(ami_id, region, public=True, marketplace=False):
+    """Set launch permission and/or share backing snapshots (e.g., of a
+    regional copy, whose snapshots differ from the source region's)"""
+    if marketplace:
+        for snapshot_id in image_snapshots(ami_id, region):
+            share_marketplace(snapshot_id, region)
+
+    if public:
+        share_public(ami_id, region)
+
+
 def main():
     try:
         opts, args = getopt.gnu_getopt(sys.argv[1:], "h", ["help", "region="])
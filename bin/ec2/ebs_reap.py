@@ -0,0 +1,350 @@
+#!/usr/bin/python3
+# Copyright (c) 2011-2026 TurnKey GNU/Linux - http://www.turnkeylinux.org
+#
+# This file is part of buildtasks.
+#
+# Buildtasks is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+
+"""
+Reap leaked build volumes and superseded AMIs and snapshots
+
+Only resources created by buildtasks are considered:
+
+    volumes     unattached, tagged turnkey-build-volume and older than
+                --volume-age
+    images      named turnkey-APP-VERSION-CODENAME-ARCH_CTIME; per
+                appliance (and region), the newest --keep stable releases
+                and any pre-releases (e.g., rc) newer than the newest
+                stable release are kept, the rest (and their snapshots)
+                are superseded
+    snapshots   tagged turnkey-appliance, not backing any image and older
+                than --snapshot-age; the newest --keep per appliance are
+                kept (parents for --engine=direct builds)
+
+Without --delete, only reports what would be reaped.
+
+Options:
+    --region=       Region to reap (repeatable, default: all regions)
+    --delete        Deregister and delete (default: dry-run report)
+    --keep=         Stable releases / snapshots to keep per appliance
+                    (default: 2)
+    --min-age=      Never reap images younger than this (hours,
+                    default: 24)
+    --volume-age=   Reap unattached build volumes older than this (hours,
+                    default: 6)
+    --snapshot-age= Reap unused snapshots older than this (hours,
+                    default: 168)
+    --include-public  Also reap superseded public images (default: skip)
+
+Environment:
+
+    AWS_ACCESS_KEY_ID       AWS Access Key ID (required)
+    AWS_SECRET_ACCESS_KEY   AWS Secret Access Key (required)
+    AWS_SESSION_TOKEN       AWS Session Token
+    BT_AWS_RATE_SCALE       Scale API call rates (default: 1, see
+                            ratelimit.py)
+
+"""
+import re
+import sys
+import time
+import getopt
+
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import utils
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+log = utils.get_logger('ebs-reap')
+
+STABLE_VERSION = re.compile(r'\d+(\.\d+)*$')
+
+HOUR = 3600
+
+
+def usage(e=None):
+    if e:
+        print("error: " + str(e), file=sys.stderr)
+
+    print("Syntax: %s [ -options ]" % (sys.argv[0]), file=sys.stderr)
+    print(__doc__.strip(), file=sys.stderr)
+
+    sys.exit(1)
+
+
+class Policy:
+    def __init__(self, keep=2, min_age=24, volume_age=6, snapshot_age=168,
+                 include_public=False):
+        self.keep = keep
+        self.min_age = min_age * HOUR
+        self.volume_age = volume_age * HOUR
+        self.snapshot_age = snapshot_age * HOUR
+        self.include_public = include_public
+
+
+class Action:
+    def __init__(self, region, kind, resource_id, reason, depends=None):
+        self.region = region
+        self.kind = kind
+        self.id = resource_id
+        self.reason = reason
+        self.depends = depends
+        self.error = None
+
+    def __str__(self):
+        return f'{self.region} {self.kind} {self.id} ({self.reason})'
+
+
+def _age(timestamp, now):
+    if isinstance(timestamp, str):
+        timestamp = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+    return now - timestamp.timestamp()
+
+
+def _version_key(version):
+    # pre-releases (e.g., 18.0rc1) sort before their release (18.0)
+    release, suffix = re.match(r'([\d.]*\d)(.*)', version).groups()
+    release = [int(part) for part in release.split('.')]
+    if not suffix:
+        return (release, 1)
+
+    return (release, 0, [int(part) if part.isdigit() else part
+                         for part in re.split(r'(\d+)', suffix)])
+
+
+def _paginate(conn, method, key, **kwargs):
+    for page in conn.get_paginator(method).paginate(**kwargs):
+        yield from page[key]
+
+
+def _backing_snapshots(image):
+    mappings = image.get('BlockDeviceMappings', [])
+    return [m['Ebs']['SnapshotId'] for m in mappings
+            if m.get('Ebs', {}).get('SnapshotId')]
+
+
+def superseded_images(images, policy, now):
+    """Return [(image, reason)] of images superseded per policy"""
+    groups = {}
+    for image in images:
+        m = utils.parse_image_name(image['Name'])
+        if m:
+            key = (m['appliance'], m['pvm'])
+            groups.setdefault(key, []).append((image, m))
+
+    superseded = []
+    for key, group in groups.items():
+        group.sort(key=lambda i: (_version_key(i[1]['version']),
+                                  i[1]['ctime']), reverse=True)
+        stable = [(image, m) for image, m in group
+                  if STABLE_VERSION.match(m['version'])]
+        kept = set(image['ImageId'] for image, m in stable[:policy.keep])
+        newest_stable = _version_key(stable[0][1]['version']) \
+            if stable else None
+
+        for image, m in group:
+            if image['ImageId'] in kept:
+                continue
+
+            if STABLE_VERSION.match(m['version']):
+                reason = f'superseded, keeping {policy.keep} newer'
+            elif newest_stable is None or \
+                    _version_key(m['version']) > newest_stable:
+                continue
+            else:
+                reason = 'pre-release superseded by stable release'
+
+            if _age(image['CreationDate'], now) < policy.min_age:
+                continue
+            if image.get('Public') and not policy.include_public:
+                continue
+
+            superseded.append((image, reason))
+
+    return superseded
+
+
+def plan(region, policy, now=None):
+    """Return list of Actions (in order) to reap resources in region"""
+    now = now if now else time.time()
+    conn = utils.connect(region)
+    actions = []
+
+    images = [i for i in conn.describe_images(Owners=['self'])['Images']
+              if i['Name'].startswith('turnkey-')]
+    superseded = superseded_images(images, policy, now)
+    reaped_ids = set(image['ImageId'] for image, reason in superseded)
+
+    # e.g., HVM and PVM images registered from the same snapshot
+    in_use = set(s for i in images if i['ImageId'] not in reaped_ids
+                 for s in _backing_snapshots(i))
+
+    reaped = set()
+    for image, reason in superseded:
+        actions.append(Action(region, 'image', image['ImageId'],
+                              f"{image['Name']}: {reason}"))
+        for snapshot_id in _backing_snapshots(image):
+            if snapshot_id in in_use | reaped:
+                continue
+            reaped.add(snapshot_id)
+            actions.append(Action(region, 'snapshot', snapshot_id,
+                                  f"backing {image['ImageId']}",
+                                  depends=image['ImageId']))
+
+    in_use |= reaped
+    filters = [{'Name': 'tag-key', 'Values': [utils.APPLIANCE_TAG]},
+               {'Name': 'status', 'Values': ['completed']}]
+    appliances = {}
+    for snapshot in _paginate(conn, 'describe_snapshots', 'Snapshots',
+                              OwnerIds=['self'], Filters=filters):
+        tags = {t['Key']: t['Value'] for t in snapshot.get('Tags', [])}
+        appliance = tags[utils.APPLIANCE_TAG]
+        appliances.setdefault(appliance, []).append(snapshot)
+
+    for appliance, snapshots in appliances.items():
+        snapshots.sort(key=lambda s: _age(s['StartTime'], now))
+        for snapshot in snapshots[policy.keep:]:
+            age = _age(snapshot['StartTime'], now)
+            if snapshot['SnapshotId'] in in_use or \
+                    age < policy.snapshot_age:
+                continue
+            actions.append(Action(region, 'snapshot', snapshot['SnapshotId'],
+                                  f'unused {appliance} snapshot, '
+                                  f'{age / HOUR:.0f}h old'))
+
+    filters = [{'Name': 'tag-key', 'Values': [utils.BUILD_VOLUME_TAG]},
+               {'Name': 'status', 'Values': ['available']}]
+    for volume in _paginate(conn, 'describe_volumes', 'Volumes',
+                            Filters=filters):
+        age = _age(volume['CreateTime'], now)
+        if age >= policy.volume_age:
+            actions.append(Action(region, 'volume', volume['VolumeId'],
+                                  f'leaked build volume, '
+                                  f'{age / HOUR:.0f}h old'))
+
+    return actions
+
+
+def reap(actions, region):
+    """Carry out actions (in order); calls are paced by ratelimit.py"""
+    conn = utils.connect(region)
+    failed = set()
+    for action in actions:
+        if action.depends in failed:
+            action.error = f'{action.depends} was not reaped'
+            continue
+
+        try:
+            if action.kind == 'image':
+                conn.deregister_image(ImageId=action.id)
+            elif action.kind == 'snapshot':
+                conn.delete_snapshot(SnapshotId=action.id)
+            elif action.kind == 'volume':
+                conn.delete_volume(VolumeId=action.id)
+            log.info(f'reaped {action}')
+        except ClientError as e:
+            action.error = utils.error_code(e)
+            log.error(f'failed to reap {action}: {e}')
+            failed.add(action.id)
+
+    return actions
+
+
+def reap_region(region, policy, delete=False):
+    actions = plan(region, policy)
+    if delete:
+        reap(actions, region)
+    return actions
+
+
+def reap_regions(regions, policy, delete=False, max_workers=8):
+    """Plan (and if delete, reap) regions concurrently; returns
+    {region: [Action]}, or {region: exception} if planning failed"""
+    results = {}
+    workers = max(min(max_workers, len(regions)), 1)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {region: executor.submit(reap_region, region, policy,
+                                           delete)
+                   for region in regions}
+        for region, future in futures.items():
+            try:
+                results[region] = future.result()
+            except (ClientError, BotoCoreError) as e:
+                log.error(f'{region}: {e}')
+                results[region] = e
+
+    return results
+
+
+def main():
+    try:
+        l_opts = ["help", "region=", "delete", "keep=", "min-age=",
+                  "volume-age=", "snapshot-age=", "include-public"]
+        opts, args = getopt.gnu_getopt(sys.argv[1:], "h", l_opts)
+    except getopt.GetoptError as e:
+        usage(e)
+
+    regions = []
+    delete = False
+    kwargs = {}
+    for opt, val in opts:
+        if opt in ('-h', '--help'):
+            usage()
+
+        if opt == "--region":
+            regions.append(val)
+
+        if opt == "--delete":
+            delete = True
+
+        if opt == "--keep":
+            kwargs['keep'] = int(val)
+
+        if opt == "--min-age":
+            kwargs['min_age'] = float(val)
+
+        if opt == "--volume-age":
+            kwargs['volume_age'] = float(val)
+
+        if opt == "--snapshot-age":
+            kwargs['snapshot_age'] = float(val)
+
+        if opt == "--include-public":
+            kwargs['include_public'] = True
+
+    if args:
+        usage("incorrect number of arguments")
+
+    regions = regions if regions else utils.get_all_regions()
+    results = reap_regions(regions, Policy(**kwargs), delete)
+
+    failed = False
+    for region, actions in results.items():
+        if isinstance(actions, Exception):
+            print(f'{region}: failed: {actions}')
+            failed = True
+            continue
+
+        for action in actions:
+            status = 'would reap' if not delete else \
+                f'FAILED ({action.error})' if action.error else 'reaped'
+            print(f'{status} {action}')
+            failed = failed or bool(action.error)
+
+        counts = {}
+        for action in actions:
+            counts[action.kind] = counts.get(action.kind, 0) + 1
+        summary = ', '.join(f'{n} {kind}(s)' for kind, n in counts.items())
+        print(f'{region}: {summary if summary else "nothing to reap"}')
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -30,9 +30,6 @@ import getopt
 
 import utils
 
-from boto.ec2.blockdevicemapping import BlockDeviceType, BlockDeviceMapping
-import boto3
-
 log = utils.get_logger('ebs-register')
 
 
@@ -52,14 +49,15 @@ def usage(e=None):
 
 
 def register(snapshot_id, region, arch, size=None,
-             name=None, desc=None, pvm=False):
+             name=None, desc=None, pvm=False, tags=None):
     conn = utils.connect(region)
 
     if None in (name, size):
         log.debug(f'getting snapshot - {snapshot_id}')
-        snapshot = conn.get_all_snapshots(snapshot_ids=[snapshot_id])[0]
-        size = size if size else snapshot.volume_size
-        name = name if name else snapshot.description
+        response = conn.describe_snapshots(SnapshotIds=[snapshot_id])
+        snapshot = response['Snapshots'][0]
+        size = size if size else snapshot['VolumeSize']
+        name = name if name else snapshot['Description']
 
     virt = 'hvm'
     kernel_id = None
@@ -72,44 +70,41 @@ def register(snapshot_id, region, arch, size=None,
         device_base = '/dev/sd'
         name += '-pvm'
 
-    log.debug('creating block_device_map')
-    block_device_map = BlockDeviceMapping()
-
-    rootfs = BlockDeviceType()
-    rootfs.delete_on_termination = True
-    rootfs.size = size
-    rootfs.snapshot_id = snapshot_id
     rootfs_device_name = device_base + 'a'
-    block_device_map[rootfs_device_name] = rootfs
-
-    ephemeral = BlockDeviceType()
-    ephemeral.ephemeral_name = 'ephemeral0'
     ephemeral_device_name = device_base + 'b'
-    block_device_map[ephemeral_device_name] = ephemeral
+    block_device_map = [
+        {
+            'DeviceName': rootfs_device_name,
+            'Ebs': {
+                'DeleteOnTermination': True,
+                'VolumeSize': size,
+                'SnapshotId': snapshot_id,
+            },
+        },
+        {
+            'DeviceName': ephemeral_device_name,
+            'VirtualName': 'ephemeral0',
+        }
+    ]
+
+    kwargs = {}
+    if kernel_id:
+        kwargs['KernelId'] = kernel_id
+    if desc:
+        kwargs['Description'] = desc
+    if tags:
+        kwargs['TagSpecifications'] = [{'ResourceType': 'image',
+                                        'Tags': utils.tag_list(tags)}]
 
     log.debug(f'registering image - {name}')
-    client3 = utils.connect_boto3(region)
-
-    response = client3.register_image(
+    response = conn.register_image(
         Name=name,
         Architecture=ec2_arch,
         RootDeviceName=rootfs_device_name,
-        BlockDeviceMappings=[
-            {
-                'DeviceName': '/dev/xvda',
-                'Ebs': {
-                    'DeleteOnTermination': True,
-                    'VolumeSize': size,
-                    'SnapshotId': snapshot_id,
-                },
-            },
-            {
-                'DeviceName': '/dev/xvdb',
-                'VirtualName': 'ephemeral0',
-            }
-        ],
+        BlockDeviceMappings=block_device_map,
         VirtualizationType=virt,
-        EnaSupport=True)
+        EnaSupport=True,
+        **kwargs)
 
     ami_id = response['ImageId']
 
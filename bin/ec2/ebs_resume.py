@@ -0,0 +1,168 @@
+# Copyright (c) 2011-2026 TurnKey GNU/Linux - http://www.turnkeylinux.org
+#
+# This file is part of buildtasks.
+#
+# Buildtasks is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+
+"""Resume interrupted EC2 publishes
+
+Every resource ebs.py creates is tagged with the build fingerprint. On
+start, resources already carrying the fingerprint (and the local journal
+kept next to LOGFILE_PATH) tell ebs.py which stages can be skipped.
+
+A run that finishes records 'done' in the journal, after which its
+resources are no longer resumed: a later build from the same inputs
+(e.g., a respin with --secupdates next week) starts over, and only
+resumes resources created after that record.
+"""
+
+import os
+import json
+import time
+import threading
+
+from datetime import datetime
+
+import utils
+
+log = utils.get_logger('ebs-resume')
+
+
+class Journal:
+    """Append-only JSON lines record of completed stages"""
+
+    def __init__(self, fingerprint, path=None):
+        self.fingerprint = fingerprint
+        if path is None and os.environ.get('LOGFILE_PATH'):
+            path = os.environ['LOGFILE_PATH'] + '.journal'
+        self.path = path
+        self.lock = threading.Lock()
+
+    def load(self):
+        entries = []
+        if not self.path or not os.path.exists(self.path):
+            return entries
+
+        with open(self.path) as fob:
+            for line in fob:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+
+                if entry.get('fingerprint') == self.fingerprint:
+                    entries.append(entry)
+
+        return entries
+
+    def record(self, stage, **values):
+        if not self.path:
+            return
+
+        entry = dict(values, stage=stage, fingerprint=self.fingerprint,
+                     time=round(time.time(), 3))
+        with self.lock:
+            with open(self.path, 'a') as fob:
+                fob.write(json.dumps(entry) + '\n')
+
+
+class State:
+    def __init__(self):
+        self.snapshot_id = None
+        self.snapshot_name = None
+        self.snapshot_state = None
+        self.bundled = set()
+        self.ami_id = None
+        self.ami_name = None
+        self.pvm_ami_id = None
+        self.marketplace = False
+        self.public = False
+        self.copies = {}
+        self.published = {}
+
+
+def _fingerprint_filter(fingerprint):
+    return [{'Name': 'tag:' + utils.FINGERPRINT_TAG, 'Values': [fingerprint]}]
+
+
+def _created(timestamp):
+    if isinstance(timestamp, str):
+        timestamp = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+    return timestamp.timestamp()
+
+
+def find_snapshot(fingerprint, region, since=None):
+    """Newest snapshot with fingerprint (created after since, if given)"""
+    conn = utils.connect(region)
+    response = conn.describe_snapshots(
+        OwnerIds=['self'], Filters=_fingerprint_filter(fingerprint))
+    snapshots = [s for s in response['Snapshots'] if s['State'] != 'error'
+                 and (since is None or _created(s['StartTime']) > since)]
+    if not snapshots:
+        return None
+
+    return max(snapshots, key=lambda s: s['StartTime'])
+
+
+def find_images(fingerprint, region, since=None):
+    """Images with fingerprint (created after since, if given)"""
+    conn = utils.connect(region)
+    response = conn.describe_images(
+        Owners=['self'], Filters=_fingerprint_filter(fingerprint))
+    return [i for i in response['Images']
+            if i['State'] not in ('failed', 'invalid', 'error')
+            and (since is None or _created(i['CreationDate']) > since)]
+
+
+def load_state(fingerprint, region, journal, copy_regions=()):
+    """Return State of fingerprinted build from journal and AWS"""
+    state = State()
+    entries = journal.load()
+
+    # only what was done since the last finished run is resumed
+    since = None
+    done = [n for n, entry in enumerate(entries) if entry['stage'] == 'done']
+    if done:
+        since = entries[done[-1]]['time']
+        entries = entries[done[-1] + 1:]
+        log.info(f'build fingerprint {fingerprint} finished before, only '
+                 f'resuming what was created since')
+
+    for entry in entries:
+        stage = entry['stage']
+        if stage == 'marketplace':
+            state.marketplace = True
+        elif stage == 'public':
+            state.public = True
+        elif stage == 'bundle':
+            state.bundled.add(entry['snapshot_id'])
+        elif stage == 'publish-copy':
+            state.published[entry['region']] = entry['ami_id']
+
+    snapshot = find_snapshot(fingerprint, region, since)
+    if snapshot:
+        state.snapshot_id = snapshot['SnapshotId']
+        state.snapshot_name = snapshot['Description']
+        state.snapshot_state = snapshot['State']
+
+    for image in find_images(fingerprint, region, since):
+        if image['Name'].endswith('-pvm'):
+            state.pvm_ami_id = image['ImageId']
+        else:
+            state.ami_id = image['ImageId']
+            state.ami_name = image['Name']
+
+    if state.ami_id:
+        for copy_region in copy_regions:
+            images = find_images(fingerprint, copy_region, since)
+            if images:
+                state.copies[copy_region] = images[0]['ImageId']
+
+    found = [f'snapshot={state.snapshot_id}', f'ami={state.ami_id}',
+             f'copies={len(state.copies)}']
+    log.info(f'build fingerprint {fingerprint}: ' + ' '.join(found))
+
+    return state
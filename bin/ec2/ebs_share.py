@@ -42,11 +42,12 @@ def usage(e=None):
 def share_marketplace(snapshot_id, region):
     conn = utils.connect(region)
 
-    log.debug(f'getting snapshot - {snapshot_id}')
-    snapshot = conn.get_all_snapshots(snapshot_ids=[snapshot_id])[0]
-
-    log.debug('sharing with marketplace')
-    snapshot.share(user_ids=['096457495696'])
+    log.debug(f'sharing with marketplace - {snapshot_id}')
+    conn.modify_snapshot_attribute(
+        SnapshotId=snapshot_id,
+        Attribute='createVolumePermission',
+        OperationType='add',
+        UserIds=['096457495696'])
 
     log.info(f'shared with marketplace - {snapshot_id}')
 
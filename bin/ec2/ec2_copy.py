@@ -19,11 +19,30 @@ Arguments:
     ami_region          Amazon Image Region
     region...regionN    Destination region(s) to copy to (also accepts: all)
 
+Options:
+
+    --wait              Wait for all copies to become available
+    --timeout=          Overall deadline in seconds when waiting
+                        (default: 14400)
+    --workers=          Concurrent region copies (default: 8)
+    --publish           Set launch permission of each copy to public once
+                        it is available (implies --wait)
+    --marketplace       Share each copy's snapshot with AWS marketplace
+                        userid once it is available (implies --wait)
+
 """
 import sys
+import time
 import getopt
+import hashlib
+
+from concurrent.futures import ThreadPoolExecutor
 
 import utils
+import waiter
+
+from ebs_publish import publish_image
+from botocore.exceptions import ClientError
 
 log = utils.get_logger('ebs-copy')
 
@@ -44,42 +63,198 @@ def usage(e=None):
     sys.exit(1)
 
 
+# throttling is retried by botocore (and paced by ratelimit.py)
+TRANSIENT_ERRORS = ('InternalError', 'InternalFailure', 'ServiceUnavailable',
+                    'Unavailable')
+
+
 class Image:
     def __init__(self, ami_id, region):
         self.id = ami_id
         self.region = region
+        self.source = None
+        self.state = 'pending'
+        self.error = None
+        self.published = False
+        self.publish_error = None
+        self.started = None
+        self.finished = None
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return None
+
+        finished = self.finished if self.finished else time.time()
+        return finished - self.started
 
     def get(self):
         conn = utils.connect(self.region)
-        return conn.get_all_images(image_ids=[self.id])[0]
+        return conn.describe_images(ImageIds=[self.id])['Images'][0]
+
+    def get_state(self):
+        # a fresh copy may not be visible to describe_images straight away
+        try:
+            return self.get()['State']
+        except IndexError:
+            return 'pending'
+        except ClientError as e:
+            if utils.error_code(e) != 'InvalidAMIID.NotFound':
+                raise
+            return 'pending'
+
+    def wait(self, state='available', timeout=14400):
+        waiter.get_tracker().wait('image', self.region, self.id, state,
+                                  timeout=timeout)
+
+    def wait_async(self, state='available', timeout=14400):
+        return waiter.get_tracker().submit('image', self.region, self.id,
+                                           state, timeout=timeout)
+
+
+def client_token(ami_id, region, issue):
+    """CopyImage idempotency token: the same for retries (by botocore or
+    after a lost response, or a resumed run) of one issue of a copy"""
+    key = f'{ami_id}:{region}:{issue}'
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def _copy(ami_id, ami_name, ami_region, region, retries, token, tags=None):
+    kwargs = {}
+    if tags:
+        kwargs['TagSpecifications'] = [{'ResourceType': 'image',
+                                        'Tags': utils.tag_list(tags)}]
+
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            conn = utils.connect(region)
+            response = conn.copy_image(SourceRegion=ami_region,
+                                       SourceImageId=ami_id, Name=ami_name,
+                                       ClientToken=token, **kwargs)
+            return response['ImageId']
+        except ClientError as e:
+            code = utils.error_code(e)
+            if code not in TRANSIENT_ERRORS or attempt > retries:
+                raise
+
+            log.debug(f'copy to {region} failed ({code}), retrying')
+            time.sleep(min(2 ** attempt, 30))
+
+
+def copy_region(ami_id, ami_name, ami_region, region, deadline, retries,
+                 wait, tags, image=None, publish=None):
+    image = image if image else Image(None, region)
+    image.started = time.time()
 
+    for attempt in range(retries + 1):
+        try:
+            if image.id is None:
+                log.debug(f'copying {ami_id} ({ami_region}) to {region}')
+                token = client_token(ami_id, region, attempt)
+                image.id = _copy(ami_id, ami_name, ami_region, region,
+                                 retries, token, tags)
+                log.info(f'pending {ami_id} ({ami_region}) to {image.id} '
+                         f'({region})')
 
-def copy_image(ami_id, ami_name, ami_region, regions=[]):
-    images = []
-    for region in regions:
-        log.debug(f'copying {ami_id} ({ami_region}) to {region}')
+            if wait:
+                timeout = max(deadline - time.monotonic(), 0)
+                image.wait('available', timeout=timeout)
+                image.state = 'available'
+            break
 
-        conn = utils.connect(region)
-        ret = conn.copy_image(ami_region, ami_id, ami_name)
-        image = Image(ret.image_id, region)
-        images.append(image)
+        except waiter.WaiterTimeout as e:
+            image.state, image.error = 'timeout', str(e)
+            break
 
-        log.info(f'pending {ami_id} ({ami_region}) to {image.id} ({region})')
+        except (waiter.WaiterError, ClientError) as e:
+            image.state, image.error = 'failed', str(e)
+            if isinstance(e, ClientError) or attempt == retries:
+                break
 
-    return images
+            log.debug(f'copy {image.id} ({region}) failed, reissuing')
+            image.id, image.error = None, None
+
+    image.finished = time.time()
+    if wait or image.error:
+        log.info(f'{image.state} {image.id} ({region}) '
+                 f'after {image.elapsed:.0f}s')
+
+    if publish and image.state == 'available':
+        try:
+            publish(image)
+            image.published = True
+        except ClientError as e:
+            image.publish_error = str(e)
+            log.error(f'publish {image.id} ({region}) failed: {e}')
+
+    return image
+
+
+def publisher(public=True, marketplace=False):
+    """Return copy_image() publish hook for publish_image()"""
+
+    def publish(image):
+        publish_image(image.id, image.region, public, marketplace)
+
+    return publish
+
+
+def copy_image(ami_id, ami_name, ami_region, regions=[], wait=False,
+               timeout=14400, max_workers=8, retries=3, tags=None,
+               existing=(), publish=None):
+    """Copy AMI to regions concurrently, returns Image per region.
+
+    If wait is set, block until every copy is available, failed or the
+    overall deadline (timeout seconds) has passed; check Image.state.
+
+    existing Images (e.g., copies from an interrupted run) are waited on
+    instead of copying to their regions again. publish(image) is called
+    in the region's worker as soon as its copy is available (requires
+    wait); errors are set in Image.publish_error.
+    """
+    deadline = time.monotonic() + timeout
+    existing = {image.region: image for image in existing}
+    workers = max(min(max_workers, len(regions)), 1)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(copy_region, ami_id, ami_name, ami_region,
+                                   region, deadline, retries, wait, tags,
+                                   existing.get(region), publish)
+                   for region in regions]
+
+        return [future.result() for future in futures]
 
 
 def main():
     try:
-        opts, args = getopt.gnu_getopt(sys.argv[1:], "h", ["help"])
+        l_opts = ["help", "wait", "timeout=", "workers=", "publish",
+                  "marketplace"]
+        opts, args = getopt.gnu_getopt(sys.argv[1:], "h", l_opts)
     except getopt.GetoptError as e:
         usage(e)
 
-    publish = False
+    kwargs = {}
+    public = marketplace = False
     for opt, val in opts:
         if opt in ('-h', '--help'):
             usage()
 
+        if opt == "--wait":
+            kwargs['wait'] = True
+
+        if opt == "--timeout":
+            kwargs['timeout'] = int(val)
+
+        if opt == "--workers":
+            kwargs['max_workers'] = int(val)
+
+        if opt == "--publish":
+            public = True
+
+        if opt == "--marketplace":
+            marketplace = True
+
     if len(args) < 4:
         usage("incorrect number of arguments")
 
@@ -90,9 +265,19 @@ def main():
         regions = utils.get_all_regions()
         regions.remove(ami_region)
 
-    images = copy_image(ami_id, ami_name, ami_region, regions)
+    if public or marketplace:
+        kwargs['wait'] = True
+        kwargs['publish'] = publisher(public, marketplace)
+
+    images = copy_image(ami_id, ami_name, ami_region, regions, **kwargs)
     for image in images:
-        print("%s - %s" % (image.id, image.region))
+        elapsed = f"{image.elapsed:.0f}s" if image.elapsed else "-"
+        published = " published" if image.published else ""
+        print("%s - %s %s %s%s" % (image.id, image.region, image.state,
+                                   elapsed, published))
+
+    if any(image.error or image.publish_error for image in images):
+        sys.exit(1)
 
 
 if __name__ == "__main__":
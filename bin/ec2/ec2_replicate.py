@@ -0,0 +1,308 @@
+#!/usr/bin/python3
+# Copyright (c) 2011-2026 TurnKey GNU/Linux - http://www.turnkeylinux.org
+#
+# This file is part of buildtasks.
+#
+# Buildtasks is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+
+"""
+Replicate AMI to destination region(s) along a fan-out tree
+
+Rather than copying every region from the source region, each region is
+copied from the nearest replica that is already available (e.g.,
+us-east-1 -> eu-west-1 -> eu-central-1). Each replica serves at most
+--fanout concurrent copies and at most --dest-limit copies run into any
+one region. If a copy from a replica fails, the region is re-planned
+from another replica (or the source).
+
+Arguments:
+
+    ami_id              Amazon Image ID
+    ami_name            Amazon Image Name
+    ami_region          Amazon Image Region
+    region...regionN    Destination region(s) to copy to (also accepts: all)
+
+Options:
+
+    --timeout=          Overall deadline in seconds (default: 14400)
+    --fanout=           Concurrent copies from each replica (default: 2)
+    --dest-limit=       Concurrent copies into each region (default: 5)
+    --publish           Set launch permission of each replica to public
+    --marketplace       Share each replica's snapshot with AWS marketplace
+
+"""
+import sys
+import time
+import getopt
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import utils
+
+from ec2_copy import Image, copy_region, publisher
+
+log = utils.get_logger('ebs-replicate')
+
+# region prefix -> continent, for distance between regions
+AREAS = {'us': 'americas', 'ca': 'americas', 'mx': 'americas',
+         'sa': 'americas', 'eu': 'emea', 'il': 'emea', 'me': 'emea',
+         'af': 'emea', 'ap': 'apac'}
+
+# AWS limits concurrent copies into a destination region; shared by every
+# replication in the process (e.g., ebs_batch.py)
+DEST_LIMIT = 5
+
+_dest_slots = {}
+_dest_slots_lock = threading.Lock()
+
+
+def fatal(e):
+    print("error: " + str(e), file=sys.stderr)
+    sys.exit(1)
+
+
+def usage(e=None):
+    if e:
+        print("error: " + str(e), file=sys.stderr)
+
+    args = "ami_id ami_name ami_region region...regionN"
+    print("Syntax: %s [ -options ] %s" % (sys.argv[0], args),
+          file=sys.stderr)
+    print(__doc__.strip(), file=sys.stderr)
+
+    sys.exit(1)
+
+
+def area(region):
+    prefix = region.split('-')[0]
+    return AREAS.get(prefix, prefix)
+
+
+def region_distance(a, b):
+    """Rough network distance: 0 (same region) to 4 (other continent)"""
+    a, b = a.split('-'), b.split('-')
+    if a == b:
+        return 0
+    if a[:2] == b[:2]:
+        return 1
+    if a[0] == b[0]:
+        return 2
+    if area(a[0]) == area(b[0]):
+        return 3
+    return 4
+
+
+def _dest_slot(region, limit):
+    with _dest_slots_lock:
+        if region not in _dest_slots:
+            _dest_slots[region] = threading.Semaphore(limit)
+        return _dest_slots[region]
+
+
+class Planner:
+    """Choose the replica to copy each region from.
+
+    A region is copied from the nearest available replica with a free
+    fanout slot, unless a replica still being copied is nearer (then it
+    waits for that one). Regions in areas with no replica yet go first,
+    so each continent gets a local replica as early as possible.
+    """
+
+    def __init__(self, ami_id, source_region, regions, fanout=2):
+        self.available = {source_region: ami_id}
+        self.pending = list(regions)
+        self.copying = {}
+        self.load = {}
+        self.excluded = {region: set() for region in regions}
+        self.fanout = fanout
+
+    def _nearest(self, region, candidates):
+        candidates = [c for c in candidates
+                      if c not in self.excluded[region]]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda c: region_distance(region, c))
+
+    def next(self):
+        """Return (region, source region) to copy next, or None"""
+        covered = set(area(r) for r in list(self.available) +
+                      list(self.copying))
+
+        def priority(region):
+            source = self._nearest(region, self.available)
+            return (area(region) in covered,
+                    region_distance(region, source) if source else 5)
+
+        for region in sorted(self.pending, key=priority):
+            source = self._nearest(region, [r for r in self.available
+                                            if self.load.get(r, 0) <
+                                            self.fanout])
+            if source is None:
+                continue
+
+            # a nearer replica is on its way
+            if any(region_distance(region, r) <
+                   region_distance(region, source)
+                   for r in self.copying
+                   if r not in self.excluded[region]):
+                continue
+
+            return region, source
+
+        return None
+
+    def start(self, region, source):
+        self.pending.remove(region)
+        self.copying[region] = source
+        self.load[source] = self.load.get(source, 0) + 1
+
+    def finish(self, region, ami_id=None):
+        source = self.copying.pop(region)
+        if source:
+            self.load[source] -= 1
+        if ami_id:
+            self.available[region] = ami_id
+
+    def replan(self, region, source):
+        """Retry region from another replica; False if none is left"""
+        self.excluded[region].add(source)
+        if not self._nearest(region, list(self.available) +
+                             list(self.copying) + self.pending):
+            return False
+
+        self.pending.append(region)
+        return True
+
+
+def replicate(ami_id, ami_name, ami_region, regions, timeout=14400,
+              fanout=2, dest_limit=DEST_LIMIT, retries=3, tags=None,
+              existing=(), publish=None):
+    """Copy AMI to regions along a fan-out tree, returns Image per region.
+
+    Blocks until every copy is available, failed or the overall deadline
+    (timeout seconds) has passed; check Image.state and Image.source.
+    existing Images (copies from an interrupted run) are waited on and
+    used as replicas once available; publish is as for copy_image().
+    """
+    deadline = time.monotonic() + timeout
+    planner = Planner(ami_id, ami_region, regions, fanout)
+    images = {}
+
+    def copy(image, source):
+        with _dest_slot(image.region, dest_limit):
+            return copy_region(planner.available.get(source, ami_id),
+                               ami_name, source if source else ami_region,
+                               image.region, deadline, retries, True, tags,
+                               image, publish)
+
+    workers = max(len(regions), 1)
+    with ThreadPoolExecutor(max_workers=workers,
+                            thread_name_prefix='replicate') as executor:
+        futures = {}
+        for image in existing:
+            planner.pending.remove(image.region)
+            planner.copying[image.region] = None
+            futures[executor.submit(copy, image, None)] = image
+
+        while futures or planner.pending:
+            while True:
+                step = planner.next()
+                if step is None:
+                    break
+
+                region, source = step
+                planner.start(region, source)
+                image = Image(None, region)
+                image.source = source
+                log.info(f'replicating {region} from {source}')
+                futures[executor.submit(copy, image, source)] = image
+
+            if not futures:
+                # nothing in flight and nothing can start
+                for region in planner.pending:
+                    images[region] = Image(None, region)
+                    images[region].state = 'failed'
+                    images[region].error = 'no replica to copy from'
+                break
+
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                futures.pop(future)
+                image = future.result()
+                if image.error is None:
+                    planner.finish(image.region, image.id)
+                    images[image.region] = image
+                    continue
+
+                source = planner.copying[image.region]
+                planner.finish(image.region)
+                if source and source != ami_region and \
+                        image.state != 'timeout' and \
+                        planner.replan(image.region, source):
+                    log.info(f'copy to {image.region} from {source} '
+                             f'failed ({image.error}), re-planning')
+                else:
+                    images[image.region] = image
+
+    return [images[region] for region in regions]
+
+
+def main():
+    try:
+        l_opts = ["help", "timeout=", "fanout=", "dest-limit=", "publish",
+                  "marketplace"]
+        opts, args = getopt.gnu_getopt(sys.argv[1:], "h", l_opts)
+    except getopt.GetoptError as e:
+        usage(e)
+
+    kwargs = {}
+    public = marketplace = False
+    for opt, val in opts:
+        if opt in ('-h', '--help'):
+            usage()
+
+        if opt == "--timeout":
+            kwargs['timeout'] = int(val)
+
+        if opt == "--fanout":
+            kwargs['fanout'] = int(val)
+
+        if opt == "--dest-limit":
+            kwargs['dest_limit'] = int(val)
+
+        if opt == "--publish":
+            public = True
+
+        if opt == "--marketplace":
+            marketplace = True
+
+    if len(args) < 4:
+        usage("incorrect number of arguments")
+
+    ami_id, ami_name, ami_region = args[:3]
+    regions = args[3:]
+
+    if 'all' in regions:
+        regions = utils.get_all_regions()
+        regions.remove(ami_region)
+
+    if public or marketplace:
+        kwargs['publish'] = publisher(public, marketplace)
+
+    images = replicate(ami_id, ami_name, ami_region, regions, **kwargs)
+    for image in images:
+        elapsed = f"{image.elapsed:.0f}s" if image.elapsed else "-"
+        print("%s - %s %s %s (from %s)" % (image.id, image.region,
+                                           image.state, elapsed,
+                                           image.source or '-'))
+
+    if any(image.error or image.publish_error for image in images):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
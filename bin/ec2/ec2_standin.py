@@ -0,0 +1,749 @@
+#!/usr/bin/python3
+# Copyright (c) 2011-2026 TurnKey GNU/Linux - http://www.turnkeylinux.org
+#
+# This file is part of buildtasks.
+#
+# Buildtasks is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+
+"""
+Local stand-in for the EC2 and EBS direct APIs (offline testing)
+
+Serves the EC2 actions used by bin/ec2 (volumes, snapshots, images,
+copies, tags, attributes) and, on the same port, the EBS direct APIs of
+ebs_blockstore.py. Requests and responses are (de)serialized using
+botocore's EC2 model, so boto3 clients work unmodified. Resources move
+through their states after configurable latencies; throttling and copy
+failures can be injected. Point the EC2 tools at it with:
+
+    export EC2_ENDPOINT_URL=http://127.0.0.1:PORT
+    export EBS_ENDPOINT_URL=http://127.0.0.1:PORT
+    export BT_EC2_METADATA=/path/to/identity.json
+
+Options:
+
+    --port=         Port to listen on (default: 8766)
+    --dir=          Directory to store blocks in (default: temporary)
+    --latency=      NAME=SECONDS state transition latency (repeatable):
+                    api, volume, attach, detach, snapshot, register, copy
+    --throttle=     Fraction of requests to fail with RequestLimitExceeded
+    --request-rate= Requests per second per region (burst of twice that)
+                    before failing with RequestLimitExceeded, like EC2's
+                    request token buckets (default: unlimited)
+    --fail-copy=    Fraction of image copies that end up 'failed'
+    --loop          Back attached volumes with loop devices (requires root)
+    --byid-dir=     Where to link attached loop devices (set
+                    BT_EBS_BYID_DIR to the same path for the EC2 tools)
+
+"""
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import random
+import getopt
+import fnmatch
+import tempfile
+import threading
+import subprocess
+
+from collections import Counter
+from datetime import datetime, timezone
+from urllib.parse import parse_qs
+from xml.etree import ElementTree
+
+from botocore.session import get_session
+
+import ebs_blockstore
+
+XMLNS = 'http://ec2.amazonaws.com/doc/2016-11-15/'
+OWNER_ID = '000000000000'
+
+# seconds until a resource reaches its next state
+LATENCY = {
+    'api': 0.0,
+    'volume': 1.0,
+    'attach': 0.5,
+    'detach': 0.5,
+    'snapshot': 2.0,
+    'register': 1.0,
+    'copy': 3.0,
+}
+
+
+def usage(e=None):
+    if e:
+        print("error: " + str(e), file=sys.stderr)
+
+    print("Syntax: %s [ -options ]" % (sys.argv[0]), file=sys.stderr)
+    print(__doc__.strip(), file=sys.stderr)
+
+    sys.exit(1)
+
+
+class StandInError(Exception):
+    def __init__(self, code, msg, status=400):
+        Exception.__init__(self, msg)
+        self.code = code
+        self.status = status
+
+
+def _serialized_name(shape, default):
+    # inverse of botocore's EC2Serializer._get_serialized_name
+    if 'queryName' in shape.serialization:
+        return shape.serialization['queryName']
+    name = shape.serialization.get('name')
+    return name[0].upper() + name[1:] if name else default
+
+
+def parse_params(shape, query, prefix=''):
+    """Return boto3 style parameters of flattened EC2 query"""
+    if shape.type_name == 'structure':
+        parsed = {}
+        for name, member in shape.members.items():
+            key = _serialized_name(member, name)
+            value = parse_params(member, query,
+                                 f'{prefix}.{key}' if prefix else key)
+            if value is not None:
+                parsed[name] = value
+        return parsed if parsed or not prefix else None
+
+    if shape.type_name == 'list':
+        items = []
+        while True:
+            item = f'{prefix}.{len(items) + 1}'
+            if not any(k == item or k.startswith(item + '.') for k in query):
+                return items if items else None
+            items.append(parse_params(shape.member, query, item))
+
+    value = query.get(prefix)
+    if value is None:
+        return None
+    if shape.type_name in ('integer', 'long'):
+        return int(value)
+    if shape.type_name == 'boolean':
+        return value == 'true'
+    return value
+
+
+def _iso_time(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime(
+        '%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+def _xml_text(shape, value):
+    if shape.type_name == 'boolean':
+        return 'true' if value else 'false'
+    if shape.type_name == 'timestamp':
+        return _iso_time(value)
+    return str(value)
+
+
+def to_xml(parent, shape, value, name):
+    """Append value as element name of parent, as EC2 would serialize it"""
+    node = ElementTree.SubElement(parent, name)
+    if shape.type_name == 'structure':
+        for member_name, member in shape.members.items():
+            if value.get(member_name) is None:
+                continue
+            to_xml(node, member, value[member_name],
+                   member.serialization.get('name', member_name))
+    elif shape.type_name == 'list':
+        item_name = shape.member.serialization.get('name', 'item')
+        for item in value:
+            to_xml(node, shape.member, item, item_name)
+    else:
+        node.text = _xml_text(shape, value)
+
+
+def _tags(resource):
+    return {tag['Key']: tag['Value'] for tag in resource.get('Tags', [])}
+
+
+def _matches(resource, filters, fields):
+    for f in filters or []:
+        name, values = f['Name'], f.get('Values', [])
+        if name == 'tag-key':
+            if not set(values) & set(_tags(resource)):
+                return False
+            continue
+        elif name.startswith('tag:'):
+            value = _tags(resource).get(name[len('tag:'):])
+        elif name in fields:
+            value = resource.get(fields[name])
+        else:
+            raise StandInError('InvalidParameterValue',
+                               f'unsupported filter: {name}')
+        if isinstance(value, float):
+            value = _iso_time(value)
+        if value is None or \
+                not any(fnmatch.fnmatchcase(value, v) for v in values):
+            return False
+
+    return True
+
+
+class Ec2StandIn:
+    """EC2 resource state for all regions"""
+
+    def __init__(self, store, latency=None, throttle=0, fail_copy=0,
+                 loop=False, byid_dir=None, seed=None, request_rate=0):
+        self.store = store
+        self.latency = dict(LATENCY, **(latency if latency else {}))
+        self.throttle = throttle
+        self.request_rate = request_rate
+        self.request_tokens = {}
+        self.fail_copy = fail_copy
+        self.loop = loop
+        self.byid_dir = byid_dir
+        self.random = random.Random(seed)
+        self.model = get_session().get_service_model('ec2')
+        self.lock = threading.RLock()
+        self.regions = {}
+        self.calls = Counter()
+        self.copy_times = []
+
+    def region(self, name):
+        if name not in self.regions:
+            self.regions[name] = {'snapshots': {}, 'volumes': {},
+                                  'images': {}, 'devices': {},
+                                  'tokens': {}}
+        return self.regions[name]
+
+    def _new_id(self, prefix):
+        return f'{prefix}-{uuid.uuid4().hex[:17]}'
+
+    def _transition(self, resource, state, latency, key='State'):
+        """Move resource to state once latency (seconds) has passed"""
+        resource['_next'] = (key, state, time.monotonic() + latency)
+
+    def _refresh(self, resource):
+        if resource.get('_next'):
+            key, state, ready = resource['_next']
+            if time.monotonic() >= ready:
+                resource[key] = state
+                resource['_next'] = None
+                if key == 'State' and state == 'completed':
+                    resource['Progress'] = '100%'
+        return resource
+
+    # request handling
+
+    def _take_token(self, region):
+        # region's request bucket: refills at request_rate, holds 2s worth
+        now = time.monotonic()
+        burst = self.request_rate * 2
+        tokens, updated = self.request_tokens.get(region, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * self.request_rate)
+        if tokens < 1:
+            self.request_tokens[region] = (tokens, now)
+            return False
+
+        self.request_tokens[region] = (tokens - 1, now)
+        return True
+
+    def handle(self, region, query):
+        action = query.pop('Action', None)
+        query.pop('Version', None)
+        try:
+            operation = self.model.operation_model(action)
+        except Exception:
+            raise StandInError('InvalidAction', f'unknown action: {action}')
+
+        handler = getattr(self, action, None)
+        if handler is None:
+            raise StandInError('UnsupportedOperation',
+                               f'not implemented: {action}')
+
+        with self.lock:
+            self.calls[(region, action)] += 1
+            throttled = self.random.random() < self.throttle
+            if self.request_rate and not self._take_token(region):
+                throttled = True
+
+        if self.latency['api']:
+            time.sleep(self.latency['api'])
+
+        if throttled:
+            raise StandInError('RequestLimitExceeded',
+                               'Request limit exceeded.', 503)
+
+        params = parse_params(operation.input_shape, query) \
+            if operation.input_shape else {}
+        with self.lock:
+            result = handler(self.region(region), region, params)
+
+        root = ElementTree.Element(f'{action}Response', xmlns=XMLNS)
+        ElementTree.SubElement(root, 'requestId').text = str(uuid.uuid4())
+        if operation.output_shape:
+            shape = operation.output_shape
+            for name, member in shape.members.items():
+                if result.get(name) is not None:
+                    to_xml(root, member, result[name],
+                           member.serialization.get('name', name))
+
+        return ElementTree.tostring(root, xml_declaration=True,
+                                    encoding='UTF-8')
+
+    def _find(self, resources, ids, code):
+        for resource_id in ids or []:
+            if resource_id not in resources:
+                raise StandInError(code, f"The ID '{resource_id}' does "
+                                   "not exist")
+        selected = ids if ids else list(resources)
+        return [self._refresh(resources[i]) for i in selected]
+
+    # snapshots (includes those created with the EBS direct APIs)
+
+    def _direct_snapshots(self, region):
+        snapshots = {}
+        for snapshot in list(self.store.snapshots.values()):
+            if snapshot.get('Region', region) != region:
+                continue
+
+            state = {'pending': 'pending', 'completed': 'pending',
+                     'error': 'error'}[snapshot['Status']]
+            completed = snapshot.get('Completed')
+            if completed and time.monotonic() >= \
+                    completed + self.latency['snapshot']:
+                state = 'completed'
+
+            snapshots[snapshot['SnapshotId']] = {
+                'SnapshotId': snapshot['SnapshotId'], 'State': state,
+                'StartTime': snapshot['StartTime'],
+                'VolumeSize': snapshot['VolumeSize'],
+                'Description': snapshot['Description'],
+                'OwnerId': OWNER_ID, 'Tags': snapshot['Tags'],
+                'Progress': '100%' if state == 'completed' else '0%'}
+
+        return snapshots
+
+    def _snapshots(self, state, region):
+        return dict(self._direct_snapshots(region), **state['snapshots'])
+
+    def CreateSnapshot(self, state, region, params):
+        volume = self._find(state['volumes'], [params['VolumeId']],
+                            'InvalidVolume.NotFound')[0]
+        snapshot = {'SnapshotId': self._new_id('snap'),
+                    'VolumeId': volume['VolumeId'], 'State': 'pending',
+                    'StartTime': time.time(), 'Progress': '0%',
+                    'OwnerId': OWNER_ID, 'VolumeSize': volume['Size'],
+                    'Description': params.get('Description', ''),
+                    'Tags': []}
+        for spec in params.get('TagSpecifications', []):
+            snapshot['Tags'] += spec.get('Tags', [])
+        self._transition(snapshot, 'completed', self.latency['snapshot'])
+        state['snapshots'][snapshot['SnapshotId']] = snapshot
+        return snapshot
+
+    def DescribeSnapshots(self, state, region, params):
+        snapshots = self._find(self._snapshots(state, region),
+                               params.get('SnapshotIds'),
+                               'InvalidSnapshot.NotFound')
+        fields = {'status': 'State', 'snapshot-id': 'SnapshotId',
+                  'description': 'Description', 'owner-id': 'OwnerId',
+                  'start-time': 'StartTime'}
+        return {'Snapshots': [s for s in snapshots if
+                              _matches(s, params.get('Filters'), fields)]}
+
+    def ModifySnapshotAttribute(self, state, region, params):
+        snapshot = self._find(self._snapshots(state, region),
+                              [params['SnapshotId']],
+                              'InvalidSnapshot.NotFound')[0]
+        if snapshot['State'] != 'completed':
+            raise StandInError('IncorrectState',
+                               f"snapshot {snapshot['SnapshotId']} is "
+                               "not completed")
+        return {}
+
+    def DeleteSnapshot(self, state, region, params):
+        snapshot_id = params['SnapshotId']
+        self._find(self._snapshots(state, region), [snapshot_id],
+                   'InvalidSnapshot.NotFound')
+        for image in state['images'].values():
+            for mapping in image.get('BlockDeviceMappings') or []:
+                if mapping.get('Ebs', {}).get('SnapshotId') == snapshot_id:
+                    raise StandInError('InvalidSnapshot.InUse',
+                                       f"The snapshot {snapshot_id} is "
+                                       f"currently in use by "
+                                       f"{image['ImageId']}")
+
+        if snapshot_id in state['snapshots']:
+            del state['snapshots'][snapshot_id]
+        else:
+            with self.store.lock:
+                del self.store.snapshots[snapshot_id]
+        return {}
+
+    # volumes
+
+    def CreateVolume(self, state, region, params):
+        volume = {'VolumeId': self._new_id('vol'), 'Size': params['Size'],
+                  'AvailabilityZone': params['AvailabilityZone'],
+                  'State': 'creating', 'CreateTime': time.time(),
+                  'VolumeType': params.get('VolumeType', 'gp2'),
+                  'Iops': params.get('Iops'),
+                  'Throughput': params.get('Throughput'),
+                  'Attachments': [], 'Tags': []}
+        for spec in params.get('TagSpecifications', []):
+            volume['Tags'] += spec.get('Tags', [])
+        self._transition(volume, 'available', self.latency['volume'])
+        state['volumes'][volume['VolumeId']] = volume
+        return volume
+
+    def DescribeVolumes(self, state, region, params):
+        volumes = self._find(state['volumes'], params.get('VolumeIds'),
+                             'InvalidVolume.NotFound')
+        fields = {'status': 'State', 'volume-id': 'VolumeId'}
+        return {'Volumes': [v for v in volumes if
+                            _matches(v, params.get('Filters'), fields)]}
+
+    def ModifyVolume(self, state, region, params):
+        volume = self._find(state['volumes'], [params['VolumeId']],
+                            'InvalidVolume.NotFound')[0]
+        for field in ('VolumeType', 'Iops', 'Throughput', 'Size'):
+            if field in params:
+                volume[field] = params[field]
+        return {'VolumeModification': {'VolumeId': volume['VolumeId'],
+                                       'ModificationState': 'modifying'}}
+
+    def _loop_attach(self, state, volume):
+        path = os.path.join(self.store.path, volume['VolumeId'] + '.img')
+        with open(path, 'wb') as fob:
+            fob.truncate(volume['Size'] * 1024 ** 3)
+        loop = subprocess.run(['losetup', '--find', '--show', '--partscan',
+                               path], capture_output=True, text=True,
+                              check=True).stdout.strip()
+        os.makedirs(self.byid_dir, exist_ok=True)
+        link = os.path.join(self.byid_dir, 'nvme-Amazon_Elastic_Block_Store_'
+                            + volume['VolumeId'].replace('-', ''))
+        os.symlink(loop, link)
+        state['devices'][volume['VolumeId']] = (loop, link)
+
+    def _loop_detach(self, state, volume):
+        loop, link = state['devices'].pop(volume['VolumeId'])
+        os.remove(link)
+        subprocess.run(['losetup', '-d', loop], check=True)
+
+    def AttachVolume(self, state, region, params):
+        volume = self._find(state['volumes'], [params['VolumeId']],
+                            'InvalidVolume.NotFound')[0]
+        if volume['State'] != 'available':
+            raise StandInError('IncorrectState',
+                               f"volume {volume['VolumeId']} is "
+                               f"{volume['State']}")
+
+        attachment = {'VolumeId': volume['VolumeId'],
+                      'InstanceId': params['InstanceId'],
+                      'Device': params['Device'], 'State': 'attaching',
+                      'AttachTime': time.time()}
+        volume['State'] = 'in-use'
+        volume['Attachments'] = [attachment]
+        self._transition(attachment, 'attached', self.latency['attach'])
+        if self.loop:
+            self._loop_attach(state, volume)
+        return attachment
+
+    def DetachVolume(self, state, region, params):
+        volume = self._find(state['volumes'], [params['VolumeId']],
+                            'InvalidVolume.NotFound')[0]
+        if not volume['Attachments']:
+            raise StandInError('IncorrectState',
+                               f"volume {volume['VolumeId']} is not "
+                               "attached")
+
+        attachment = volume['Attachments'][0]
+        attachment['State'] = 'detaching'
+        if volume['VolumeId'] in state['devices']:
+            self._loop_detach(state, volume)
+        self._transition(volume, 'available', self.latency['detach'])
+        return attachment
+
+    def DeleteVolume(self, state, region, params):
+        volume = self._find(state['volumes'], [params['VolumeId']],
+                            'InvalidVolume.NotFound')[0]
+        if volume['State'] != 'available':
+            raise StandInError('VolumeInUse',
+                               f"volume {volume['VolumeId']} is in use")
+        del state['volumes'][volume['VolumeId']]
+        return {}
+
+    def DescribeInstances(self, state, region, params):
+        instances = []
+        for instance_id in params.get('InstanceIds', []):
+            mappings = [{'DeviceName': '/dev/xvda',
+                         'Ebs': {'VolumeId': 'vol-root',
+                                 'Status': 'attached'}}]
+            for volume in state['volumes'].values():
+                self._refresh(volume)
+                for attachment in volume['Attachments']:
+                    if volume['State'] == 'in-use' and \
+                            attachment['InstanceId'] == instance_id:
+                        mappings.append({
+                            'DeviceName': attachment['Device'],
+                            'Ebs': {'VolumeId': volume['VolumeId'],
+                                    'Status': 'attached'}})
+            instances.append({'InstanceId': instance_id,
+                              'BlockDeviceMappings': mappings})
+
+        return {'Reservations': [{'Instances': instances}]}
+
+    # images
+
+    def RegisterImage(self, state, region, params):
+        for mapping in params.get('BlockDeviceMappings', []):
+            snapshot_id = mapping.get('Ebs', {}).get('SnapshotId')
+            if snapshot_id:
+                self._find(self._snapshots(state, region), [snapshot_id],
+                           'InvalidSnapshot.NotFound')
+
+        if any(i['Name'] == params['Name']
+               for i in state['images'].values()):
+            raise StandInError('InvalidAMIName.Duplicate',
+                               f"AMI name {params['Name']} is already in "
+                               "use")
+
+        image = {'ImageId': self._new_id('ami'), 'Name': params['Name'],
+                 'State': 'pending', 'OwnerId': OWNER_ID,
+                 'CreationDate': _iso_time(time.time()),
+                 'Architecture': params.get('Architecture'),
+                 'Description': params.get('Description'),
+                 'RootDeviceName': params.get('RootDeviceName'),
+                 'VirtualizationType': params.get('VirtualizationType'),
+                 'EnaSupport': params.get('EnaSupport'),
+                 'BlockDeviceMappings': params.get('BlockDeviceMappings'),
+                 'Tags': []}
+        for spec in params.get('TagSpecifications', []):
+            image['Tags'] += spec.get('Tags', [])
+        self._transition(image, 'available', self.latency['register'])
+        state['images'][image['ImageId']] = image
+        return {'ImageId': image['ImageId']}
+
+    def CopyImage(self, state, region, params):
+        # a repeated token returns the first copy, like EC2's idempotency
+        tokens = state['tokens']
+        if params.get('ClientToken') in tokens:
+            return {'ImageId': tokens[params['ClientToken']]}
+
+        source = self._find(self.region(params['SourceRegion'])['images'],
+                            [params['SourceImageId']],
+                            'InvalidAMIID.NotFound')[0]
+        if source['State'] == 'failed':
+            raise StandInError('IncorrectState',
+                               f"image {source['ImageId']} is failed")
+
+        self.copy_times.append(time.monotonic())
+        image = dict(source, ImageId=self._new_id('ami'),
+                     Name=params['Name'], State='pending', Tags=[],
+                     Description=params.get('Description'),
+                     CreationDate=_iso_time(time.time()),
+                     BlockDeviceMappings=[])
+
+        # the copy is backed by its own snapshots in the destination region
+        for mapping in source.get('BlockDeviceMappings') or []:
+            mapping = dict(mapping)
+            if mapping.get('Ebs', {}).get('SnapshotId'):
+                snapshot = {'SnapshotId': self._new_id('snap'),
+                            'State': 'pending', 'StartTime': time.time(),
+                            'Progress': '0%', 'OwnerId': OWNER_ID,
+                            'VolumeSize': mapping['Ebs'].get('VolumeSize'),
+                            'Description': f"Copied for {image['ImageId']}",
+                            'Tags': []}
+                self._transition(snapshot, 'completed',
+                                 self.latency['copy'])
+                state['snapshots'][snapshot['SnapshotId']] = snapshot
+                mapping['Ebs'] = dict(mapping['Ebs'],
+                                      SnapshotId=snapshot['SnapshotId'])
+            image['BlockDeviceMappings'].append(mapping)
+        for spec in params.get('TagSpecifications', []):
+            image['Tags'] += spec.get('Tags', [])
+        if self.random.random() < self.fail_copy:
+            image['StateReason'] = {'Code': 'Server.InternalError',
+                                    'Message': 'injected failure'}
+            self._transition(image, 'failed', self.latency['copy'])
+        else:
+            self._transition(image, 'available', self.latency['copy'])
+        state['images'][image['ImageId']] = image
+        if params.get('ClientToken'):
+            tokens[params['ClientToken']] = image['ImageId']
+        return {'ImageId': image['ImageId']}
+
+    def DescribeImages(self, state, region, params):
+        images = self._find(state['images'], params.get('ImageIds'),
+                            'InvalidAMIID.NotFound')
+        fields = {'state': 'State', 'name': 'Name', 'image-id': 'ImageId',
+                  'creation-date': 'CreationDate'}
+        return {'Images': [i for i in images if
+                           _matches(i, params.get('Filters'), fields)]}
+
+    def DeregisterImage(self, state, region, params):
+        image = self._find(state['images'], [params['ImageId']],
+                           'InvalidAMIID.NotFound')[0]
+        del state['images'][image['ImageId']]
+        return {}
+
+    def ModifyImageAttribute(self, state, region, params):
+        image = self._find(state['images'], [params['ImageId']],
+                           'InvalidAMIID.NotFound')[0]
+        if image['State'] == 'failed':
+            raise StandInError('IncorrectState',
+                               f"image {image['ImageId']} is failed")
+        return {}
+
+    # tags
+
+    def CreateTags(self, state, region, params):
+        resources = dict(state['images'], **state['volumes'])
+        resources.update(state['snapshots'])
+        for snapshot in self.store.snapshots.values():
+            resources.setdefault(snapshot['SnapshotId'], snapshot)
+
+        for resource_id in params['Resources']:
+            if resource_id not in resources:
+                raise StandInError('InvalidID',
+                                   f"The ID '{resource_id}' is not valid")
+            resource = resources[resource_id]
+            tags = dict(_tags(resource), **_tags(params))
+            resource['Tags'] = [{'Key': k, 'Value': v}
+                                for k, v in tags.items()]
+        return {}
+
+    def stats(self):
+        """Return {'calls': {action: count}, 'copy_spread': seconds}"""
+        with self.lock:
+            calls = Counter()
+            for (region, action), count in self.calls.items():
+                calls[action] += count
+            spread = max(self.copy_times) - min(self.copy_times) \
+                if self.copy_times else 0
+
+        return {'calls': dict(calls), 'copy_spread': round(spread, 3)}
+
+
+def _region(headers):
+    m = re.search(r'Credential=[^/]+/\d+/([^/]+)/',
+                  headers.get('Authorization', ''))
+    return m.group(1) if m else 'us-east-1'
+
+
+class Handler(ebs_blockstore.Handler):
+    ec2 = None
+
+    def do_POST(self):
+        if self.path != '/':
+            return ebs_blockstore.Handler.do_POST(self)
+
+        body = self._body().decode()
+        query = {k: v[0] for k, v in parse_qs(body).items()}
+        try:
+            data = self.ec2.handle(_region(self.headers), query)
+        except StandInError as e:
+            root = ElementTree.Element('Response')
+            error = ElementTree.SubElement(
+                ElementTree.SubElement(root, 'Errors'), 'Error')
+            ElementTree.SubElement(error, 'Code').text = e.code
+            ElementTree.SubElement(error, 'Message').text = str(e)
+            ElementTree.SubElement(root, 'RequestID').text = \
+                str(uuid.uuid4())
+            return self._send(e.status, data=ElementTree.tostring(root),
+                              headers={'Content-Type': 'text/xml'})
+
+        self._send(200, data=data, headers={'Content-Type': 'text/xml'})
+
+    def start_snapshot(self, query):
+        params = json.loads(self._body() or b'{}')
+        snapshot = self.store.start(params)
+        self.store.get(snapshot['SnapshotId'])['Region'] = \
+            _region(self.headers)
+        self._send(201, snapshot)
+
+    def complete_snapshot(self, query, snapshot_id):
+        ebs_blockstore.Handler.complete_snapshot(self, query, snapshot_id)
+        snapshot = self.store.get(snapshot_id)
+        if snapshot['Status'] == 'completed':
+            snapshot['Completed'] = time.monotonic()
+
+
+def serve(port=8766, path=None, address='127.0.0.1', **kwargs):
+    """Return started server (daemon thread); server.ec2 is its state.
+
+    kwargs are passed to Ec2StandIn (latency, throttle, fail_copy, ...)
+    """
+    path = path if path else tempfile.mkdtemp(prefix='ec2-standin.')
+    store = ebs_blockstore.BlockStore(path)
+    ec2 = Ec2StandIn(store, **kwargs)
+    handler = type('Handler', (Handler,), {'store': store, 'ec2': ec2})
+    server = ebs_blockstore.ThreadingHTTPServer((address, port), handler)
+    server.ec2 = ec2
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    return server
+
+
+def main():
+    try:
+        l_opts = ["help", "port=", "dir=", "latency=", "throttle=",
+                  "request-rate=", "fail-copy=", "loop", "byid-dir="]
+        opts, args = getopt.gnu_getopt(sys.argv[1:], "h", l_opts)
+    except getopt.GetoptError as e:
+        usage(e)
+
+    port = 8766
+    path = None
+    kwargs = {'latency': {}}
+    for opt, val in opts:
+        if opt in ('-h', '--help'):
+            usage()
+
+        if opt == "--port":
+            port = int(val)
+
+        if opt == "--dir":
+            path = val
+            os.makedirs(path, exist_ok=True)
+
+        if opt == "--latency":
+            name, seconds = val.split('=', 1)
+            if name not in LATENCY:
+                usage(f"unknown latency: {name}")
+            kwargs['latency'][name] = float(seconds)
+
+        if opt == "--throttle":
+            kwargs['throttle'] = float(val)
+
+        if opt == "--request-rate":
+            kwargs['request_rate'] = float(val)
+
+        if opt == "--fail-copy":
+            kwargs['fail_copy'] = float(val)
+
+        if opt == "--loop":
+            kwargs['loop'] = True
+
+        if opt == "--byid-dir":
+            kwargs['byid_dir'] = val
+
+    if args:
+        usage("incorrect number of arguments")
+
+    if kwargs.get('loop') and not kwargs.get('byid_dir'):
+        usage("--loop requires --byid-dir")
+
+    server = serve(port, path, **kwargs)
+    url = f"http://127.0.0.1:{server.server_port}"
+    print(f"EC2_ENDPOINT_URL={url}")
+    print(f"EBS_ENDPOINT_URL={url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,321 @@
+#!/usr/bin/python3
+# Copyright (c) 2011-2026 TurnKey GNU/Linux - http://www.turnkeylinux.org
+#
+# This file is part of buildtasks.
+#
+# Buildtasks is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+
+"""
+Build bootable raw disk image from rootfs (no mounts or loop devices)
+
+The image is a sparse file; partitions are written with sfdisk, the root
+filesystem is created and populated in one pass (mkfs.ext4 -d) at the
+partition's offset, and GRUB's core image is embedded with grub-bios-setup
+along with a generated /boot/grub/grub.cfg (written with debugfs).
+
+Arguments:
+
+    rootfs          Path to rootfs
+    image           Path of image to create
+
+Options:
+
+    --size=         Image size with K, M or G suffix (default: size of
+                    rootfs plus 25%)
+    --layout=       Partition layout (default: gpt)
+
+                    gpt:    BIOS boot partition (GRUB) + root partition
+                    msdos:  single bootable root partition, GRUB embedded
+                            after the MBR
+                    none:   filesystem only, no partitions or bootloader
+
+    --fs-label=     Root filesystem label (default: rootfs)
+    --cmdline=      Extra kernel command line (appended to the rootfs'
+                    GRUB_CMDLINE_LINUX and GRUB_CMDLINE_LINUX_DEFAULT)
+
+"""
+import os
+import re
+import sys
+import json
+import uuid
+import getopt
+import shutil
+import tempfile
+import subprocess
+
+import utils
+
+log = utils.get_logger('image-builder')
+
+SECTOR = 512
+MiB = 1024 ** 2
+
+BIOS_BOOT_GUID = '21686148-6449-6E6F-744E-656564454649'
+LINUX_FS_GUID = '0FC63DAF-8483-4772-8E79-3D69D8477DE4'
+
+LAYOUTS = {
+    'gpt': ('label: gpt\n'
+            f'start=1MiB, size=2MiB, type={BIOS_BOOT_GUID}, name=grub\n'
+            f'start=3MiB, type={LINUX_FS_GUID}, name=rootfs\n'),
+    'msdos': ('label: dos\n'
+              'start=1MiB, type=83, bootable\n'),
+    'none': None,
+}
+
+# embedded in core.img, so GRUB needs nothing from /boot/grub/i386-pc to
+# boot (the rootfs' grub.cfg may insmod any of these)
+GRUB_MODULES = ['biosdisk', 'part_gpt', 'part_msdos', 'ext2', 'search',
+                'search_fs_uuid', 'search_label', 'normal', 'linux', 'echo',
+                'test', 'configfile', 'gzio', 'loadenv', 'all_video',
+                'serial', 'terminal']
+
+
+def fatal(e):
+    print("error: " + str(e), file=sys.stderr)
+    sys.exit(1)
+
+
+def usage(e=None):
+    if e:
+        print("error: " + str(e), file=sys.stderr)
+
+    print("Syntax: %s [ -options ] rootfs image" % (sys.argv[0]),
+          file=sys.stderr)
+    print(__doc__.strip(), file=sys.stderr)
+
+    sys.exit(1)
+
+
+class ImageBuilderError(Exception):
+    pass
+
+
+def parse_size(size):
+    """Return bytes of e.g., '10G', '512M', '1048576K' or '4096'"""
+    m = re.fullmatch(r'(\d+)([KMG]?)i?B?', size.strip(), re.IGNORECASE)
+    if not m:
+        raise ImageBuilderError(f"invalid size: {size}")
+
+    number, unit = m.groups()
+    return int(number) * 1024 ** ' KMG'.index(unit.upper() or ' ')
+
+
+def rootfs_size(rootfs):
+    output = subprocess.run(['du', '-s', '-B1', rootfs], capture_output=True,
+                            text=True, check=True).stdout
+    return int(output.split()[0])
+
+
+def _version_key(path):
+    return [int(part) if part.isdigit() else part
+            for part in re.split(r'(\d+)', path)]
+
+
+def find_kernel(rootfs):
+    """Return (vmlinuz, initrd) paths relative to rootfs /boot"""
+    boot = os.path.join(rootfs, 'boot')
+    kernels = [name for name in os.listdir(boot)
+               if name.startswith('vmlinuz-')]
+    if not kernels:
+        raise ImageBuilderError(f"no kernel found in {boot}")
+
+    kernel = sorted(kernels, key=_version_key)[-1]
+    initrd = 'initrd.img-' + kernel[len('vmlinuz-'):]
+    if not os.path.exists(os.path.join(boot, initrd)):
+        raise ImageBuilderError(f"no initrd found for {kernel}")
+
+    return '/boot/' + kernel, '/boot/' + initrd
+
+
+def get_cmdline(rootfs):
+    """Kernel command line configured in rootfs' /etc/default/grub"""
+    files = [os.path.join(rootfs, 'etc/default/grub')]
+    grub_d = os.path.join(rootfs, 'etc/default/grub.d')
+    if os.path.isdir(grub_d):
+        files += sorted(os.path.join(grub_d, name)
+                        for name in os.listdir(grub_d)
+                        if name.endswith('.cfg'))
+
+    script = ''.join(f'. "{path}"\n' for path in files
+                     if os.path.exists(path))
+    script += 'echo "$GRUB_CMDLINE_LINUX $GRUB_CMDLINE_LINUX_DEFAULT"'
+    return subprocess.run(['sh', '-c', script], capture_output=True,
+                          text=True, check=True).stdout.strip()
+
+
+def grub_config(rootfs, fs_uuid, cmdline=None):
+    kernel, initrd = find_kernel(rootfs)
+    cmdline = ' '.join(filter(None, [get_cmdline(rootfs), cmdline]))
+    try:
+        title = utils.get_turnkey_version(rootfs)
+    except FileNotFoundError:
+        title = 'GNU/Linux'
+
+    return (f"set timeout=1\n"
+            f"search --no-floppy --fs-uuid --set=root {fs_uuid}\n"
+            f"menuentry '{title}' {{\n"
+            f"    linux {kernel} root=UUID={fs_uuid} ro {cmdline}\n"
+            f"    initrd {initrd}\n"
+            f"}}\n")
+
+
+def partition(image, layout):
+    """Partition image; returns (offset, size) in bytes of root partition"""
+    subprocess.run(['sfdisk', '--quiet', image], input=LAYOUTS[layout],
+                   text=True, check=True)
+    table = json.loads(subprocess.run(['sfdisk', '--json', image],
+                                      capture_output=True, text=True,
+                                      check=True).stdout)
+    root = table['partitiontable']['partitions'][-1]
+    return root['start'] * SECTOR, root['size'] * SECTOR
+
+
+def mkfs(rootfs, image, offset, size, fs_uuid, fs_label):
+    log.debug(f'mkfs.ext4 -d {rootfs} - offset {offset} size {size}')
+    subprocess.run(['mkfs.ext4', '-F', '-q', '-t', 'ext4', '-d', rootfs,
+                    '-U', fs_uuid, '-L', fs_label, '-E', f'offset={offset}',
+                    image, f'{size // 1024}k'], check=True)
+
+
+def write_file(image, offset, path, data):
+    """Write data to path in (unmounted) filesystem at offset of image"""
+    with tempfile.NamedTemporaryFile('w') as fob:
+        fob.write(data)
+        fob.flush()
+
+        # commands that fail (e.g., mkdir of existing dir) don't stop debugfs
+        parents = []
+        parent = os.path.dirname(path)
+        while parent != '/':
+            parents.insert(0, parent)
+            parent = os.path.dirname(parent)
+
+        commands = [f'mkdir {parent}' for parent in parents]
+        commands += [f'rm {path}', f'write {fob.name} {path}',
+                     f'sif {path} uid 0', f'sif {path} gid 0',
+                     f'sif {path} mode 0100644']
+        subprocess.run(['debugfs', '-w', '-f', '-',
+                        f'{image}?offset={offset}'],
+                       input='\n'.join(commands) + '\n', text=True,
+                       capture_output=True, check=True)
+
+    # nor does a failed write, so read the file back
+    result = subprocess.run(['debugfs', '-R', f'cat {path}',
+                             f'{image}?offset={offset}'],
+                            capture_output=True, text=True, check=True)
+    if result.stdout != data:
+        raise ImageBuilderError(f"failed to write {path} to {image}: "
+                                f"{result.stderr.strip()}")
+
+
+def install_grub(rootfs, image, layout):
+    """Embed GRUB core image (built from rootfs' GRUB) into image"""
+    moddir = os.path.join(rootfs, 'usr/lib/grub/i386-pc')
+    if not os.path.isdir(moddir):
+        moddir = '/usr/lib/grub/i386-pc'
+
+    prefix = {'gpt': '(hd0,gpt2)', 'msdos': '(hd0,msdos1)'}[layout]
+    tmpdir = tempfile.mkdtemp(prefix='image-builder.')
+    try:
+        shutil.copy(os.path.join(moddir, 'boot.img'), tmpdir)
+        subprocess.run(['grub-mkimage', '-O', 'i386-pc', '-d', moddir,
+                        '-o', os.path.join(tmpdir, 'core.img'),
+                        '-p', prefix + '/boot/grub'] + GRUB_MODULES,
+                       check=True)
+
+        devicemap = os.path.join(tmpdir, 'device.map')
+        with open(devicemap, 'w') as fob:
+            fob.write(f'(hd0) {os.path.abspath(image)}\n')
+
+        subprocess.run(['grub-bios-setup', '--skip-fs-probe',
+                        '--directory', tmpdir, '--device-map', devicemap,
+                        os.path.abspath(image)], check=True)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def build_image(rootfs, image, size=None, layout='gpt', fs_label='rootfs',
+                cmdline=None):
+    """Build raw disk image from rootfs; returns root filesystem UUID.
+
+    Runs without root privileges beyond read access to rootfs: nothing is
+    mounted and no loop or device-mapper devices are used, so several
+    images can be built concurrently on one host.
+    """
+    if layout not in LAYOUTS:
+        raise ImageBuilderError(f"unknown layout: {layout}")
+
+    size = size if size else rootfs_size(rootfs) * 5 // 4
+    size = -(-size // MiB) * MiB
+    fs_uuid = str(uuid.uuid4())
+
+    log.info(f'creating {size // MiB}MiB sparse {layout} image - {image}')
+    with open(image, 'wb') as fob:
+        fob.truncate(size)
+
+    try:
+        if layout == 'none':
+            offset, fs_size = 0, size
+        else:
+            offset, fs_size = partition(image, layout)
+
+        log.info(f'creating filesystem from {rootfs}')
+        mkfs(rootfs, image, offset, fs_size, fs_uuid, fs_label)
+
+        if layout != 'none':
+            log.info('installing GRUB')
+            config = grub_config(rootfs, fs_uuid, cmdline)
+            write_file(image, offset, '/boot/grub/grub.cfg', config)
+            install_grub(rootfs, image, layout)
+    except BaseException:
+        os.remove(image)
+        raise
+
+    return fs_uuid
+
+
+def main():
+    try:
+        l_opts = ["help", "size=", "layout=", "fs-label=", "cmdline="]
+        opts, args = getopt.gnu_getopt(sys.argv[1:], "h", l_opts)
+    except getopt.GetoptError as e:
+        usage(e)
+
+    kwargs = {}
+    for opt, val in opts:
+        if opt in ('-h', '--help'):
+            usage()
+
+        if opt == "--size":
+            kwargs['size'] = parse_size(val)
+
+        if opt == "--layout":
+            kwargs['layout'] = val
+
+        if opt == "--fs-label":
+            kwargs['fs_label'] = val
+
+        if opt == "--cmdline":
+            kwargs['cmdline'] = val
+
+    if len(args) != 2:
+        usage("incorrect number of arguments")
+
+    rootfs, image = args
+    if not os.path.isdir(rootfs):
+        fatal(f"rootfs path does not exist: {rootfs}")
+
+    try:
+        fs_uuid = build_image(rootfs, image, **kwargs)
+    except (ImageBuilderError, subprocess.CalledProcessError) as e:
+        fatal(e)
+
+    print(image, fs_uuid)
+
+
+if __name__ == "__main__":
+    main()
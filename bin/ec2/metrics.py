@@ -0,0 +1,201 @@
+# Copyright (c) 2011-2026 TurnKey GNU/Linux - http://www.turnkeylinux.org
+#
+# This file is part of buildtasks.
+#
+# Buildtasks is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+
+"""AWS API call and waiter instrumentation
+
+Every client created by utils.connect() is instrumented through botocore
+events: each call records operation, region, latency, retries and
+throttling errors. Waiters record the time spent waiting separately, and
+calls made while polling are marked so they aren't counted twice.
+
+Records are appended to LOGFILE_PATH as JSON lines (if set); report()
+summarizes them at the end of the run.
+"""
+
+import os
+import json
+import time
+import threading
+
+THROTTLE_CODES = ('RequestLimitExceeded', 'Throttling',
+                  'ThrottlingException', 'TooManyRequestsException',
+                  'RequestThrottled', 'SlowDown')
+
+# upper bounds (seconds) of the latency histogram buckets
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, float('inf'))
+
+_calls = []
+_waits = []
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def _write(entry):
+    logfile = os.environ.get('LOGFILE_PATH')
+    if logfile:
+        with _lock:
+            with open(logfile, 'a') as fob:
+                fob.write(json.dumps(entry) + '\n')
+
+
+def record_call(service, region, operation, latency, retries=0,
+                throttles=0, error=None):
+    entry = {'type': 'aws-call', 'time': time.time(), 'service': service,
+             'region': region, 'operation': operation,
+             'latency': round(latency, 4), 'retries': retries,
+             'throttles': throttles, 'error': error,
+             'in_wait': in_wait()}
+    with _lock:
+        _calls.append(entry)
+    _write(entry)
+
+
+def record_wait(desc, elapsed, error=None):
+    entry = {'type': 'wait', 'time': time.time(), 'desc': desc,
+             'elapsed': round(elapsed, 3), 'error': error}
+    with _lock:
+        _waits.append(entry)
+    _write(entry)
+
+
+class waiting:
+    """Context marking API calls in this thread as made by a waiter"""
+
+    def __enter__(self):
+        self.previous = getattr(_local, 'waiting', False)
+        _local.waiting = True
+
+    def __exit__(self, *exc):
+        _local.waiting = self.previous
+
+
+def in_wait():
+    """Return True if API calls in this thread are made by a waiter"""
+    return getattr(_local, 'waiting', False)
+
+
+def _error_code(response):
+    if not response:
+        return None
+    return response.get('Error', {}).get('Code')
+
+
+def instrument(client):
+    """Register event handlers recording each call made by client"""
+    service = client.meta.service_model.service_name
+    region = client.meta.region_name
+
+    def before_call(model, context, **kwargs):
+        context['metrics_operation'] = model.name
+        context['metrics_started'] = time.monotonic()
+        context['metrics_throttles'] = 0
+
+    def needs_retry(response, request_dict, **kwargs):
+        # response is (http_response, parsed) or None on connection errors
+        if response and _error_code(response[1]) in THROTTLE_CODES:
+            context = request_dict.get('context', {})
+            context['metrics_throttles'] = \
+                context.get('metrics_throttles', 0) + 1
+
+    def finish(context, parsed, error=None):
+        started = context.get('metrics_started')
+        if started is None:
+            return
+
+        metadata = parsed.get('ResponseMetadata', {}) if parsed else {}
+        record_call(service, region, context['metrics_operation'],
+                    time.monotonic() - started,
+                    metadata.get('RetryAttempts', 0),
+                    context.get('metrics_throttles', 0), error)
+
+    def after_call(context, parsed, **kwargs):
+        finish(context, parsed, _error_code(parsed))
+
+    # emitted (without the operation model) when the request itself failed,
+    # e.g., on connection errors
+    def after_call_error(context, exception, **kwargs):
+        parsed = getattr(exception, 'response', None)
+        error = _error_code(parsed) or type(exception).__name__
+        finish(context, parsed, error)
+
+    events = client.meta.events
+    events.register('before-call', before_call)
+    events.register('needs-retry', needs_retry)
+    events.register('after-call', after_call)
+    events.register('after-call-error', after_call_error)
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def histogram(latencies):
+    """Return [(bucket upper bound, count)] of latencies"""
+    counts = [0] * len(BUCKETS)
+    for latency in latencies:
+        for i, bound in enumerate(BUCKETS):
+            if latency <= bound:
+                counts[i] += 1
+                break
+
+    return list(zip(BUCKETS, counts))
+
+
+def summary():
+    """Return list of summary lines, or [] if nothing was recorded"""
+    with _lock:
+        calls = list(_calls)
+        waits = list(_waits)
+
+    if not calls and not waits:
+        return []
+
+    api = [c for c in calls if not c['in_wait']]
+    polls = [c for c in calls if c['in_wait']]
+    lines = [f"aws api: {len(api)} calls "
+             f"{sum(c['latency'] for c in api):.1f}s, "
+             f"{sum(c['retries'] for c in calls)} retries, "
+             f"{sum(c['throttles'] for c in calls)} throttled, "
+             f"{len([c for c in calls if c['error']])} errors; "
+             f"waiters: {len(waits)} waits "
+             f"{sum(w['elapsed'] for w in waits):.1f}s "
+             f"({len(polls)} polls)"]
+
+    operations = {}
+    for call in calls:
+        key = (call['operation'], call['region'])
+        operations.setdefault(key, []).append(call)
+
+    for (operation, region), op_calls in sorted(operations.items()):
+        latencies = [c['latency'] for c in op_calls]
+        throttles = sum(c['throttles'] for c in op_calls)
+        lines.append(f"  {operation} ({region}): {len(op_calls)} calls "
+                     f"p50={_percentile(latencies, 0.5):.2f}s "
+                     f"p90={_percentile(latencies, 0.9):.2f}s "
+                     f"max={max(latencies):.2f}s"
+                     + (f" throttled={throttles}" if throttles else ''))
+
+    if calls:
+        lines.append('latency histogram:')
+        buckets = histogram([c['latency'] for c in calls])
+        while not buckets[-1][1]:
+            buckets.pop()
+        most = max(count for bound, count in buckets)
+        for bound, count in buckets:
+            label = f'<={bound:g}s' if bound != float('inf') else '>30s'
+            bar = '#' * (count * 40 // most) if most else ''
+            lines.append(f'  {label:>8} {count:6d} {bar}')
+
+    return lines
+
+
+def report(log):
+    for line in summary():
+        log.info(line)
@@ -0,0 +1,225 @@
+# Copyright (c) 2011-2026 TurnKey GNU/Linux - http://www.turnkeylinux.org
+#
+# This file is part of buildtasks.
+#
+# Buildtasks is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+
+"""Client-side rate limiting of AWS API calls
+
+Every client created by utils.connect() takes a token from a shared
+bucket before each request is sent (retries included). Like EC2's own
+request token buckets, there is one bucket per region and API category
+(e.g., describe vs. mutating calls), so a burst of polling can't eat
+into the budget for attaching volumes or registering images.
+
+Buckets adapt to throttling: a throttled response halves the bucket's
+refill rate (at most once per second, down to RATE_FLOOR of its
+configured rate) and empties it; each successful call then recovers a
+little of the rate until it is back to the configured rate.
+
+When calls are queued for a bucket, tokens go to the most urgent first.
+Priority only orders calls within a bucket: attach, register, copy, ...
+(URGENT_OPERATIONS) go ahead of other mutating calls such as tagging,
+and describe calls made by a build step go ahead of waiter polls (see
+metrics.waiting). Mutating calls never queue behind polls, as those
+take tokens from the describe bucket.
+
+BT_AWS_RATE_SCALE scales all configured rates (e.g., 0.5 when two
+builders share an account).
+"""
+
+import os
+import time
+import heapq
+import itertools
+import threading
+
+import metrics
+
+# priorities (lower goes first)
+URGENT = 0
+NORMAL = 1
+POLL = 2
+
+# mutating calls a build step is blocked on (ahead of e.g., CreateTags in
+# the same bucket)
+URGENT_OPERATIONS = ('AttachVolume', 'DetachVolume', 'CreateVolume',
+                     'CreateSnapshot', 'RegisterImage', 'CopyImage',
+                     'StartSnapshot', 'CompleteSnapshot')
+
+# (service, category): (refill rate per second, burst); kept below the
+# documented account limits, as other tools may share the account
+RATES = {
+    ('ec2', 'describe'): (20, 50),
+    ('ec2', 'mutate'): (5, 20),
+    ('ebs', 'block'): (500, 500),
+    ('ebs', 'control'): (10, 20),
+    ('s3', 'object'): (200, 200),
+}
+
+RATE_SCALE = float(os.environ.get('BT_AWS_RATE_SCALE', 1))
+
+# throttling never slows a bucket below this fraction of its rate
+RATE_FLOOR = 0.05
+
+# fraction of the configured rate recovered per successful call
+RECOVERY = 0.02
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def category(service, operation):
+    if service == 'ebs':
+        if operation in ('PutSnapshotBlock', 'GetSnapshotBlock'):
+            return 'block'
+        return 'control'
+
+    if service == 's3':
+        return 'object'
+
+    if operation.startswith(('Describe', 'Get', 'List')):
+        return 'describe'
+    return 'mutate'
+
+
+def priority(operation):
+    if operation in URGENT_OPERATIONS:
+        return URGENT
+    if metrics.in_wait():
+        return POLL
+    return NORMAL
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.backoff_until = 0
+        self.queue = []
+        self.tickets = itertools.count()
+        self.cond = threading.Condition()
+
+        self.delayed = 0
+        self.delay = 0
+        self.throttles = 0
+
+    def _refill(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, priority=NORMAL):
+        """Block until a token is available; returns seconds waited"""
+        started = time.monotonic()
+        ticket = (priority, next(self.tickets))
+        with self.cond:
+            heapq.heappush(self.queue, ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if self.queue[0] != ticket:
+                        self.cond.wait()
+                    elif self.tokens < 1:
+                        self.cond.wait((1 - self.tokens) / self.rate)
+                    else:
+                        break
+            except BaseException:
+                self.queue.remove(ticket)
+                heapq.heapify(self.queue)
+                self.cond.notify_all()
+                raise
+
+            heapq.heappop(self.queue)
+            self.tokens -= 1
+            self.cond.notify_all()
+
+            waited = time.monotonic() - started
+            if waited > 0.001:
+                self.delayed += 1
+                self.delay += waited
+            return waited
+
+    def throttled(self):
+        with self.cond:
+            self.throttles += 1
+            now = time.monotonic()
+            if now < self.backoff_until:
+                return
+
+            self._refill(now)
+            self.rate = max(self.rate / 2, self.max_rate * RATE_FLOOR)
+            self.tokens = min(self.tokens, 0)
+            self.backoff_until = now + 1
+
+    def succeeded(self):
+        if self.rate < self.max_rate:
+            with self.cond:
+                self._refill(time.monotonic())
+                self.rate = min(self.rate + self.max_rate * RECOVERY,
+                                self.max_rate)
+
+
+def get_bucket(service, region, category):
+    key = (service, region, category)
+    with _buckets_lock:
+        if key not in _buckets:
+            default = RATES[('ec2', 'mutate')]
+            rate, burst = RATES.get((service, category), default)
+            _buckets[key] = TokenBucket(rate * RATE_SCALE,
+                                        max(burst * RATE_SCALE, 1))
+        return _buckets[key]
+
+
+def instrument(client):
+    """Register event handlers rate limiting each request of client"""
+    service = client.meta.service_model.service_name
+    region = client.meta.region_name
+
+    def before_send(event_name, **kwargs):
+        operation = event_name.rsplit('.', 1)[-1]
+        bucket = get_bucket(service, region, category(service, operation))
+        bucket.acquire(priority(operation))
+
+    def needs_retry(response, operation, **kwargs):
+        # response is (http_response, parsed) or None on connection errors
+        if not response:
+            return
+
+        bucket = get_bucket(service, region,
+                            category(service, operation.name))
+        code = response[1].get('Error', {}).get('Code')
+        if code in metrics.THROTTLE_CODES:
+            bucket.throttled()
+        elif code is None:
+            bucket.succeeded()
+
+    events = client.meta.events
+    events.register('before-send', before_send)
+    events.register('needs-retry', needs_retry)
+
+
+def summary():
+    """Return list of summary lines, or [] if no call was held back"""
+    with _buckets_lock:
+        buckets = sorted(_buckets.items())
+
+    lines = []
+    for (service, region, category), bucket in buckets:
+        if not (bucket.delayed or bucket.throttles):
+            continue
+        lines.append(f"  {service} {category} ({region}): "
+                     f"{bucket.delayed} delayed {bucket.delay:.1f}s, "
+                     f"{bucket.throttles} throttled, rate "
+                     f"{bucket.rate:.1f}/{bucket.max_rate:.1f}/s")
+
+    if lines:
+        lines.insert(0, 'rate limit:')
+    return lines
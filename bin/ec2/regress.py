@@ -0,0 +1,347 @@
+#!/usr/bin/python3
+# Copyright (c) 2011-2026 TurnKey GNU/Linux - http://www.turnkeylinux.org
+#
+# This file is part of buildtasks.
+#
+# Buildtasks is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+
+"""
+Regression tests for bin/ec2, against the local EC2/EBS stand-in
+
+Needs no AWS account, credentials or root: AWS calls go to a fresh
+ec2_standin.py server (with short latencies) and local tests work in a
+temporary directory. Exits non-zero if any test fails.
+
+Arguments:
+
+    test            Name of test to run (repeatable, default: all)
+
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import threading
+
+import utils
+import waiter
+import ebs_direct
+import ec2_copy
+import ec2_standin
+import ec2_replicate
+
+from ec2_copy import Image
+from ebs_register import register
+
+IDENTITY = {'instanceId': 'i-0standin0000000', 'region': 'us-east-1',
+            'availabilityZone': 'us-east-1a'}
+
+# stand-in state transitions (seconds), much shorter than the defaults
+LATENCY = {'volume': 0.1, 'attach': 0.1, 'detach': 0.1, 'snapshot': 0.3,
+           'register': 0.2, 'copy': 0.3}
+
+REGION = IDENTITY['region']
+
+TMPDIR = None
+
+
+class TestFailure(Exception):
+    pass
+
+
+def info(msg):
+    print(f'INFO [{os.path.basename(sys.argv[0])}]: {msg}')
+
+
+def check(condition, msg):
+    if not condition:
+        raise TestFailure(msg)
+
+
+def usage(e=None):
+    if e:
+        print("error: " + str(e), file=sys.stderr)
+
+    print("Syntax: %s [ test... ]" % (sys.argv[0]), file=sys.stderr)
+    print(__doc__.strip(), file=sys.stderr)
+    print("\nTests: " + ' '.join(TESTS), file=sys.stderr)
+
+    sys.exit(1)
+
+
+def new_snapshot():
+    conn = utils.connect(REGION)
+    volume_id = conn.create_volume(Size=1,
+                                   AvailabilityZone=REGION + 'a')['VolumeId']
+    return conn.create_snapshot(VolumeId=volume_id)['SnapshotId']
+
+
+def test_tracker():
+    tracker = waiter.Tracker({'snapshot': 0.1, 'image': 0.1})
+
+    snapshot_id = new_snapshot()
+    elapsed = tracker.wait('snapshot', REGION, snapshot_id, 'completed',
+                           timeout=10)
+    check(elapsed < 10, f'snapshot wait took {elapsed:.1f}s')
+
+    # a resource that never appears times out with its last state
+    try:
+        tracker.wait('snapshot', REGION, 'snap-0missing', 'completed',
+                     timeout=0.5)
+        raise TestFailure('wait for missing snapshot did not time out')
+    except waiter.WaiterTimeout:
+        pass
+
+    cancelled = threading.Event()
+    future = tracker.submit('snapshot', REGION, 'snap-0missing', 'completed',
+                            cancelled=cancelled)
+    time.sleep(0.3)
+    tracker.cancel(cancelled)
+    try:
+        future.result(5)
+        raise TestFailure('cancelled wait returned')
+    except waiter.WaiterCancelled:
+        pass
+
+    # cancelling one wait leaves the others running
+    check(tracker.wait('snapshot', REGION, snapshot_id, 'completed',
+                       timeout=5) is not None, 'tracker stopped working')
+
+    future = tracker.submit('snapshot', REGION, 'snap-0missing', 'completed')
+    time.sleep(0.3)
+    tracker.cancel()
+    try:
+        future.result(5)
+        raise TestFailure('wait survived cancelling all waits')
+    except waiter.WaiterCancelled:
+        pass
+
+
+def test_register():
+    snapshot_id = new_snapshot()
+    waiter.get_tracker().wait('snapshot', REGION, snapshot_id, 'completed',
+                              timeout=10)
+
+    tags = {utils.FINGERPRINT_TAG: 'regress'}
+    ami_id, name = register(snapshot_id, REGION, 'amd64', size=2,
+                            name='regress-register', tags=tags)
+    check(name == 'regress-register', f'unexpected name: {name}')
+
+    image = Image(ami_id, REGION).get()
+    devices = {m['DeviceName']: m for m in image['BlockDeviceMappings']}
+    root = devices[image['RootDeviceName']]['Ebs']
+    check(root['SnapshotId'] == snapshot_id,
+          f"root device snapshot: {root['SnapshotId']}")
+    check(root['VolumeSize'] == 2, f"root volume size: {root['VolumeSize']}")
+    check(image['VirtualizationType'] == 'hvm',
+          f"virtualization: {image['VirtualizationType']}")
+    check({t['Key']: t['Value'] for t in image.get('Tags', [])} == tags,
+          f"tags: {image.get('Tags')}")
+
+
+def test_replicate():
+    snapshot_id = new_snapshot()
+    waiter.get_tracker().wait('snapshot', REGION, snapshot_id, 'completed',
+                              timeout=10)
+    ami_id, name = register(snapshot_id, REGION, 'amd64',
+                            name='regress-replicate')
+    Image(ami_id, REGION).wait(timeout=10)
+
+    regions = [r for r in utils.get_all_regions() if r != REGION][:5]
+    tags = {utils.FINGERPRINT_TAG: 'regress-replicate'}
+    images = ec2_replicate.replicate(ami_id, name, REGION, regions,
+                                     timeout=60, fanout=2, tags=tags)
+
+    check([image.region for image in images] == regions,
+          'images not returned in region order')
+    for image in images:
+        check(image.state == 'available' and image.error is None,
+              f'{image.region}: {image.state} {image.error}')
+        check(image.source in [REGION] + regions,
+              f'{image.region}: copied from {image.source}')
+        copy_tags = image.get().get('Tags', [])
+        check({t['Key']: t['Value'] for t in copy_tags} == tags,
+              f'{image.region}: tags {copy_tags}')
+
+    ids = [image.id for image in images]
+    check(len(set(ids)) == len(ids), f'duplicate copies: {ids}')
+
+    # the fan-out tree copies from replicas, not only from the source
+    check(any(image.source != REGION for image in images),
+          'every copy was made from the source region')
+
+    # a retried copy (same token) doesn't create a duplicate
+    token = ec2_copy.client_token(ami_id, regions[0], 0)
+    first = ec2_copy._copy(ami_id, name, REGION, regions[0], 0, token)
+    again = ec2_copy._copy(ami_id, name, REGION, regions[0], 0, token)
+    check(first == again, f'retried copy created {again} besides {first}')
+
+
+def _write_image(path, blocks, size):
+    with open(path, 'wb') as fob:
+        fob.truncate(size)
+        for index, data in blocks.items():
+            fob.seek(index * ebs_direct.BLOCK_SIZE)
+            fob.write(data)
+
+
+def test_diff_blocks():
+    block = ebs_direct.BLOCK_SIZE
+    size = 64 * block
+    parent = os.path.join(TMPDIR, 'parent.img')
+    child = os.path.join(TMPDIR, 'child.img')
+
+    data = {i: os.urandom(block) for i in (0, 3, 10, 40)}
+    _write_image(parent, data, size)
+
+    parent_index = {}
+    uploaded = list(ebs_direct.diff_blocks(parent, {}, parent_index))
+    check(sorted(i for i, _, _ in uploaded) == sorted(data),
+          f'parent blocks: {[i for i, _, _ in uploaded]}')
+    for index, blob, blob_digest in uploaded:
+        check(blob == data[index], f'block {index} data differs')
+        check(blob_digest == ebs_direct.checksum(blob),
+              f'block {index} checksum differs')
+
+    # one block changed, one added, one zeroed
+    changed = dict(data)
+    changed[3] = os.urandom(block)
+    changed[20] = os.urandom(block)
+    del changed[40]
+    _write_image(child, changed, size)
+
+    child_index = {}
+    diff = {i: blob for i, blob, _ in
+            ebs_direct.diff_blocks(child, parent_index, child_index)}
+    check(sorted(diff) == [3, 20, 40], f'changed blocks: {sorted(diff)}')
+    check(diff[40] == ebs_direct.ZERO_BLOCK, 'zeroed block not zero')
+    check(sorted(child_index) == sorted(changed),
+          f'child index: {sorted(child_index)}')
+
+    # round-trip through the stand-in's EBS direct APIs
+    parent_id = ebs_direct.upload_image(parent, 'regress-parent', 1,
+                                        REGION)
+    child_id = ebs_direct.upload_image(child, 'regress-child', 1, REGION,
+                                       parent=parent_id)
+    check(ebs_direct.load_index(child_id) == child_index,
+          'saved child index differs')
+
+    os.remove(ebs_direct._index_path(child_id))
+    fetched = ebs_direct.fetch_index(child_id, REGION)
+    check(fetched == child_index, 'child snapshot blocks differ from image')
+
+
+def test_copy_tree():
+    src = os.path.join(TMPDIR, 'copy-src')
+    dest = os.path.join(TMPDIR, 'copy-dest')
+    os.makedirs(os.path.join(src, 'dir/sub'))
+
+    with open(os.path.join(src, 'dir/file'), 'wb') as fob:
+        fob.write(os.urandom(300000))
+    with open(os.path.join(src, 'sparse'), 'wb') as fob:
+        fob.write(b'head')
+        fob.seek(64 * 2**20)
+        fob.write(b'tail')
+    os.link(os.path.join(src, 'dir/file'), os.path.join(src, 'dir/sub/link'))
+    os.symlink('../file', os.path.join(src, 'dir/sub/symlink'))
+    os.mkfifo(os.path.join(src, 'fifo'))
+    os.chmod(os.path.join(src, 'dir/file'), 0o640)
+    os.utime(os.path.join(src, 'dir'), (1000000000, 1000000000))
+
+    stats = utils.copy_tree(src, dest)
+    check(stats.files >= 2, f'copied {stats.files} files')
+
+    for root, dirs, files in os.walk(src):
+        for name in dirs + files:
+            path = os.path.join(root, name)
+            copy = os.path.join(dest, os.path.relpath(path, src))
+            st, cst = os.lstat(path), os.lstat(copy)
+            for attr in ('st_mode', 'st_uid', 'st_gid', 'st_size'):
+                check(getattr(st, attr) == getattr(cst, attr),
+                      f'{copy}: {attr} differs')
+            if os.path.isfile(path) and not os.path.islink(path):
+                with open(path, 'rb') as a, open(copy, 'rb') as b:
+                    check(a.read() == b.read(), f'{copy}: data differs')
+
+    check(os.path.samefile(os.path.join(dest, 'dir/file'),
+                           os.path.join(dest, 'dir/sub/link')),
+          'hardlink not preserved')
+    check(os.readlink(os.path.join(dest, 'dir/sub/symlink')) == '../file',
+          'symlink target differs')
+    check(os.stat(os.path.join(dest, 'dir')).st_mtime == 1000000000,
+          'directory mtime not preserved')
+
+    sparse = os.stat(os.path.join(dest, 'sparse'))
+    check(sparse.st_blocks * 512 < sparse.st_size // 2,
+          'sparse file copied densely')
+
+
+TESTS = {
+    'tracker': test_tracker,
+    'register': test_register,
+    'replicate': test_replicate,
+    'diff_blocks': test_diff_blocks,
+    'copy_tree': test_copy_tree,
+}
+
+
+def main():
+    args = sys.argv[1:]
+    if '-h' in args or '--help' in args:
+        usage()
+
+    for name in args:
+        if name not in TESTS:
+            usage(f"unknown test: {name}")
+
+    global TMPDIR
+    TMPDIR = tempfile.mkdtemp(prefix='ec2-regress.')
+    identity = os.path.join(TMPDIR, 'identity.json')
+    with open(identity, 'w') as fob:
+        json.dump(IDENTITY, fob)
+
+    server = ec2_standin.serve(0, os.path.join(TMPDIR, 'store'),
+                               latency=LATENCY)
+    url = f'http://127.0.0.1:{server.server_port}'
+    os.environ.update(EC2_ENDPOINT_URL=url, EBS_ENDPOINT_URL=url,
+                      AWS_ACCESS_KEY_ID='standin',
+                      AWS_SECRET_ACCESS_KEY='standin',
+                      BT_EC2_METADATA=identity)
+    os.environ.pop('AWS_SESSION_TOKEN', None)
+    ebs_direct.INDEX_DIR = os.path.join(TMPDIR, 'index')
+
+    # the shared tracker polls the stand-in often, not every 10-15s
+    waiter._tracker = waiter.Tracker({'snapshot': 0.1, 'image': 0.1})
+
+    failed = []
+    try:
+        for name in args if args else TESTS:
+            info(f'{name}: running')
+            started = time.monotonic()
+            try:
+                TESTS[name]()
+            except Exception as e:
+                failed.append(name)
+                print(f"FAIL [{name}]: {type(e).__name__}: {e}",
+                      file=sys.stderr)
+                continue
+            info(f'{name}: passed ({time.monotonic() - started:.1f}s)')
+    finally:
+        server.shutdown()
+        shutil.rmtree(TMPDIR, ignore_errors=True)
+
+    if failed:
+        print("error: failed: " + ' '.join(failed), file=sys.stderr)
+        sys.exit(1)
+
+    print()
+    info("all tests passed")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,7 +6,11 @@ import importlib
 import sys
 
 modules = ['conf', 'ebs', 'ebs_bundle', 'ebs_publish', 'ebs_register',
-           'ebs_share', 'ec2_copy', 'utils']
+           'ebs_share', 'ec2_copy', 'utils', 'waiter',
+           'ebs_direct', 'ebs_blockstore', 'blockdev', 'ebs_batch',
+           'ebs_resume', 'copy_tree', 'image_builder', 'metrics',
+           'ec2_standin', 'ebs_bench', 'ebs_reap',
+           'ec2_replicate', 'ebs_inventory', 'ratelimit', 'regress']
 
 for module in modules:
     print(f'testing import of {module}')
@@ -11,36 +11,119 @@
 
 import re
 import os
+import errno
+import atexit
 import sys
+import stat
+import time
+import shutil
+import json
+import hashlib
 import logging
+import threading
 import subprocess
+import urllib.error
+import urllib.request
 
-import conf
+from concurrent.futures import ThreadPoolExecutor
 
-# depends on tkl-ec2metadata
-import ec2metadata
+import conf
+import metrics
+import ratelimit
 
-# depends on python3-boto & python3-boto3
-from boto.ec2 import connect_to_region
+# depends on python3-boto3
 import boto3
-
-
-def connect(region=None):
-    region = region if region else get_region()
-    return connect_to_region(
-        region,
-        aws_access_key_id=os.environ.get('AWS_ACCESS_KEY_ID'),
-        aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY'),
-        security_token=os.environ.get('AWS_SESSION_TOKEN', None))
-
-
-def connect_boto3(region=None):
+from botocore.config import Config
+
+CLIENT_CONFIG = Config(max_pool_connections=50,
+                       retries={'max_attempts': 5, 'mode': 'standard'})
+
+# tag identifying the appliance (name, codename, arch) a snapshot was built
+# from, e.g., core-bookworm-amd64; used to find the parent for child
+# snapshots
+APPLIANCE_TAG = 'turnkey-appliance'
+
+# tag identifying the exact build inputs (see get_fingerprint), used to
+# find resources to resume from after an interrupted run
+FINGERPRINT_TAG = 'turnkey-fingerprint'
+
+# tag on EBS volumes created for building (value is the builder's instance
+# id), so volumes leaked by crashed builds can be found and reaped
+BUILD_VOLUME_TAG = 'turnkey-build-volume'
+
+# instance metadata (IMDS); EC2_METADATA_URL may point to a local
+# stand-in, or BT_EC2_METADATA to a JSON fixture of the instance identity
+# document (e.g., {"instanceId": .., "availabilityZone": .., "region": ..})
+IMDS_URL = os.environ.get('EC2_METADATA_URL', 'http://169.254.169.254')
+IMDS_TIMEOUT = 2
+IMDS_ATTEMPTS = 3
+IMDS_TOKEN_TTL = 21600
+
+_identity = None
+_identity_lock = threading.Lock()
+
+_sessions = {}
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _get_credentials():
+    # unset credentials fall through to boto3's default chain, which
+    # refreshes instance profile / assumed role session tokens itself
+    return (os.environ.get('AWS_ACCESS_KEY_ID'),
+            os.environ.get('AWS_SECRET_ACCESS_KEY'),
+            os.environ.get('AWS_SESSION_TOKEN'))
+
+
+def connect(region=None, service='ec2', endpoint_url=None):
+    """Return shared (thread-safe) boto3 client for region and service.
+
+    Clients are cached per credential set; if the AWS_* credentials in the
+    environment change (e.g., a refreshed session token), a new session is
+    created and the stale clients for that service and region dropped.
+    EC2_ENDPOINT_URL overrides the EC2 endpoint (e.g., ec2_standin.py).
+    Clients are instrumented (see metrics) and rate limited (see
+    ratelimit).
+    """
     region = region if region else get_region()
-    return boto3.client(
-        'ec2',
-        region_name=region,
-        aws_access_key_id=os.environ.get('AWS_ACCESS_KEY_ID'),
-        aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY'))
+    if endpoint_url is None and service == 'ec2':
+        endpoint_url = os.environ.get('EC2_ENDPOINT_URL')
+    credentials = _get_credentials()
+    key = (service, region, endpoint_url)
+
+    with _clients_lock:
+        cached = _clients.get(key)
+        if cached and cached[0] == credentials:
+            return cached[1]
+
+        session = _sessions.get(credentials)
+        if session is None:
+            access_key, secret_key, token = credentials
+            session = boto3.session.Session(aws_access_key_id=access_key,
+                                            aws_secret_access_key=secret_key,
+                                            aws_session_token=token)
+            _sessions[credentials] = session
+
+        client = session.client(service, region_name=region,
+                                endpoint_url=endpoint_url,
+                                config=CLIENT_CONFIG)
+        metrics.instrument(client)
+        ratelimit.instrument(client)
+        _clients[key] = (credentials, client)
+        return client
+
+
+@atexit.register
+def _report_metrics():
+    log = get_logger('aws-metrics')
+    metrics.report(log)
+    for line in ratelimit.summary():
+        log.info(line)
+
+
+def error_code(e):
+    """Return AWS error code of botocore ClientError"""
+    return e.response.get('Error', {}).get('Code')
 
 
 def get_turnkey_version(rootfs):
@@ -48,16 +131,150 @@ def get_turnkey_version(rootfs):
         return fob.read().strip()
 
 
+def get_appliance(rootfs):
+    # turnkey-core-18.0-bookworm-amd64 -> core-bookworm-amd64
+    turnkey_version = get_turnkey_version(rootfs)
+    m = re.match(r'turnkey-(.+)-\d[^-]*-([a-z]+)-([a-z0-9]+)$',
+                 turnkey_version)
+    if not m:
+        return turnkey_version
+
+    return '-'.join(m.groups())
+
+
+# AMI names are the snapshot description: turnkey_version + ctime (+ -pvm)
+IMAGE_NAME = re.compile(r'turnkey-(?P<app>.+)-(?P<version>\d[^-]*)-'
+                        r'(?P<codename>[a-z]+)-(?P<arch>[a-z0-9]+)'
+                        r'_(?P<ctime>\d+)(?P<pvm>-pvm)?$')
+
+
+def parse_image_name(name):
+    """Return dict of app, version, codename, arch, ctime and pvm of
+    buildtasks AMI name, or None if name isn't one"""
+    m = IMAGE_NAME.match(name)
+    if not m:
+        return None
+
+    fields = m.groupdict()
+    fields['appliance'] = '-'.join([fields['app'], fields['codename'],
+                                    fields['arch']])
+    fields['ctime'] = int(fields['ctime'])
+    fields['pvm'] = bool(fields['pvm'])
+    return fields
+
+
+def get_rootfs_digest(rootfs):
+    """Digest of rootfs tree contents (paths, modes, owners, file data and
+    link targets; not mtimes, which change whenever rootfs is rebuilt)"""
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(rootfs):
+        dirs.sort()
+        for name in sorted(dirs + files):
+            path = os.path.join(root, name)
+            st = os.lstat(path)
+            entry = [os.path.relpath(path, rootfs), st.st_mode, st.st_uid,
+                     st.st_gid, st.st_size]
+            if stat.S_ISLNK(st.st_mode):
+                entry.append(os.readlink(path))
+            digest.update(repr(entry).encode())
+
+            if stat.S_ISREG(st.st_mode):
+                with open(path, 'rb') as fob:
+                    for block in iter(lambda: fob.read(2**20), b''):
+                        digest.update(block)
+
+    return digest.hexdigest()
+
+
+def get_buildtasks_commit():
+    bt = os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+    return subprocess.run(['git', '-C', bt, 'rev-parse', 'HEAD'],
+                          capture_output=True, text=True).stdout.strip()
+
+
+def get_fingerprint(rootfs, inputs=None):
+    """Build fingerprint: turnkey_version, build inputs (e.g., ISO sha256,
+    patches and options; see bt-ec2) or else rootfs digest, and buildtasks
+    commit"""
+    parts = [get_turnkey_version(rootfs),
+             inputs if inputs else get_rootfs_digest(rootfs),
+             get_buildtasks_commit()]
+    return hashlib.sha256('\n'.join(parts).encode()).hexdigest()[:32]
+
+
+def tag_list(tags):
+    return [{'Key': k, 'Value': v} for k, v in tags.items()]
+
+
+class MetadataError(Exception):
+    pass
+
+
+def _imds_request(path, method='GET', headers={}):
+    request = urllib.request.Request(IMDS_URL + path, method=method,
+                                     headers=headers)
+    error = None
+    for attempt in range(IMDS_ATTEMPTS):
+        try:
+            with urllib.request.urlopen(request,
+                                        timeout=IMDS_TIMEOUT) as response:
+                return response.read().decode()
+        except urllib.error.HTTPError as e:
+            # only throttling and server errors are worth retrying
+            if e.code not in (429, 500, 503):
+                raise
+            error = e
+        except (urllib.error.URLError, OSError) as e:
+            error = e
+
+    raise MetadataError(f'instance metadata unavailable ({path}): {error}')
+
+
+def _imds_token():
+    # IMDSv2; None falls back to IMDSv1 where tokens aren't supported
+    try:
+        return _imds_request(
+            '/latest/api/token', method='PUT',
+            headers={'X-aws-ec2-metadata-token-ttl-seconds':
+                     str(IMDS_TOKEN_TTL)})
+    except urllib.error.HTTPError as e:
+        if e.code not in (403, 404, 405):
+            raise
+        return None
+
+
+def get_identity():
+    """Return instance identity document (fetched once per process)"""
+    global _identity
+
+    with _identity_lock:
+        if _identity is None:
+            fixture = os.environ.get('BT_EC2_METADATA')
+            if fixture:
+                with open(fixture) as fob:
+                    _identity = json.load(fob)
+            else:
+                token = _imds_token()
+                headers = {'X-aws-ec2-metadata-token': token} if token else {}
+                _identity = json.loads(_imds_request(
+                    '/latest/dynamic/instance-identity/document',
+                    headers=headers))
+
+        return _identity
+
+
 def get_instanceid():
-    return ec2metadata.get('instance-id')
+    return get_identity()['instanceId']
 
 
 def get_zone():
-    return ec2metadata.get('availability-zone')
+    return get_identity()['availabilityZone']
 
 
 def get_region():
-    return ec2metadata.get('availability-zone')[0:-1]
+    identity = get_identity()
+    return identity.get('region', identity['availabilityZone'][0:-1])
 
 
 def get_all_regions():
@@ -113,6 +330,266 @@ def mkdir(path):
         os.makedirs(path)
 
 
-def rsync(rootfs, dest):
-    subprocess.run(
-            ['rsync', '-a', '-t', '-r', '-S', '-I', '-H', f'{rootfs}/', dest])
+def partition_path(device, number):
+    # e.g., /dev/xvdf -> /dev/xvdf2 but /dev/loop0 -> /dev/loop0p2
+    separator = 'p' if device[-1].isdigit() else ''
+    return f'{device}{separator}{number}'
+
+
+def install_grub(mount_path, device):
+    """Install GRUB to device from within populated rootfs at mount_path"""
+    submounts = ['/sys', '/proc', '/dev']
+    for s in submounts:
+        subprocess.run(['mount', '--bind', '--make-rslave', s, mount_path + s],
+                       check=True)
+    try:
+        subprocess.run(['chroot', mount_path, 'grub-install', device],
+                       check=True)
+        subprocess.run(['chroot', mount_path, 'update-grub'], check=True)
+        subprocess.run(['chroot', mount_path, 'update-initramfs', '-u'],
+                       check=True)
+    finally:
+        submounts.reverse()
+        for s in submounts:
+            subprocess.run(['umount', '-l', mount_path + s], check=True)
+
+
+# copy verification compares this many samples of each file's data
+VERIFY_SAMPLES = 4
+VERIFY_SAMPLE_SIZE = 64 * 2**10
+
+
+class CopyError(Exception):
+    pass
+
+
+class CopyStats:
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.entries = 0
+        self.elapsed = 0
+        self.lock = threading.Lock()
+
+    def add(self, nbytes):
+        with self.lock:
+            self.files += 1
+            self.bytes += nbytes
+
+    def __str__(self):
+        elapsed = max(self.elapsed, 0.001)
+        return (f'{self.entries} entries, {self.files} files, '
+                f'{self.bytes // 2**20}MiB in {self.elapsed:.1f}s '
+                f'({self.bytes / 2**20 / elapsed:.1f}MiB/s, '
+                f'{self.files / elapsed:.0f} files/s)')
+
+
+def _copy_xattrs(src, dest):
+    # posix ACLs are stored as system.posix_acl_* xattrs, so copied here too
+    try:
+        names = os.listxattr(src, follow_symlinks=False)
+    except OSError:
+        return
+
+    for name in names:
+        value = os.getxattr(src, name, follow_symlinks=False)
+        os.setxattr(dest, name, value, follow_symlinks=False)
+
+
+def _copy_metadata(src, dest, st):
+    os.chown(dest, st.st_uid, st.st_gid, follow_symlinks=False)
+    if not stat.S_ISLNK(st.st_mode):
+        # after chown, which clears setuid/setgid bits
+        os.chmod(dest, stat.S_IMODE(st.st_mode))
+    _copy_xattrs(src, dest)
+    os.utime(dest, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
+
+
+def _copy_range(src_fd, dest_fd, offset, length):
+    # in-kernel copy (reflink/server-side where supported); sendfile for
+    # older kernels or cross-filesystem copies that refuse it
+    end = offset + length
+    while offset < end:
+        try:
+            n = os.copy_file_range(src_fd, dest_fd, end - offset,
+                                   offset, offset)
+        except OSError:
+            os.lseek(dest_fd, offset, os.SEEK_SET)
+            n = os.sendfile(dest_fd, src_fd, offset, end - offset)
+
+        if n == 0:
+            raise CopyError(f'unexpected end of file at {offset}')
+        offset += n
+
+
+def _copy_file(src, dest, st):
+    """Copy regular file data (holes are kept) and metadata"""
+    with open(src, 'rb') as src_fob, open(dest, 'wb') as dest_fob:
+        src_fd, dest_fd = src_fob.fileno(), dest_fob.fileno()
+        offset = 0
+        while offset < st.st_size:
+            try:
+                offset = os.lseek(src_fd, offset, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    # no more data, the rest is a hole
+                    break
+                # SEEK_DATA not supported (e.g., EINVAL); copy the rest
+                _copy_range(src_fd, dest_fd, offset, st.st_size - offset)
+                break
+            hole = os.lseek(src_fd, offset, os.SEEK_HOLE)
+            _copy_range(src_fd, dest_fd, offset, hole - offset)
+            offset = hole
+
+        os.ftruncate(dest_fd, st.st_size)
+
+    _copy_metadata(src, dest, st)
+    return st.st_size
+
+
+def _remove(path):
+    # replace what's in the way, as rsync would
+    try:
+        st = os.lstat(path)
+    except FileNotFoundError:
+        return
+
+    if stat.S_ISDIR(st.st_mode):
+        shutil.rmtree(path)
+    else:
+        os.unlink(path)
+
+
+def _data_differs(src, dest, size):
+    """Compare samples of file data (start, end and evenly in between), so
+    e.g. a copy left zero-filled doesn't pass for its source"""
+    span = max(size - VERIFY_SAMPLE_SIZE, 0)
+    offsets = sorted({span * i // (VERIFY_SAMPLES - 1)
+                      for i in range(VERIFY_SAMPLES)})
+    with open(src, 'rb') as a, open(dest, 'rb') as b:
+        for offset in offsets:
+            if os.pread(a.fileno(), VERIFY_SAMPLE_SIZE, offset) != \
+                    os.pread(b.fileno(), VERIFY_SAMPLE_SIZE, offset):
+                return True
+    return False
+
+
+def _verify_tree(src, dest, links):
+    """Compare metadata of every entry of src with its copy in dest, and
+    samples of regular file data"""
+    errors = []
+    for root, dirs, files in os.walk(src):
+        for name in dirs + files:
+            path = os.path.join(root, name)
+            copy = os.path.join(dest, os.path.relpath(path, src))
+            try:
+                a, b = os.lstat(path), os.lstat(copy)
+            except FileNotFoundError:
+                errors.append(f'missing: {copy}')
+                continue
+
+            fields = ['st_mode', 'st_uid', 'st_gid']
+            if not stat.S_ISDIR(a.st_mode):
+                fields += ['st_size', 'st_mtime_ns', 'st_rdev']
+            for field in fields:
+                if getattr(a, field) != getattr(b, field):
+                    errors.append(f'{field} differs: {copy}')
+
+            if stat.S_ISLNK(a.st_mode) and \
+                    os.readlink(path) != os.readlink(copy):
+                errors.append(f'symlink differs: {copy}')
+
+            if stat.S_ISREG(a.st_mode) and a.st_size and \
+                    _data_differs(path, copy, a.st_size):
+                errors.append(f'data differs: {copy}')
+
+    for link, target in links:
+        if not os.path.samefile(link, target):
+            errors.append(f'hardlink not preserved: {link}')
+
+    return errors
+
+
+def copy_tree(src, dest, workers=None, verify=True):
+    """Copy tree src into dest preserving everything rsync -aHSAX would.
+
+    Walks src once with scandir; directories, symlinks and special files
+    are created inline while regular file data is copied by a thread pool
+    (copy_file_range, keeping sparse holes). Hardlinks are recreated once
+    their first path is copied, and directory metadata is applied last so
+    mtimes aren't disturbed. Returns CopyStats.
+    """
+    log = get_logger('copy-tree')
+    workers = workers if workers else min(32, (os.cpu_count() or 1) * 4)
+    stats = CopyStats()
+    started = time.monotonic()
+
+    dirs = []
+    links = []
+    inodes = {}
+    futures = []
+
+    def walk(path, dest_path):
+        with os.scandir(path) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+
+        for entry in entries:
+            st = entry.stat(follow_symlinks=False)
+            target = os.path.join(dest_path, entry.name)
+            stats.entries += 1
+
+            if stat.S_ISDIR(st.st_mode):
+                if not os.path.isdir(target) or os.path.islink(target):
+                    _remove(target)
+                    os.mkdir(target, 0o700)
+                dirs.append((entry.path, target, st))
+                walk(entry.path, target)
+                continue
+
+            _remove(target)
+            if st.st_nlink > 1:
+                key = (st.st_dev, st.st_ino)
+                if key in inodes:
+                    links.append((target, inodes[key]))
+                    continue
+                inodes[key] = target
+
+            if stat.S_ISREG(st.st_mode):
+                futures.append(executor.submit(_copy_file, entry.path,
+                                               target, st))
+            elif stat.S_ISLNK(st.st_mode):
+                os.symlink(os.readlink(entry.path), target)
+                _copy_metadata(entry.path, target, st)
+            else:
+                # device nodes, fifos and sockets
+                os.mknod(target, st.st_mode, st.st_rdev)
+                _copy_metadata(entry.path, target, st)
+
+    mkdir(dest)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        walk(src, dest)
+        for future in futures:
+            stats.add(future.result())
+
+    for target, first in links:
+        os.link(first, target)
+
+    # deepest first, so setting a directory's mtime isn't undone by
+    # creating entries in it
+    for path, target, st in reversed(dirs):
+        _copy_metadata(path, target, st)
+
+    st = os.stat(src)
+    _copy_metadata(src, dest, st)
+
+    stats.elapsed = time.monotonic() - started
+    log.info(f'copied {src} to {dest}: {stats}')
+
+    if verify:
+        errors = _verify_tree(src, dest, links)
+        if errors:
+            for error in errors[:20]:
+                log.error(error)
+            raise CopyError(f'{len(errors)} differences copying {src}')
+
+    return stats
@@ -0,0 +1,357 @@
+# Copyright (c) 2011-2026 TurnKey GNU/Linux - http://www.turnkeylinux.org
+#
+# This file is part of buildtasks.
+#
+# Buildtasks is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+
+"""Wait for AWS resource state transitions with backoff and deadlines"""
+
+import math
+import time
+import random
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+import utils
+import metrics
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+log = utils.get_logger('ebs-waiter')
+
+_executor = None
+_executor_lock = threading.Lock()
+
+_tracker = None
+_tracker_lock = threading.Lock()
+
+
+class WaiterError(Exception):
+    pass
+
+
+class WaiterTimeout(WaiterError):
+    pass
+
+
+class WaiterCancelled(WaiterError):
+    pass
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=32,
+                                           thread_name_prefix='waiter')
+        return _executor
+
+
+class Waiter:
+    """Poll check() until it returns True, backing off between polls.
+
+    check() may raise WaiterError to abort (e.g., resource entered a failed
+    state). The delay between polls grows by factor up to max_delay, with
+    +/- jitter (fraction) applied so that concurrent waiters spread out.
+    """
+
+    def __init__(self, delay=1, max_delay=30, factor=1.5, jitter=0.2,
+                 timeout=None):
+        self.delay = delay
+        self.max_delay = max_delay
+        self.factor = factor
+        self.jitter = jitter
+        self.timeout = timeout
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def _sleep_time(self, delay, deadline):
+        delay = delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+        if deadline is not None:
+            delay = min(delay, max(deadline - time.monotonic(), 0))
+
+        return delay
+
+    def wait(self, check, desc='condition'):
+        started = time.monotonic()
+        error = None
+        try:
+            with metrics.waiting():
+                return self._wait(check, desc, started)
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            metrics.record_wait(desc, time.monotonic() - started, error)
+
+    def _wait(self, check, desc, started):
+        deadline = None if self.timeout is None else started + self.timeout
+        delay = self.delay
+        polls = 0
+
+        while True:
+            polls += 1
+            if check():
+                elapsed = time.monotonic() - started
+                log.debug(f'{desc} reached after {elapsed:.1f}s '
+                          f'({polls} polls)')
+                return elapsed
+
+            if deadline is not None and time.monotonic() >= deadline:
+                raise WaiterTimeout(f'timed out after {self.timeout}s '
+                                    f'waiting for {desc}')
+
+            if self.cancelled.wait(self._sleep_time(delay, deadline)):
+                raise WaiterCancelled(f'cancelled waiting for {desc}')
+
+            delay = min(delay * self.factor, self.max_delay)
+
+    def submit(self, check, desc='condition'):
+        """Wait in the background; returns a concurrent.futures.Future"""
+        return _get_executor().submit(self.wait, check, desc)
+
+
+def status_check(get_state, status, name, failed=('error', 'failed')):
+    """Return check() comparing get_state() (a fresh describe) to status"""
+
+    def check():
+        current = get_state()
+        if current in failed and current != status:
+            raise WaiterError(f'{name} entered state {current}')
+
+        return current == status
+
+    return check
+
+
+def wait_for_status(get_state, status, name, timeout=None, **kwargs):
+    waiter = Waiter(timeout=timeout, **kwargs)
+    desc = f'{name} state={status}'
+    return waiter.wait(status_check(get_state, status, name), desc)
+
+
+class Tracker:
+    """Track state of in-flight snapshots and images across regions.
+
+    Instead of each waiter polling its own resource, waiters subscribe to
+    the tracker, which refreshes every tracked resource of a kind in a
+    region with one batched describe call per poll interval (so the call
+    rate depends on the number of regions, not of resources).
+    """
+
+    # kind: (describe method, owner argument, id filter, response key,
+    #        id key, poll interval)
+    KINDS = {
+        'snapshot': ('describe_snapshots', 'OwnerIds', 'snapshot-id',
+                     'Snapshots', 'SnapshotId', 10),
+        'image': ('describe_images', 'Owners', 'image-id', 'Images',
+                  'ImageId', 15),
+    }
+
+    # states a resource doesn't leave once it fails
+    FAILED = {
+        'snapshot': ('error',),
+        'image': ('failed', 'invalid', 'deregistered', 'error'),
+    }
+
+    # max values per describe filter
+    BATCH_SIZE = 200
+
+    # consecutive failed describes of a group after which it's logged as a
+    # warning and its waiters fail (transient errors are retried by boto)
+    DESCRIBE_FAILURES = 5
+
+    def __init__(self, intervals=None):
+        self.intervals = {kind: spec[-1] for kind, spec in self.KINDS.items()}
+        self.intervals.update(intervals if intervals else {})
+        self.states = {}
+        self.watchers = {}
+        self.due = {}
+        self.errors = {}
+        self.cond = threading.Condition()
+        self.thread = None
+        self.cancelled = threading.Event()
+
+    def cancel(self, cancelled=None):
+        """Cancel the wait given cancelled (its Event), or else all waits,
+        current and future (e.g., on shutdown)"""
+        (cancelled if cancelled else self.cancelled).set()
+        with self.cond:
+            self.cond.notify_all()
+
+    def watch(self, kind, region, resource_id):
+        if kind not in self.KINDS:
+            raise WaiterError(f'unknown resource kind: {kind}')
+
+        key = (kind, region, resource_id)
+        with self.cond:
+            self.watchers[key] = self.watchers.get(key, 0) + 1
+            self.states.setdefault(key, None)
+
+            # new groups are polled shortly, so a burst of subscriptions
+            # (e.g., copies to all regions) is batched into one call
+            self.due.setdefault((kind, region), time.monotonic() + 1)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run,
+                                               name='tracker', daemon=True)
+                self.thread.start()
+            self.cond.notify_all()
+
+    def unwatch(self, kind, region, resource_id):
+        key = (kind, region, resource_id)
+        with self.cond:
+            self.watchers[key] -= 1
+            if not self.watchers[key]:
+                del self.watchers[key]
+                del self.states[key]
+
+    def get_state(self, kind, region, resource_id):
+        """Last seen state (None if not seen yet)"""
+        with self.cond:
+            return self.states.get((kind, region, resource_id))
+
+    def _describe(self, kind, region, ids):
+        method, owners, id_filter, key, id_key, interval = self.KINDS[kind]
+        conn = utils.connect(region)
+        states = {}
+        for i in range(0, len(ids), self.BATCH_SIZE):
+            filters = [{'Name': id_filter,
+                        'Values': ids[i:i + self.BATCH_SIZE]}]
+            response = getattr(conn, method)(Filters=filters,
+                                             **{owners: ['self']})
+            for resource in response[key]:
+                states[resource[id_key]] = resource['State']
+
+        return states
+
+    def refresh(self, kind, region):
+        """Refresh states of tracked resources of kind in region"""
+        with self.cond:
+            ids = sorted(r for k, g, r in self.watchers
+                         if (k, g) == (kind, region))
+        if not ids:
+            return
+
+        group = (kind, region)
+        try:
+            with metrics.waiting():
+                states = self._describe(kind, region, ids)
+        except (BotoCoreError, ClientError) as e:
+            with self.cond:
+                failures = self.errors.get(group, (0, None))[0] + 1
+                self.errors[group] = (failures, e)
+                self.cond.notify_all()
+
+            msg = f'tracker: describing {kind}s in {region} failed: {e}'
+            if failures >= self.DESCRIBE_FAILURES:
+                log.warning(f'{msg} ({failures} times in a row)')
+            else:
+                log.debug(msg)
+            return
+
+        with self.cond:
+            self.errors.pop(group, None)
+            for resource_id, state in states.items():
+                key = (kind, region, resource_id)
+                if key in self.states:
+                    self.states[key] = state
+            self.cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                groups = set((k, g) for k, g, r in self.watchers)
+                for group in list(self.due):
+                    if group not in groups:
+                        del self.due[group]
+                        self.errors.pop(group, None)
+                if not self.due:
+                    self.thread = None
+                    return
+
+                now = time.monotonic()
+                due = [group for group, at in self.due.items() if at <= now]
+                if not due:
+                    self.cond.wait(min(self.due.values()) - now)
+                    continue
+
+                for kind, region in due:
+                    self.due[(kind, region)] = now + self.intervals[kind]
+
+            for kind, region in due:
+                self.refresh(kind, region)
+
+    def wait(self, kind, region, resource_id, status, timeout=None,
+             failed=None, cancelled=None):
+        """Block until resource reaches status; returns elapsed seconds.
+
+        Raises WaiterError if the resource enters a failed state (default:
+        FAILED[kind]) or describing it keeps failing, WaiterTimeout after
+        timeout seconds, and WaiterCancelled once cancel() is called (for
+        this wait's cancelled Event, if given, or for all waits).
+        """
+        desc = f'{resource_id} ({region}) state={status}'
+        failed = self.FAILED.get(kind, ()) if failed is None else failed
+        started = time.monotonic()
+        deadline = math.inf if timeout is None else started + timeout
+        error = None
+
+        self.watch(kind, region, resource_id)
+        try:
+            with self.cond:
+                while True:
+                    state = self.states[(kind, region, resource_id)]
+                    if state == status:
+                        elapsed = time.monotonic() - started
+                        log.debug(f'{desc} reached after {elapsed:.1f}s')
+                        return elapsed
+
+                    if state in failed:
+                        raise WaiterError(f'{resource_id} ({region}) '
+                                          f'entered state {state}')
+
+                    failures, e = self.errors.get((kind, region), (0, None))
+                    if failures >= self.DESCRIBE_FAILURES:
+                        raise WaiterError(f'describing {resource_id} '
+                                          f'({region}) failed {failures} '
+                                          f'times in a row: {e}') from e
+
+                    if self.cancelled.is_set() or \
+                            (cancelled and cancelled.is_set()):
+                        raise WaiterCancelled(f'cancelled waiting for '
+                                              f'{desc}')
+
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise WaiterTimeout(f'timed out after {timeout}s '
+                                            f'waiting for {desc} (last '
+                                            f'state: {state})')
+
+                    self.cond.wait(min(remaining, 60))
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            self.unwatch(kind, region, resource_id)
+            metrics.record_wait(desc, time.monotonic() - started, error)
+
+    def submit(self, kind, region, resource_id, status, timeout=None,
+               failed=None, cancelled=None):
+        """Wait in the background; returns a concurrent.futures.Future"""
+        return _get_executor().submit(self.wait, kind, region, resource_id,
+                                      status, timeout, failed, cancelled)
+
+
+def get_tracker():
+    """Return the process wide Tracker"""
+    global _tracker
+    with _tracker_lock:
+        if _tracker is None:
+            _tracker = Tracker()
+        return _tracker